@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Alignment of monthly series on integer month offsets.
+
+Model output and satellite products are all on the same monthly grid, so a
+series is fully described by the offset of its first month (months since
+1970-01) and its values. Clipping two series to their common window is then
+slicing both value arrays, without building, sorting and indexing a joined
+DataFrame:
+
+    comb = align([lpjml_cell['mfapar'], fapar_sat_cell], ['LPJmL-FAPAR', 'MODIS-FAPAR'])
+    comb['LPJmL-FAPAR'], comb['MODIS-FAPAR']   # numpy views, same length
+    comb.frame()                               # DataFrame for plots and csv
+
+The values are views on the data of the input series wherever the series
+has no missing months, they must not be modified in place.
+"""
+import numpy as np
+import pandas as pd
+
+
+def month_offsets(index):
+    """
+    months since 1970-01 of the dates of a DatetimeIndex
+    """
+    return np.asarray(index.values, dtype='datetime64[M]').astype(np.int64)
+
+
+def monthly(series):
+    """
+    First month and values of a monthly series on the full grid of months
+    :param series: pd.Series or one column pd.DataFrame
+        with DatetimeIndex
+    :return: tuple
+        offset of the first month and values as float array, a view on the
+        series data unless months are missing (then filled with nan)
+    """
+    index = series.index
+    values = series.values
+    if values.ndim == 2:
+        values = values[:, 0]
+    if values.dtype != np.float64:
+        values = values.astype(np.float64)
+    if len(index) == 0:
+        return 0, values
+    first, last = month_offsets(index[[0, -1]])
+    if last - first == len(index) - 1 and index.is_monotonic_increasing and index.is_unique:
+        return first, values
+    # missing months
+    offsets = month_offsets(index)
+    first = offsets.min()
+    grid = np.full(offsets.max() - first + 1, np.nan)
+    grid[offsets - first] = values
+    return first, grid
+
+
+class Aligned(object):
+    """
+    Named value arrays on a common window of months
+    """
+
+    def __init__(self, start, names, values):
+        self.start = start
+        self.names = list(names)
+        self.values = list(values)
+
+    def __len__(self):
+        return len(self.values[0]) if self.values else 0
+
+    def __getitem__(self, name):
+        return self.values[self.names.index(name)]
+
+    @property
+    def index(self):
+        """
+        DatetimeIndex of the window (first day of each month)
+        """
+        months = np.arange(self.start, self.start + len(self)).astype('datetime64[M]')
+        return pd.DatetimeIndex(months.astype('datetime64[ns]'), name='date')
+
+    def frame(self):
+        """
+        the aligned series as DataFrame
+        """
+        return pd.DataFrame(dict(zip(self.names, self.values)), index=self.index,
+                            columns=self.names)
+
+    def apply(self, func):
+        """
+        new Aligned with func applied to every value array
+        """
+        return Aligned(self.start, self.names, [func(values) for values in self.values])
+
+    def reindex(self, start, length):
+        """
+        the series on another window, months outside of this one are nan
+        """
+        if start == self.start and length == len(self):
+            return self
+        return Aligned(start, self.names,
+                       [window(values, self.start, start, length) for values in self.values])
+
+
+def window(values, first, start, length):
+    """
+    values of a series starting at month first on the window [start,
+    start + length), a view if the window is covered
+    """
+    lo = start - first
+    if lo >= 0 and lo + length <= len(values):
+        return values[lo:lo + length]
+    out = np.full(length, np.nan)
+    src_lo = max(lo, 0)
+    src_hi = min(lo + length, len(values))
+    if src_hi > src_lo:
+        out[src_lo - lo:src_hi - lo] = values[src_lo:src_hi]
+    return out
+
+
+def align(series, names=None):
+    """
+    Clip monthly series to the months covered by all of them
+    :param series: list
+        pd.Series or one column pd.DataFrames with DatetimeIndex, or
+        (first month, values) tuples as returned by monthly
+    :param names: list
+        names of the aligned series, default the series names (first column
+        of frames)
+    :return: Aligned
+    """
+    if names is None:
+        names = [s.name if isinstance(s, pd.Series) else s.columns[0] for s in series]
+    parts = [s if isinstance(s, tuple) else monthly(s) for s in series]
+    start = max(first for first, values in parts)
+    stop = min(first + len(values) for first, values in parts)
+    length = max(stop - start, 0)
+    return Aligned(start, names, [values[start - first:start - first + length]
+                                  for first, values in parts])
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Vectorized version of taskA.calc_annually for many cells at once.
+
+The monthly outputs of all cells are stacked into (cell, month) arrays,
+reshaped to (cell, year, 12) for the annual sums and the annual correlation
+matrices of all cells are computed in one go.
+"""
+import numpy as np
+import pandas as pd
+
+from lpjml import LPJmLCell
+
+TREES = ["fpc TrBE", "fpc TrBR", "fpc TeNE", "fpc TeBE", "fpc TeBS", "fpc BoNE", "fpc BoBS", "fpc BoNS"]
+GRASSES = ["fpc TrH", "fpc TeH"]
+
+
+def stack_cells(lpjml_cells, var, columns=None):
+    """
+    One variable of many cells as array
+    :param lpjml_cells: list
+        LPJmLCell instances
+    :param var: string
+        variable name, e.g. 'mgpp'
+    :param columns: list
+        columns of the variable to use, default the column named var
+    :return: tuple
+        dates (pd.DatetimeIndex) and array (cell, date) or (cell, date, column)
+    """
+    frames = [lpjml_cell[var] for lpjml_cell in lpjml_cells]
+    dates = frames[0].index
+    if not all(frame.index.equals(dates) for frame in frames[1:]):
+        for frame in frames[1:]:
+            dates = dates.union(frame.index)
+        frames = [frame.reindex(dates) for frame in frames]
+    single = columns is None
+    if single:
+        columns = [var]
+    # look the columns up once if all cells have the same layout
+    positions = frames[0].columns.get_indexer(columns)
+    if all(frame.columns.equals(frames[0].columns) for frame in frames[1:]):
+        data = np.stack([frame.values[:, positions] for frame in frames])
+    else:
+        data = np.stack([frame[columns].values for frame in frames])
+    if single:
+        data = data[:, :, 0]
+    return dates, data.astype(np.float64)
+
+
+def _monthly_to_annual(dates, data, years):
+    """
+    annual sums (like resample('YS').sum()) of (cell, month) data on the grid
+    of years, years outside of the monthly data are nan
+    """
+    month_idx = (dates.year - years[0]) * 12 + dates.month - 1
+    grid = np.full((data.shape[0], len(years) * 12), np.nan)
+    grid[:, month_idx] = data
+    annual = np.nansum(grid.reshape(data.shape[0], len(years), 12), axis=2)
+    covered = np.zeros(len(years), dtype=bool)
+    covered[dates.year.min() - years[0]:dates.year.max() - years[0] + 1] = True
+    annual[:, ~covered] = np.nan
+    return annual
+
+
+def _annual_to_grid(dates, data, years):
+    """
+    place annual data (cell, year[, column]) on the grid of years
+    (like asfreq('YS'))
+    """
+    grid = np.full((data.shape[0], len(years)) + data.shape[2:], np.nan)
+    grid[:, dates.year - years[0]] = data
+    return grid
+
+
+def _dominant(data, names):
+    """
+    series of the class with the highest mean per cell, of equal means the
+    first class like the descending sort in taskA.calc_annually
+    :return: tuple
+        (cell, year) array and the name of the dominant class per cell
+    """
+    means = np.nanmean(data, axis=1)
+    means = np.where(np.isnan(means), -np.inf, means)
+    idx = np.argmax(means, axis=1)
+    series = np.take_along_axis(data, idx[:, None, None], axis=2)[:, :, 0]
+    return series, [names[i] for i in idx]
+
+
+def nan_corr(data):
+    """
+    Pearson correlation matrices with pairwise complete observations (like
+    pd.DataFrame.corr) for many samples at once
+    :param data: np.array
+        (sample, observation, variable)
+    :return: np.array
+        (sample, variable, variable)
+    """
+    valid = ~np.isnan(data)
+    m = valid.astype(np.float64)
+    # center by the column means first to keep the sums well conditioned
+    x = np.where(valid, data - np.nanmean(data, axis=1, keepdims=True), 0.0)
+
+    n = np.einsum('soi,soj->sij', m, m)
+    sx = np.einsum('soi,soj->sij', x, m)
+    sxx = np.einsum('soi,soj->sij', x * x, m)
+    sxy = np.einsum('soi,soj->sij', x, x)
+    sy = np.swapaxes(sx, 1, 2)
+    syy = np.swapaxes(sxx, 1, 2)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cov = sxy - sx * sy / n
+        var_x = sxx - sx * sx / n
+        var_y = syy - sy * sy / n
+        corr = cov / np.sqrt(var_x * var_y)
+    corr[n < 2] = np.nan
+    return np.clip(corr, -1, 1)
+
+
+def annual_data(lpjmlpath, cells, lpjml_cells=None):
+    """
+    Annual GPP, NBP, dominant tree and grass FPC and vegetation carbon of
+    many cells, see taskA.calc_annually
+    :return: tuple
+        years (pd.DatetimeIndex), data (cell, year, 5) and the column names
+        per cell
+    """
+    if lpjml_cells is None:
+        lpjml_cells = [LPJmLCell(lpjmlpath, cell) for cell in cells]
+
+    monthly = {}
+    for var in ['mnpp', 'mfirec', 'mrh', 'mgpp']:
+        monthly_dates, monthly[var] = stack_cells(lpjml_cells, var)
+    mnbp = monthly['mnpp'] - monthly['mfirec'] - monthly['mrh']
+    fpc_dates, fpc = stack_cells(lpjml_cells, 'fpc', TREES + GRASSES)
+    vegc_dates, vegc = stack_cells(lpjml_cells, 'vegc')
+
+    first = min(monthly_dates.year.min(), fpc_dates.year.min(), vegc_dates.year.min())
+    last = max(monthly_dates.year.max(), fpc_dates.year.max(), vegc_dates.year.max())
+    years = np.arange(first, last + 1)
+
+    gpp = _monthly_to_annual(monthly_dates, monthly['mgpp'], years)
+    nbp = _monthly_to_annual(monthly_dates, mnbp, years)
+    fpc = _annual_to_grid(fpc_dates, fpc, years)
+    vegc = _annual_to_grid(vegc_dates, vegc, years)
+
+    trees, tree_names = _dominant(fpc[:, :, :len(TREES)], TREES)
+    grasses, grass_names = _dominant(fpc[:, :, len(TREES):], GRASSES)
+
+    data = np.stack([gpp, nbp, trees, grasses, vegc], axis=2)
+    columns = [['gpp', 'nbp', tree, grass, 'vegc'] for tree, grass in zip(tree_names, grass_names)]
+    years = pd.DatetimeIndex(pd.to_datetime(years.astype(str), format='%Y'), name='date')
+    return years, data, columns
+
+
+def annual_correlations(lpjmlpath, cells, lpjml_cells=None):
+    """
+    Correlation matrices of the annual data of many cells, same numbers as
+    the corrs of taskA.calc_annually
+    :return: dict
+        cell -> pd.DataFrame
+    """
+    years, data, columns = annual_data(lpjmlpath, cells, lpjml_cells)
+    corrs = nan_corr(data)
+    return {cell: pd.DataFrame(corr, index=cols, columns=cols)
+            for cell, corr, cols in zip(cells, corrs, columns)}
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+Import time of the analysis modules, each in a fresh interpreter, and the
+plotting and scipy modules they pull in.
+
+    python benchmarks/bench_import_time.py
+    python benchmarks/bench_import_time.py --baseline HEAD~1
+    python benchmarks/bench_import_time.py --baseline none
+
+The modules of a baseline commit (exported with git archive) are timed as
+well, by default the commit before the imports were made lazy, so the
+table shows the reduction. --baseline none times the current tree only.
+"""
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+rootpath = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+MODULES = ['error_metrics', 'bootstrap', 'rendering', 'taskA', 'taskB', 'taskC', 'global_eval']
+HEAVY = ['matplotlib', 'matplotlib.pyplot', 'seaborn', 'scipy.stats']
+
+# subject of the commit that made the imports lazy, the default baseline is
+# its parent
+LAZY_COMMIT = 'Import plotting and scipy modules only when needed'
+
+# prints the heavy modules loaded by the import
+SCRIPT = 'import sys, {module}; print(",".join(m for m in {heavy!r} if m in sys.modules))'
+
+
+def import_time(path, module, repeat=3):
+    """
+    best cumulative import time of a module in a fresh interpreter
+    :return: tuple
+        seconds and the loaded modules of HEAVY
+    """
+    best = None
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                              SCRIPT.format(module=module, heavy=HEAVY)],
+                             cwd=path, capture_output=True, text=True, check=True)
+        # "import time: self [us] | cumulative | imported package"
+        seconds = None
+        for line in out.stderr.splitlines():
+            fields = [field.strip() for field in line.split('|')]
+            if len(fields) == 3 and fields[2] == module:
+                seconds = int(fields[1]) / 1e6
+        if seconds is None:
+            raise RuntimeError('no -X importtime line for {} in {} (imported before?)'.format(
+                module, path))
+        best = seconds if best is None else min(best, seconds)
+    return best, out.stdout.strip()
+
+
+def default_baseline():
+    """the parent of the commit that made the imports lazy"""
+    out = subprocess.run(['git', 'log', '-1', '--format=%H', '--fixed-strings',
+                          '--grep', LAZY_COMMIT], cwd=rootpath, capture_output=True, text=True,
+                         check=True).stdout.strip()
+    if not out:
+        raise RuntimeError('commit "{}" not found, pass --baseline REV or none'.format(
+            LAZY_COMMIT))
+    return out + '~1'
+
+
+def export(rev, path):
+    """write the tree of a git revision to path"""
+    archive = subprocess.run(['git', 'archive', rev], cwd=rootpath, capture_output=True,
+                             check=True).stdout
+    subprocess.run(['tar', '-x', '-C', path], input=archive, check=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--baseline', help='git revision to compare with, none to skip, default '
+                                           'the commit before the lazy imports')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('modules', nargs='*', default=MODULES)
+    args = parser.parse_args()
+
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+    baseline = args.baseline or default_baseline()
+    basepath = None
+    if baseline != 'none':
+        print('baseline {}'.format(baseline))
+        basepath = tempfile.mkdtemp(prefix='climers_import_')
+        export(baseline, basepath)
+    try:
+        print('{:15s} {:>10s} {:>10s}  {}'.format('module', 'old [s]' if basepath else '',
+                                                    'new [s]', 'loads'))
+        for module in args.modules:
+            seconds, loaded = import_time(rootpath, module, args.repeat)
+            old = ''
+            if basepath:
+                try:
+                    old = '{:10.3f}'.format(import_time(basepath, module, args.repeat)[0])
+                except (subprocess.CalledProcessError, RuntimeError):
+                    old = 'missing'
+            print('{:15s} {:>10s} {:10.3f}  {}'.format(module, old, seconds, loaded or '-'))
+    finally:
+        if basepath:
+            shutil.rmtree(basepath)
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Times non_dominated_fronts and crowding_distance on random scores and
+compares the fronts with a naive pairwise sort on a subset.
+
+    python benchmarks/bench_pareto.py --parsets 50000 --objectives 3
+"""
+import os
+import sys
+import time
+import argparse
+
+rootpath = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, rootpath)
+
+import numpy as np
+
+from pareto import non_dominated_fronts, crowding_distance
+
+
+def naive_fronts(objectives):
+    """fronts by comparing all pairs, O(n^2) time and memory"""
+    dominates = ((objectives[:, None, :] <= objectives[None, :, :]).all(axis=2) &
+                 (objectives[:, None, :] < objectives[None, :, :]).any(axis=2))
+    fronts = np.zeros(len(objectives), dtype=np.int64)
+    left = np.ones(len(objectives), dtype=bool)
+    front = 0
+    while left.any():
+        front += 1
+        current = left & ~dominates[left].any(axis=0)
+        fronts[current] = front
+        left &= ~current
+    return fronts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--parsets', type=int, default=50000)
+    parser.add_argument('--objectives', type=int, default=3)
+    parser.add_argument('--check', type=int, default=3000,
+                        help='number of parameter sets compared with the naive sort')
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    # correlated scores like KGE of FAPAR, GPP-SIF and SSM
+    common = rng.normal(size=(args.parsets, 1))
+    scores = common + 0.5 * rng.normal(size=(args.parsets, args.objectives))
+    objectives = -scores
+
+    start = time.perf_counter()
+    fronts = non_dominated_fronts(objectives)
+    t_fronts = time.perf_counter() - start
+    start = time.perf_counter()
+    crowding_distance(objectives, fronts)
+    t_crowding = time.perf_counter() - start
+    print('{} parameter sets, {} objectives, {} fronts'.format(
+        args.parsets, args.objectives, fronts.max()))
+    print('non_dominated_fronts {:8.3f} s'.format(t_fronts))
+    print('crowding_distance    {:8.3f} s'.format(t_crowding))
+
+    subset = objectives[:args.check]
+    start = time.perf_counter()
+    expected = naive_fronts(subset)
+    t_naive = time.perf_counter() - start
+    start = time.perf_counter()
+    same = np.array_equal(non_dominated_fronts(subset), expected)
+    t_subset = time.perf_counter() - start
+    print('{} parameter sets: naive {:.3f} s, non_dominated_fronts {:.3f} s, same fronts: {}'.format(
+        len(subset), t_naive, t_subset, same))
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+Compares kendalltau_batch and spearman_batch with one scipy call per run
+on a synthetic ensemble (values and timings).
+
+    python benchmarks/bench_rank_correlation.py --runs 10000 --months 220
+"""
+import os
+import sys
+import time
+import argparse
+
+rootpath = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, rootpath)
+
+import numpy as np
+from scipy.stats import kendalltau, spearmanr
+
+from error_metrics import kendalltau_batch, spearman_batch
+
+
+def _scipy(func, s, o):
+    values = []
+    for row in s:
+        valid = ~(np.isnan(row) | np.isnan(o))
+        values.append(func(row[valid], o[valid])[0])
+    return np.array(values)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10000)
+    parser.add_argument('--months', type=int, default=220)
+    parser.add_argument('--check', type=int, default=500,
+                        help='number of runs compared with scipy')
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    o = np.round(rng.uniform(size=args.months), 3)
+    o[rng.uniform(size=args.months) < 0.1] = np.nan
+    s = o * rng.uniform(0, 1, size=(args.runs, 1)) + rng.uniform(size=(args.runs, args.months))
+
+    for name, batch, func in [('kendall', kendalltau_batch, kendalltau),
+                              ('spearman', spearman_batch, spearmanr)]:
+        start = time.perf_counter()
+        values = batch(s, o)
+        t_batch = time.perf_counter() - start
+        start = time.perf_counter()
+        reference = _scipy(func, s[:args.check], o)
+        t_scipy = (time.perf_counter() - start) * args.runs / args.check
+        print('{:8s} batch {:7.3f} s  scipy {:7.3f} s (extrapolated)  max diff {:.1e}'.format(
+            name, t_batch, t_scipy, np.nanmax(np.abs(values[:args.check] - reference))))
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the dedicated LPJmL parser with the generic pandas reader on the
+bundled data (without the binary cache).
+
+    python benchmarks/bench_read_data.py
+"""
+import os
+import sys
+import glob
+import timeit
+
+rootpath = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, rootpath)
+
+from exercise03 import _parse_data, _parse_lpjml
+
+
+def bench(files, repeat=3):
+    """
+    best time of `repeat` runs over all files for both readers
+    :return: dict
+        seconds for 'pandas' and 'lpjml'
+    """
+    results = {}
+    for name, reader in [('pandas', _parse_data), ('lpjml', _parse_lpjml)]:
+        results[name] = min(timeit.repeat(lambda: [reader(f) for f in files],
+                                          repeat=repeat, number=1))
+    return results
+
+
+if __name__ == '__main__':
+    datapath = os.path.join(rootpath, 'data')
+    # only files in the LPJmL layout, the others fall back to pandas anyway
+    files = [f for f in glob.glob(os.path.join(datapath, '**', '*.txt'), recursive=True)
+             if _parse_lpjml(f) is not None]
+
+    results = bench(files)
+    print('{} files'.format(len(files)))
+    for name, seconds in results.items():
+        print('{:8s} {:8.3f} s  {:6.2f} ms/file'.format(name, seconds, 1000 * seconds / len(files)))
+    print('speedup  {:8.2f} x'.format(results['pandas'] / results['lpjml']))
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Time and peak memory of reading a few cells of a wide satellite product:
+full parse (read_data), column-selective parse (read_columns), conversion
+(build_columns) and reads from the converted product.
+
+    python benchmarks/bench_satellite_columns.py --cells 20000 --months 228
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+
+rootpath = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, rootpath)
+
+import numpy as np
+
+from exercise03 import read_data
+from satellite import read_columns, build_columns, ColumnStore
+from synthetic import _write_table, _seasonal
+
+
+def measure(func):
+    """
+    seconds of one call and peak traced memory (MB) of a second one, tracing
+    slows down the parsers a lot
+    """
+    start = time.perf_counter()
+    func()
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak / 2 ** 20
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--cells', type=int, default=20000)
+    parser.add_argument('--months', type=int, default=228)
+    parser.add_argument('--read', type=int, default=10, help='number of cells read')
+    parser.add_argument('--chunk', type=int, default=2000, help='cells per chunk')
+    args = parser.parse_args()
+
+    tmppath = tempfile.mkdtemp()
+    try:
+        rng = np.random.RandomState(0)
+        cells = [str(i) for i in range(args.cells)]
+        keys = ['{}-{:02d}'.format(2000 + m // 12, m % 12 + 1) for m in range(args.months)]
+        values = _seasonal(rng, args.months, args.cells).T
+        values[rng.uniform(size=values.shape) < 0.02] = np.nan
+        fname = os.path.join(tmppath, 'product.txt')
+        _write_table(fname, ['date'] + cells, keys, values)
+        del values
+        print('{} cells x {} months, {:.1f} MB text'.format(
+            args.cells, args.months, os.path.getsize(fname) / 2 ** 20))
+
+        subset = cells[::args.cells // args.read][:args.read]
+        path = os.path.join(tmppath, 'columns')
+        results = [('read_data', measure(lambda: read_data(fname, cache=False)[subset])),
+                   ('read_columns', measure(lambda: read_columns(fname, subset))),
+                   ('build_columns', measure(lambda: build_columns(fname, path)))]
+        store = ColumnStore(path)
+        results += [('store.values', measure(lambda: store.values(subset))),
+                    ('store.iter_chunks', measure(lambda: [np.nanmean(v) for _, v in
+                                                           store.iter_chunks(args.chunk)]))]
+        for name, (seconds, peak) in results:
+            print('{:18s} {:8.3f} s  {:9.1f} MB peak'.format(name, seconds, peak))
+    finally:
+        shutil.rmtree(tmppath)
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+Compares rolling_metrics (cumulative sums) with one taskb_metrics_batch and
+KGE_batch call per window on a synthetic ensemble (values and timings).
+
+    python benchmarks/bench_windowed.py --runs 1000 --months 240 --window 36
+"""
+import os
+import sys
+import time
+import argparse
+import warnings
+
+rootpath = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, rootpath)
+
+import numpy as np
+
+from bootstrap import taskb_metrics_batch
+from error_metrics import KGE_batch
+from windowed import rolling_metrics
+
+
+def per_window(s, o, window):
+    """the metrics window by window, (runs, windows) arrays"""
+    metrics = {}
+    for start in range(s.shape[1] - window + 1):
+        sw, ow = s[:, start:start + window], o[:, start:start + window]
+        values = taskb_metrics_batch(sw, ow)
+        values['KGE'], _, values['alpha'], values['beta'] = KGE_batch(sw, ow)
+        for name, value in values.items():
+            metrics.setdefault(name, []).append(value)
+    return {name: np.stack(values, axis=1) for name, values in metrics.items()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=1000)
+    parser.add_argument('--months', type=int, default=240)
+    parser.add_argument('--window', type=int, default=36)
+    args = parser.parse_args()
+    warnings.simplefilter('ignore', RuntimeWarning)
+
+    rng = np.random.RandomState(0)
+    season = np.sin(np.arange(args.months) * 2 * np.pi / 12)
+    o = 0.5 + 0.3 * season + 0.05 * rng.normal(size=args.months)
+    o[rng.uniform(size=args.months) < 0.1] = np.nan
+    s = 0.5 + 0.3 * season * rng.uniform(0.5, 1.5, size=(args.runs, 1)) \
+        + 0.05 * rng.normal(size=(args.runs, args.months))
+    s[rng.uniform(size=s.shape) < 0.05] = np.nan
+
+    start = time.perf_counter()
+    reference = per_window(s, np.broadcast_to(o, s.shape), args.window)
+    t_loop = time.perf_counter() - start
+    start = time.perf_counter()
+    windows, metrics = rolling_metrics(s, o, args.window)
+    t_prefix = time.perf_counter() - start
+
+    print('{} runs, {} months, {} windows of {} months'.format(
+        args.runs, args.months, len(windows), args.window))
+    print('per window      {:8.3f} s'.format(t_loop))
+    print('rolling_metrics {:8.3f} s  ({:.1f}x)'.format(t_prefix, t_loop / t_prefix))
+    for name, values in reference.items():
+        print('{:6s} max abs difference {:.2e}'.format(
+            name, np.nanmax(np.abs(metrics[name] - values))))
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+Checks that annual.annual_correlations gives the same columns (dominant
+tree and grass class) and correlations as taskA.calc_annually, per cell.
+Exits with 1 if a cell differs.
+
+    python benchmarks/check_annual.py 7460 32785
+"""
+import os
+import sys
+import argparse
+
+rootpath = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, rootpath)
+
+import numpy as np
+
+import annual
+import taskA
+from driver import discover_cells
+from lpjml import LPJmLCell
+
+
+def skip_figure(job):
+    """renderer of calc_annually that draws nothing"""
+    return job.fname
+
+
+if __name__ == '__main__':
+    lpjmlpath = os.path.join(rootpath, 'data', 'LPJmL')
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('cells', nargs='*', help='default all cells in data/LPJmL')
+    parser.add_argument('--tolerance', type=float, default=1e-10)
+    args = parser.parse_args()
+
+    cells = args.cells or discover_cells(lpjmlpath)
+    lpjml_cells = [LPJmLCell(lpjmlpath, cell) for cell in cells]
+    corrs = annual.annual_correlations(lpjmlpath, cells, lpjml_cells)
+    ok = True
+    for cell, lpjml_cell in zip(cells, lpjml_cells):
+        expected = taskA.calc_annually(lpjmlpath, cell, out_path=rootpath, lpjml_cell=lpjml_cell,
+                                       csv=False, renderer=skip_figure)
+        result = corrs[cell]
+        if list(result.columns) != list(expected.columns):
+            ok = False
+            print('{:6s} columns differ: {} instead of {}'.format(
+                cell, list(result.columns), list(expected.columns)))
+            continue
+        a, b = result.values, expected.values
+        same = np.array_equal(np.isnan(a), np.isnan(b))
+        difference = np.nanmax(np.abs(a - b)) if same and not np.isnan(b).all() else 0.0
+        if not same or difference > args.tolerance:
+            ok = False
+        print('{:6s} {}'.format(cell, 'nan differ' if not same
+                                else 'max difference {:.2e}, {}'.format(difference,
+                                                                        ', '.join(result.columns[2:4]))))
+    print('same as calc_annually' if ok else 'ANNUAL DIFFERS FROM calc_annually')
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Checks that the numba and numpy backends of metric_kernels agree, on
+random series with gaps and on edge cases (no valid pair, a single value,
+observed mean 0, constant simulated or observed series, whose taskB
+metrics both take from numpy), and times both.
+Without numba the kernel runs as plain Python on a few rows. Exits with 1
+if the backends disagree. tests/test_metric_kernels.py runs the comparison
+under pytest.
+
+    python benchmarks/check_metric_kernels.py --runs 10000 --months 220
+"""
+import os
+import sys
+import time
+import argparse
+
+rootpath = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, rootpath)
+
+import numpy as np
+
+import metric_kernels
+from metric_kernels import PANEL, metric_panel, panel_rows, _kernel_panel
+
+
+def series(runs, months, seed=0):
+    """simulations with gaps and the edge cases in the first rows"""
+    rng = np.random.RandomState(seed)
+    o = 0.5 + 0.3 * np.sin(np.arange(months) * 2 * np.pi / 12) + 0.05 * rng.normal(size=months)
+    s = o * rng.uniform(0.5, 1.5, size=(runs, 1)) + 0.05 * rng.normal(size=(runs, months))
+    s[rng.uniform(size=s.shape) < 0.1] = np.nan
+    o = np.tile(o, (runs, 1))
+    o[rng.uniform(size=o.shape) < 0.1] = np.nan
+    s[0] = np.nan                   # no valid pair
+    s[1, 1:] = np.nan               # a single value
+    o[2] = 0.0                      # observed mean 0
+    s[3] = 0.3                      # constant simulation
+    o[4] = 0.4                      # constant observations
+    s[5], o[5] = 0.3, 0.4           # both constant
+    o[6, ::2] = 0.1                 # constant over the valid pairs only
+    s[6, 1::2] = np.nan
+    return s, o
+
+
+def compare(panel, expected):
+    """largest relative difference per metric, None if the nan differ"""
+    result = {}
+    for name in PANEL:
+        a, b = panel[name], expected[name]
+        same = np.isnan(a) == np.isnan(b)
+        finite = np.isfinite(a) & np.isfinite(b)
+        if not same.all() or not np.array_equal(a[~finite & ~np.isnan(a)], b[~finite & ~np.isnan(b)]):
+            result[name] = None
+        else:
+            result[name] = np.max(np.abs(a[finite] - b[finite]) / np.maximum(1, np.abs(b[finite]))
+                                  ) if finite.any() else 0.0
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10000)
+    parser.add_argument('--months', type=int, default=220)
+    parser.add_argument('--tolerance', type=float, default=1e-10)
+    args = parser.parse_args()
+
+    compiled = metric_kernels.backend('auto') == 'numba'
+    runs = args.runs if compiled else min(args.runs, 200)
+    s, o = series(runs, args.months)
+
+    start = time.perf_counter()
+    expected = metric_panel(s, o, 'numpy')
+    t_numpy = time.perf_counter() - start
+    if compiled:
+        # compile before timing
+        metric_panel(s[:2], o[:2], 'numba')
+        start = time.perf_counter()
+        panel = metric_panel(s, o, 'numba')
+        t_kernel = time.perf_counter() - start
+        label = 'numba'
+    else:
+        start = time.perf_counter()
+        with np.errstate(all='ignore'):
+            panel = _kernel_panel(panel_rows, s, o)
+        t_kernel = time.perf_counter() - start
+        label = 'kernel as Python (numba is not installed)'
+
+    print('{} runs, {} months'.format(runs, args.months))
+    print('numpy {:10.4f} s'.format(t_numpy))
+    print('{} {:10.4f} s'.format(label, t_kernel))
+    ok = True
+    for name, difference in compare(panel, expected).items():
+        if difference is None or difference > args.tolerance:
+            ok = False
+        print('{:6s} {}'.format(name, 'nan/inf differ' if difference is None
+                                else 'max rel difference {:.2e}'.format(difference)))
+    print('backends agree' if ok else 'BACKENDS DISAGREE')
+    sys.exit(0 if ok else 1)
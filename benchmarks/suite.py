@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+Times the read, align, metric, ensemble, aggregation and plotting stages on
+synthetic data (see synthetic.py) and records the results as JSON.
+
+    python benchmarks/suite.py --cells 20 --parsets 200
+    python benchmarks/suite.py --compare benchmarks/results/<old>.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+rootpath = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, rootpath)
+
+import matplotlib
+matplotlib.use('Agg')
+import numpy as np
+import pandas as pd
+
+import synthetic
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=rootpath,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def _time(func, repeat):
+    """best wall time of repeat calls and the result of the last call"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best, result
+
+
+def run(data, repeat=3, workdir=None):
+    """
+    Run all stages on a synthetic data folder
+    :param data: dict
+        as returned by synthetic.generate
+    :return: dict
+        stage name -> {'seconds': best time, 'units': number of items}
+    """
+    from exercise03 import read_data
+    from lpjml import LPJmLCell
+    from satellite import SatelliteStore
+    from error_metrics import KGE_batch
+    from alignment import align
+    import taskA
+    import taskB
+    import taskC
+    import annual
+
+    cells = data['cells']
+    lpjmlpath = data['lpjmlpath']
+    files = [os.path.join(root, f) for root, _, fs in os.walk(lpjmlpath) for f in fs
+             if f.endswith('.txt') and 'gridcell' not in f]
+    stages = {}
+
+    # read
+    stages['read_text'] = (_time(lambda: [read_data(f, cache=False) for f in files], repeat)[0],
+                           len(files))
+    [read_data(f) for f in files]
+    stages['read_cached'] = (_time(lambda: [read_data(f) for f in files], repeat)[0], len(files))
+
+    # align
+    lpjml_cells = [LPJmLCell(lpjmlpath, cell) for cell in cells]
+    for lpjml_cell in lpjml_cells:
+        lpjml_cell.combined(['mfapar', 'mgpp', 'mswc1'])
+    store = SatelliteStore(data['satpath'])
+    for product in ['fapar', 'sif', 'ssm']:
+        store.cells(product)
+
+    def align_cells():
+        combs = []
+        for cell, lpjml_cell in zip(cells, lpjml_cells):
+            combs.append([align([lpjml_cell[var], store.get(product, cell)])
+                          for var, product in [('mfapar', 'fapar'), ('mgpp', 'sif'),
+                                               ('mswc1', 'ssm')]])
+        return combs
+    stages['align'], combs = _time(align_cells, repeat)
+    stages['align'] = (stages['align'], len(cells))
+
+    # metrics
+    def metrics():
+        return [taskB.calc_metrics_values(*comb.values) for cell_combs in combs for comb in cell_combs]
+    stages['metrics_taskB'] = (_time(metrics, repeat)[0], 3 * len(cells))
+
+    # ensemble, read and align all parameter sets, then KGE in one batch
+    def ensemble():
+        results = taskC.iter_ensemble(data['cellpath'], data['satpath'], data['ensemble_cell'],
+                                      data['pars_set'], products=('fapar',), n_workers=1)
+        fapar = [combs['fapar'] for metrics, combs in results]
+        sims = np.vstack([comb['mfapar'] for comb in fapar])
+        return KGE_batch(sims, fapar[0]['MODIS-FAPAR'])
+    stages['ensemble_taskC'] = (_time(ensemble, repeat)[0], len(data['pars_set']))
+
+    sims = np.vstack([read_data(os.path.join(data['cellpath'], pars, '{}_{}_mfapar.txt'.format(
+        data['ensemble_cell'], pars)))['mfapar'].values for pars in data['pars_set']])
+    obs = sims.mean(axis=0)
+    stages['metrics_kge_batch'] = (_time(lambda: KGE_batch(sims, obs), repeat)[0], sims.shape[0])
+
+    # aggregation
+    stages['aggregation_annual'] = (
+        _time(lambda: annual.annual_correlations(lpjmlpath, cells, lpjml_cells), repeat)[0],
+        len(cells))
+
+    # plotting, a few cells are enough
+    plot_cells = cells[:min(len(cells), 3)]
+    outpath = tempfile.mkdtemp(dir=workdir)
+
+    def plotting():
+        for cell, lpjml_cell in zip(plot_cells, lpjml_cells):
+            vars_cell = taskA.calc_variables(lpjmlpath, outpath, cell, False, lpjml_cell)
+            vars_cell.name = cell
+            taskA.plot_vars(vars_cell, outpath, True)
+    stages['plotting'] = (_time(plotting, 1)[0], len(plot_cells))
+    shutil.rmtree(outpath)
+
+    return {name: {'seconds': round(seconds, 6), 'units': units}
+            for name, (seconds, units) in stages.items()}
+
+
+def compare(old, new):
+    """print the timing ratio new/old per stage"""
+    print('{:20s} {:>10s} {:>10s} {:>8s}'.format('stage', 'old [s]', 'new [s]', 'ratio'))
+    for name, result in new['stages'].items():
+        if name not in old['stages']:
+            continue
+        t_old = old['stages'][name]['seconds']
+        t_new = result['seconds']
+        print('{:20s} {:10.4f} {:10.4f} {:8.2f}'.format(name, t_old, t_new, t_new / t_old))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--cells', type=int, default=5)
+    parser.add_argument('--parsets', type=int, default=50)
+    parser.add_argument('--months', type=int, default=360)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--out', help='json file, default benchmarks/results/<commit>.json')
+    parser.add_argument('--compare', help='json file of an earlier run')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='climers_bench_')
+    os.environ['EXERCISE03_CACHE_DIR'] = os.path.join(workdir, 'cache')
+    os.makedirs(os.environ['EXERCISE03_CACHE_DIR'])
+    try:
+        data = synthetic.generate(os.path.join(workdir, 'data'), args.cells, args.parsets,
+                                  args.months)
+        stages = run(data, args.repeat, workdir)
+    finally:
+        shutil.rmtree(workdir)
+
+    commit = _git_commit()
+    result = {'commit': commit,
+              'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'config': {'cells': args.cells, 'parsets': args.parsets,
+                         'months': args.months, 'repeat': args.repeat},
+              'platform': {'python': platform.python_version(), 'numpy': np.__version__,
+                           'pandas': pd.__version__, 'machine': platform.machine()},
+              'stages': stages}
+
+    out = args.out or os.path.join(rootpath, 'benchmarks', 'results', '{}.json'.format(commit))
+    if not os.path.exists(os.path.dirname(out)):
+        os.makedirs(os.path.dirname(out))
+    with open(out, 'w') as f:
+        json.dump(result, f, indent=1)
+
+    for name, stage in stages.items():
+        print('{:20s} {:10.4f} s  ({} items)'.format(name, stage['seconds'], stage['units']))
+    print('written to {}'.format(out))
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), result)
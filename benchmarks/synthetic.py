@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+Writes synthetic LPJmL cells, a pars* ensemble and satellite products in the
+exact on-disk format of data/, for benchmarking at arbitrary sizes.
+
+    python benchmarks/synthetic.py /tmp/synthetic --cells 100 --parsets 500
+"""
+import os
+import argparse
+import numpy as np
+
+MONTHLY = ['mburnt_area', 'mevap', 'mfapar', 'mfirec', 'mgpp', 'minterc',
+           'mnpp', 'mrh', 'mswc1', 'mtransp']
+FPC = ['fpc NatStand', 'fpc TrBE', 'fpc TrBR', 'fpc TeNE', 'fpc TeBE', 'fpc TeBS',
+       'fpc BoNE', 'fpc BoBS', 'fpc BoNS', 'fpc TrH', 'fpc TeH', 'fpc PoH']
+# satellite products and the part of the model period they cover
+SATELLITE = {'MOD15A2H.FPAR.forLPJcells.2000.2018.30days.txt': (0.4, 1.2),
+             'GlobFluo-GOME2.SIF.forLPJcells.2007.2015.30days.txt': (0.6, 0.9),
+             'ESACCIv050.SSM.forLPJcells.1978.2017.30days.txt': (-0.1, 1.1)}
+
+
+def _months(start_year, n_months):
+    return [(start_year + i // 12, i % 12 + 1) for i in range(n_months)]
+
+
+def _fmt(value):
+    return 'NA' if np.isnan(value) else '{:.15g}'.format(value)
+
+
+def _write_table(fname, names, keys, values):
+    """
+    write a table in the LPJmL layout, values (row, column)
+    """
+    with open(fname, 'w') as f:
+        f.write(' '.join('"{}"'.format(n) for n in names) + '\n')
+        for key, row in zip(keys, values):
+            f.write('"{}" '.format(key) + ' '.join(_fmt(v) for v in row) + '\n')
+
+
+def _seasonal(rng, n_months, n_series, amplitude=1.0, offset=1.0, noise=0.1):
+    t = np.arange(n_months)
+    phase = rng.uniform(0, 2 * np.pi, size=(n_series, 1))
+    signal = offset + amplitude * np.sin(2 * np.pi * t / 12 + phase)
+    return np.clip(signal + noise * rng.standard_normal((n_series, n_months)), 0, None)
+
+
+def write_cell(path, prefix, rng, start_year, n_months):
+    """
+    all output files of one cell (or one parameter set of a cell)
+    """
+    os.makedirs(path, exist_ok=True)
+    months = _months(start_year, n_months)
+    keys = ['{}-{}'.format(y, m) for y, m in months]
+    series = _seasonal(rng, n_months, len(MONTHLY))
+    for var, values in zip(MONTHLY, series):
+        if var == 'mburnt_area':
+            values = np.zeros(n_months)
+        elif var in ('mfapar', 'mswc1'):
+            values = values / (values.max() + 1e-9)
+        elif var == 'mnpp':
+            values = values - 0.5
+        _write_table(os.path.join(path, '{}_{}.txt'.format(prefix, var)),
+                     ['date', var], keys, values[:, None])
+
+    n_years = n_months // 12
+    year_keys = ['{}-1'.format(start_year + i) for i in range(n_years)]
+    fpc = rng.uniform(0, 1, size=(n_years, len(FPC)))
+    _write_table(os.path.join(path, '{}_fpc.txt'.format(prefix)), ['date'] + FPC, year_keys, fpc)
+    vegc = np.cumsum(rng.uniform(0, 10, size=n_years))
+    _write_table(os.path.join(path, '{}_vegc.txt'.format(prefix)), ['date', 'vegc'], year_keys,
+                 vegc[:, None])
+    with open(os.path.join(path, '{}_gridcell.txt'.format(prefix)), 'w') as f:
+        f.write('"lon" "lat" "cropland"\n{:.2f} {:.2f} {:.4f}\n'.format(
+            rng.uniform(-180, 180), rng.uniform(-60, 80), rng.uniform(0, 1)))
+
+
+def generate(outpath, n_cells=5, n_parsets=50, n_months=360, start_year=1982, seed=0,
+             na_fraction=0.02):
+    """
+    Write a synthetic data folder
+    :param outpath: string
+        folder to create, gets the LPJmL and Satellite subfolders of data/
+    :param n_cells: int
+        number of cells
+    :param n_parsets: int
+        number of parameter sets, written for the first cell
+    :param n_months: int
+        length of the monthly model output
+    :return: dict
+        cells, ensemble cell and paths of the written data
+    """
+    rng = np.random.RandomState(seed)
+    lpjmlpath = os.path.join(outpath, 'LPJmL')
+    satpath = os.path.join(outpath, 'Satellite')
+    os.makedirs(satpath, exist_ok=True)
+    cells = [str(c) for c in rng.choice(67420, size=n_cells, replace=False) + 1]
+
+    for cell in cells:
+        write_cell(os.path.join(lpjmlpath, 'cell_{}'.format(cell)), cell, rng, start_year, n_months)
+
+    # ensemble for the first cell
+    ens_cell = cells[0]
+    cellpath = os.path.join(lpjmlpath, 'cell_{}'.format(ens_cell))
+    pars_set = ['pars{}'.format(i) for i in range(1, n_parsets + 1)]
+    for pars in pars_set:
+        write_cell(os.path.join(cellpath, pars), '{}_{}'.format(ens_cell, pars), rng,
+                   start_year, n_months)
+    _write_table(os.path.join(lpjmlpath, 'cell_{}_parameter-sets.txt'.format(ens_cell)),
+                 ['parset', 'WATER_BASE', 'EMAX'], pars_set,
+                 np.column_stack([rng.uniform(20, 90, n_parsets), rng.uniform(2, 11, n_parsets)]))
+
+    # satellite products, one column per cell
+    for fname, (first, last) in SATELLITE.items():
+        first = start_year * 12 + int(first * n_months)
+        n = int(last * n_months) - int(first - start_year * 12)
+        keys = ['{}-{:02d}'.format(m // 12, m % 12 + 1) for m in range(first, first + n)]
+        values = _seasonal(rng, n, n_cells).T
+        values[rng.uniform(size=values.shape) < na_fraction] = np.nan
+        _write_table(os.path.join(satpath, fname), ['date'] + cells, keys, values)
+
+    return {'cells': cells, 'ensemble_cell': ens_cell, 'pars_set': pars_set,
+            'datapath': outpath, 'lpjmlpath': lpjmlpath, 'satpath': satpath,
+            'cellpath': cellpath}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('outpath')
+    parser.add_argument('--cells', type=int, default=5)
+    parser.add_argument('--parsets', type=int, default=50)
+    parser.add_argument('--months', type=int, default=360)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    generate(args.outpath, args.cells, args.parsets, args.months, seed=args.seed)
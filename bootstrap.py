@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Bootstrap confidence intervals of the error metrics.
+
+The resample indices are drawn once as a (n_boot, n_time) matrix and the
+batched metrics of error_metrics (or taskb_metrics_batch) score all
+replicates of all runs at once. All runs of an ensemble are resampled with
+the same indices, so their replicates stay comparable. The moving block
+bootstrap (block_size > 1) keeps the autocorrelation of monthly series
+within blocks.
+
+    idx = resample_indices(n_time, 1000, block_size=12, seed=0)
+    kge = bootstrap_batch(KGE_batch, sims, obs, idx)   # (n_runs, n_boot)
+    low, high = confidence_interval(kge)
+"""
+import warnings
+
+import numpy as np
+
+from error_metrics import correlation_batch
+
+
+def resample_indices(n, n_boot=1000, block_size=None, seed=0):
+    """
+    Index matrix of bootstrap resamples
+    :param n: int
+        length of the series
+    :param n_boot: int
+        number of resamples
+    :param block_size: int
+        length of the blocks of the moving block bootstrap, None or 1
+        draws single values
+    :param seed: int
+        seed of the random numbers
+    :return: np.array
+        (n_boot, n) indices
+    """
+    rng = np.random.RandomState(seed)
+    if not block_size or block_size <= 1:
+        return rng.randint(0, n, size=(n_boot, n))
+    block_size = min(block_size, n)
+    n_blocks = -(-n // block_size)
+    starts = rng.randint(0, n - block_size + 1, size=(n_boot, n_blocks))
+    idx = starts[:, :, None] + np.arange(block_size)
+    return idx.reshape(n_boot, n_blocks * block_size)[:, :n]
+
+
+def bootstrap_batch(metric, s, o, idx, max_bytes=2 ** 28):
+    """
+    Metric of all resamples of many runs
+    :param metric: callable
+        batched metric, metric(s, o) with (rows, n_time) arrays, e.g.
+        error_metrics.KGE_batch; if it returns a tuple the first element
+        is used
+    :param s: np.array
+        simulated, (n_runs, n_time) or (n_time,)
+    :param o: np.array
+        observed, (n_time,) or same shape as s
+    :param idx: np.array
+        resample indices, see resample_indices
+    :param max_bytes: int
+        approximate memory limit, the resamples are evaluated in chunks
+    :return: np.array
+        (n_runs, n_boot)
+    """
+    s = np.atleast_2d(np.asarray(s, dtype=np.float64))
+    o = np.broadcast_to(np.asarray(o, dtype=np.float64), s.shape)
+    n_runs, n = s.shape
+    n_boot = idx.shape[0]
+    # the batched metrics keep a few temporaries of the size of the input
+    chunk = max(1, int(max_bytes // (8 * 8 * n_runs * n)))
+
+    values = np.empty((n_runs, n_boot))
+    for start in range(0, n_boot, chunk):
+        sub = idx[start:start + chunk]
+        k = sub.shape[0]
+        s_rep = s[:, sub].reshape(n_runs * k, n)
+        o_rep = o[:, sub].reshape(n_runs * k, n)
+        result = metric(s_rep, o_rep)
+        if isinstance(result, tuple):
+            result = result[0]
+        values[:, start:start + k] = result.reshape(n_runs, k)
+    return values
+
+
+def confidence_interval(values, alpha=0.05):
+    """
+    Percentile interval of bootstrap replicates
+    :param values: np.array
+        (..., n_boot)
+    :return: tuple
+        lower and upper bound, nan replicates are ignored
+    """
+    low, high = np.nanpercentile(values, [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=-1)
+    return low, high
+
+
+def taskb_metrics_batch(s, o):
+    """
+    NRMSE, NAE, VR, IoA and Corr of taskB (not rounded) for a batch of
+    series with nan. Like pandas the means and variances use all valid
+    values of a series, the residual terms only the valid pairs.
+    :param s: np.array
+        simulated, (rows, n_time)
+    :param o: np.array
+        observed, (rows, n_time)
+    :return: dict
+        metric name -> (rows,) array
+    """
+    s = np.atleast_2d(np.asarray(s, dtype=np.float64))
+    o = np.atleast_2d(np.asarray(o, dtype=np.float64))
+    with warnings.catch_warnings(), np.errstate(divide='ignore', invalid='ignore'):
+        # rows without valid values or pairs (mean of empty slice, degrees
+        # of freedom <= 0), their metrics are nan
+        warnings.simplefilter('ignore', RuntimeWarning)
+        o_mean = np.nanmean(o, axis=1)
+        squared = (s - o) ** 2
+        nrmse = np.sqrt(np.nanmean(squared, axis=1)) / o_mean
+        nae = (np.nanmean(s, axis=1) - o_mean) / o_mean
+        vr = np.nanvar(s, axis=1, ddof=1) / np.nanvar(o, axis=1, ddof=1)
+        denom = np.nansum((np.abs(s - o_mean[:, None]) + np.abs(o - o_mean[:, None])) ** 2,
+                          axis=1)
+        ioa = 1 - np.nansum(squared, axis=1) / denom
+    corr = correlation_batch(s, o)
+    return {'NRMSE': nrmse, 'NAE': nae, 'VR': vr, 'IoA': ioa, 'Corr': corr}
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Runs a per-cell analysis over many LPJmL cells on a pool of worker
+processes. A failing cell is recorded in the summary and does not stop the
+other cells.
+
+Figures deferred by the analysis (rendering.defer) are rendered on a
+separate rendering.RenderPool while the workers go on with the next cells.
+"""
+import os
+import re
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from functools import partial
+
+import pandas as pd
+
+import profiling
+import rendering
+
+
+def discover_cells(lpjmlpath):
+    """
+    all cells with a cell_<number> folder in lpjmlpath, in numerical order
+    """
+    cells = [m.group(1) for m in (re.match(r'^cell_(\d+)$', d) for d in os.listdir(lpjmlpath))
+             if m and os.path.isdir(os.path.join(lpjmlpath, m.group(0)))]
+    return sorted(cells, key=int)
+
+
+def _run_cell(func, cell):
+    # runs in the worker, exceptions are turned into a failed summary row
+    start = time.time()
+    try:
+        outputs = func(cell)
+        status, error = 'ok', ''
+    except Exception as e:
+        outputs = None
+        status = 'failed'
+        error = '{}: {}'.format(type(e).__name__, e)
+        traceback.print_exc()
+    jobs = rendering.take_deferred()
+    return {'cell': cell,
+            'status': status,
+            'seconds': round(time.time() - start, 3),
+            'error': error,
+            'outputs': ';'.join(outputs) if outputs else '',
+            'profile': profiling.take(),
+            'jobs': jobs if status == 'ok' else []}
+
+
+def run_cells(func, cells, n_workers=None, max_pending=None, render_workers=None):
+    """
+    Apply func to every cell
+    :param func: callable
+        func(cell) runs the analysis of one cell and returns the list of
+        written files, must be picklable (module level function or partial)
+    :param cells: list
+        cell numbers as strings
+    :param n_workers: int
+        number of worker processes, default number of CPUs, 1 runs in this
+        process
+    :param max_pending: int
+        maximum number of cells submitted to the pool at once, default
+        2 * n_workers
+    :param render_workers: int
+        number of processes rendering the deferred figures, see
+        rendering.RenderPool
+    :return: pd.DataFrame
+        one row per cell (in the order of cells) with status, run time,
+        error message and written files; a cell whose figure fails is failed
+    """
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    if max_pending is None:
+        max_pending = 2 * n_workers
+    run = partial(_run_cell, func)
+    pool = None
+
+    def render(row):
+        # the pool is started with the first deferred figure
+        nonlocal pool
+        for job in row.pop('jobs', []):
+            if pool is None:
+                pool = rendering.RenderPool(render_workers)
+            pool.submit(job, row['cell'])
+        return row
+
+    if n_workers == 1:
+        rows = [render(run(cell)) for cell in cells]
+    else:
+        rows = {}
+        cells_iter = iter(cells)
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            pending = {}
+            while True:
+                # keep at most max_pending cells in flight
+                for cell in cells_iter:
+                    pending[executor.submit(run, cell)] = cell
+                    if len(pending) >= max_pending:
+                        break
+                if not pending:
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    cell = pending.pop(future)
+                    try:
+                        rows[cell] = render(future.result())
+                    except Exception as e:
+                        # e.g. the worker process died
+                        rows[cell] = {'cell': cell, 'status': 'failed', 'seconds': None,
+                                      'error': '{}: {}'.format(type(e).__name__, e),
+                                      'outputs': ''}
+        rows = [rows[cell] for cell in cells]
+
+    for row in rows:
+        profiling.merge(row.pop('profile', None))
+    if pool is not None:
+        for cell, error in pool.close().items():
+            row = rows[cells.index(cell)]
+            row['status'] = 'failed'
+            row['error'] = 'render: {}'.format(error)
+
+    return pd.DataFrame(rows, columns=['cell', 'status', 'seconds', 'error', 'outputs']).set_index('cell')
+
+
+def run_cells_incremental(func, cells, inputs_of, manifest, code, n_workers=None):
+    """
+    run_cells for the cells whose inputs or code changed since the last run
+    :param inputs_of: callable
+        inputs_of(cell) returns the input files of a cell
+    :param manifest: manifest.Manifest
+        record of the earlier runs, updated and saved
+    :param code: string
+        hash of the code and config, see Manifest.code_hash
+    :return: pd.DataFrame
+        like run_cells, up to date cells have the status 'skipped'
+    """
+    inputs = {cell: manifest.input_hashes(inputs_of(cell)) for cell in cells}
+    stale = [cell for cell in cells if not manifest.is_current(cell, inputs[cell], code)]
+    summary = run_cells(func, stale, n_workers)
+
+    rows = []
+    for cell in cells:
+        if cell in summary.index:
+            row = summary.loc[cell]
+            if row['status'] == 'ok':
+                manifest.update(cell, inputs[cell], code, row['outputs'].split(';'))
+            else:
+                manifest.remove(cell)
+            rows.append(dict(row, cell=cell))
+        else:
+            rows.append({'cell': cell, 'status': 'skipped', 'seconds': 0.0, 'error': '',
+                         'outputs': ';'.join(manifest.outputs(cell))})
+    manifest.save()
+    return pd.DataFrame(rows, columns=['cell', 'status', 'seconds', 'error', 'outputs']).set_index('cell')
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+Packs the monthly output of all parameter sets (pars1, pars2, ...) of a cell
+into one memory-mapped float array of shape (parset, variable, month).
+
+The cube is stored as cube.npy next to a small index.json holding the names
+of the parameter sets, the variables, the dates and the modification time
+and size of every source file. Reading a variable for all runs only touches
+the pages of that slice, no text is parsed. open_cube builds the cube again
+if a parameter set was added or removed or a source file changed.
+"""
+import os
+import re
+import json
+import numpy as np
+import pandas as pd
+
+from exercise03 import read_data
+
+# monthly LPJmL outputs with a single column; fpc and vegc are annual
+VARIABLES = ['mburnt_area', 'mevap', 'mfapar', 'mfirec', 'mgpp', 'minterc',
+             'mnpp', 'mrh', 'mswc1', 'mtransp']
+
+CUBE_DIRNAME = 'ensemble_cube'
+
+
+def find_parsets(cellpath):
+    """
+    names of the parameter set folders in a cell folder, in numerical order
+    """
+    parsets = [d for d in os.listdir(cellpath)
+               if re.match(r'^pars\d+$', d) and os.path.isdir(os.path.join(cellpath, d))]
+    return sorted(parsets, key=lambda d: int(d[4:]))
+
+
+def _source_name(cell, pars, var):
+    # source file of a variable, relative to the cell folder
+    return os.path.join(pars, '{}_{}_{}.txt'.format(cell, pars, var))
+
+
+def _stamp(fname):
+    st = os.stat(fname)
+    return [st.st_mtime_ns, st.st_size]
+
+
+def source_stamps(cellpath, cell, pars_set, variables=VARIABLES):
+    """
+    modification time and size of the text files of a cube, by file name
+    relative to cellpath
+    """
+    names = [_source_name(cell, pars, var) for pars in pars_set for var in variables]
+    return {name: _stamp(os.path.join(cellpath, name)) for name in names}
+
+
+def build_cube(cellpath, cell, outpath=None, pars_set=None, variables=VARIABLES):
+    """
+    Convert the text output of all parameter sets of a cell to a cube
+    :param cellpath: string
+        folder of the cell, holding the pars* folders
+    :param cell: string
+        LPJmL cell number
+    :param outpath: string
+        folder for cube.npy and index.json, default cellpath/ensemble_cube
+    :param pars_set: list
+        parameter sets to include, default all pars* folders
+    :param variables: list
+        monthly variables to include
+    :return: string
+        outpath
+    """
+    if outpath is None:
+        outpath = os.path.join(cellpath, CUBE_DIRNAME)
+    if pars_set is None:
+        pars_set = find_parsets(cellpath)
+    if not os.path.exists(outpath):
+        os.makedirs(outpath)
+
+    def read_var(pars, var):
+        df = read_data(os.path.join(cellpath, _source_name(cell, pars, var)))
+        return df[var]
+
+    # stamps before reading, a file changed meanwhile is converted again on
+    # the next open
+    sources = source_stamps(cellpath, cell, pars_set, variables)
+    # all files of an ensemble must share the dates of the first parameter set
+    dates = read_var(pars_set[0], variables[0]).index
+
+    # written to temporary files, an interrupted build leaves no cube that
+    # looks valid: the old index is removed first and the new one is
+    # written last
+    index_fname = os.path.join(outpath, 'index.json')
+    cube_fname = os.path.join(outpath, 'cube.npy')
+    tmp_cube = '{}.{}.tmp'.format(cube_fname, os.getpid())
+    tmp_index = '{}.{}.tmp'.format(index_fname, os.getpid())
+    try:
+        cube = np.lib.format.open_memmap(tmp_cube, mode='w+', dtype=np.float64,
+                                         shape=(len(pars_set), len(variables), len(dates)))
+        for i, pars in enumerate(pars_set):
+            for j, var in enumerate(variables):
+                series = read_var(pars, var)
+                if not series.index.equals(dates):
+                    raise ValueError('dates of {} ({} to {}) differ from {} ({} to {})'.format(
+                        _source_name(cell, pars, var), series.index.min(), series.index.max(),
+                        _source_name(cell, pars_set[0], variables[0]), dates.min(), dates.max()))
+                cube[i, j, :] = series.values
+        cube.flush()
+        del cube
+
+        index = {'cell': cell,
+                 'parsets': list(pars_set),
+                 'variables': list(variables),
+                 'dates': [d.strftime('%Y-%m') for d in dates],
+                 'sources': sources}
+        with open(tmp_index, 'w') as f:
+            json.dump(index, f, indent=1)
+        if os.path.exists(index_fname):
+            os.remove(index_fname)
+        os.replace(tmp_cube, cube_fname)
+        os.replace(tmp_index, index_fname)
+    finally:
+        for fname in [tmp_cube, tmp_index]:
+            if os.path.exists(fname):
+                os.remove(fname)
+    return outpath
+
+
+def is_current(path, cellpath, cell):
+    """
+    True if the cube in path holds all parameter sets of cellpath and none
+    of their source files changed since it was built
+    """
+    try:
+        with open(os.path.join(path, 'index.json')) as f:
+            index = json.load(f)
+        if index['parsets'] != find_parsets(cellpath):
+            return False
+        return index['sources'] == source_stamps(cellpath, cell, index['parsets'],
+                                                 index['variables'])
+    except (OSError, ValueError, KeyError):
+        return False
+
+
+class EnsembleCube(object):
+    """
+    Read access to a cube written by build_cube
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, 'index.json')) as f:
+            index = json.load(f)
+        self.cell = index['cell']
+        self.parsets = index['parsets']
+        self.variables = index['variables']
+        self.dates = pd.DatetimeIndex(pd.to_datetime(index['dates'], format='%Y-%m'),
+                                      name='date')
+        self.data = np.load(os.path.join(path, 'cube.npy'), mmap_mode='r')
+
+    def values(self, variable):
+        """
+        view on one variable for all parameter sets, (parset, month)
+        """
+        return self.data[:, self.variables.index(variable), :]
+
+    def frame(self, variable):
+        """
+        one variable for all parameter sets as DataFrame (dates x parsets)
+        """
+        return pd.DataFrame(self.values(variable).T, index=self.dates,
+                            columns=self.parsets)
+
+    def series(self, pars, variable):
+        """
+        one variable of one parameter set
+        """
+        return pd.Series(self.data[self.parsets.index(pars), self.variables.index(variable), :],
+                         index=self.dates, name=variable)
+
+
+def open_cube(cellpath, cell, rebuild=False):
+    """
+    Open the cube of a cell, it is built first if it does not exist yet or
+    is out of date (see is_current)
+    """
+    path = os.path.join(cellpath, CUBE_DIRNAME)
+    if rebuild or not is_current(path, cellpath, cell):
+        build_cube(cellpath, cell, path)
+    return EnsembleCube(path)
+
+
+if __name__ == '__main__':
+    rootpath = os.path.dirname(os.path.realpath(__file__))
+    cellpath = os.path.join(rootpath, 'data', 'LPJmL', 'cell_32785')
+    cube = open_cube(cellpath, '32785', rebuild=True)
+    print(cube.frame('mfapar').describe())
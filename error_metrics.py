@@ -19,13 +19,19 @@ functions:
     L:        likelihood estimation
     correlation: correlation
 
+PairedSeries filters a pair of series once and shares sums, means and
+residuals between all metrics of the pair, the functions above use it.
+
+batched variants (suffix _batch) score a (n_runs, n_time) matrix of
+simulations against one observed series or a matching matrix in a single
+vectorized pass, see filter_nan_batch. kendalltau_batch and spearman_batch
+rank many simulations against one observed series.
+
 """
 
 # import required modules
+import functools
 import numpy as np
-from random import randrange
-import matplotlib.pyplot as plt
-from scipy.stats import kendalltau
 
 
 def filter_nan(s, o):
@@ -45,6 +51,152 @@ def filter_nan(s, o):
     return s, o
 
 
+def _cached(func):
+    # read only attribute, computed on first access
+    name = func.__name__
+
+    @functools.wraps(func)
+    def getter(self):
+        try:
+            return self._cache[name]
+        except KeyError:
+            value = self._cache[name] = func(self)
+            return value
+    return property(getter)
+
+
+class PairedSeries(object):
+    """
+    simulated and observed series with the nan pairs removed once (see
+    filter_nan). Sums, means and residuals are computed on first use and
+    shared by all metrics, so the full metric panel of a pair costs about
+    one pass over the data.
+    input:
+        s: simulated
+        o: observed
+
+    pair = PairedSeries(s, o)
+    pair.rmse(), pair.KGE(), pair.metrics()
+    """
+
+    def __init__(self, s, o):
+        self.s, self.o = filter_nan(s, o)
+        self._cache = {}
+
+    @_cached
+    def n(self):
+        return self.s.size
+
+    @_cached
+    def sum_s(self):
+        return np.sum(self.s)
+
+    @_cached
+    def sum_o(self):
+        return np.sum(self.o)
+
+    @_cached
+    def mean_s(self):
+        return self.sum_s / self.n
+
+    @_cached
+    def mean_o(self):
+        return self.sum_o / self.n
+
+    @_cached
+    def residuals(self):
+        return self.s - self.o
+
+    @_cached
+    def sum_residuals(self):
+        return np.sum(self.residuals)
+
+    @_cached
+    def sum_abs_residuals(self):
+        return np.sum(np.abs(self.residuals))
+
+    @_cached
+    def sse(self):
+        # sum of squared residuals
+        return np.dot(self.residuals, self.residuals)
+
+    @_cached
+    def s_centered(self):
+        return self.s - self.mean_s
+
+    @_cached
+    def o_centered(self):
+        return self.o - self.mean_o
+
+    @_cached
+    def ss_s(self):
+        return np.dot(self.s_centered, self.s_centered)
+
+    @_cached
+    def ss_o(self):
+        return np.dot(self.o_centered, self.o_centered)
+
+    @_cached
+    def sp(self):
+        # sum of the cross products of the deviations
+        return np.dot(self.s_centered, self.o_centered)
+
+    def pc_bias(self):
+        return 100.0 * self.sum_residuals / self.sum_o
+
+    def apb(self):
+        return 100.0 * self.sum_abs_residuals / self.sum_o
+
+    def rmse(self):
+        return np.sqrt(self.sse / self.n)
+
+    def mae(self):
+        return self.sum_abs_residuals / self.n
+
+    def bias(self):
+        return self.sum_residuals / self.n
+
+    def NS(self):
+        return 1 - self.sse / self.ss_o
+
+    def L(self, N=5):
+        return np.exp(-N * self.sse / self.ss_o)
+
+    def correlation(self):
+        if self.n == 0:
+            return np.NaN
+        return np.clip(self.sp / np.sqrt(self.ss_s * self.ss_o), -1, 1)
+
+    def index_agreement(self):
+        return 1 - self.sse / np.sum(
+            (np.abs(self.s - self.mean_o) + np.abs(self.o_centered)) ** 2)
+
+    def agreement_coefficient(self):
+        dbar = np.abs(self.mean_s - self.mean_o)
+        return 1 - self.sse / np.sum(
+            (dbar + np.abs(self.s_centered)) * (dbar + np.abs(self.o_centered)))
+
+    def KGE(self):
+        cc = self.correlation()
+        alpha = np.sqrt(self.ss_s / self.ss_o)
+        beta = self.sum_s / self.sum_o
+        kge = 1 - np.sqrt((cc - 1) ** 2 + (alpha - 1) ** 2 + (beta - 1) ** 2)
+        return kge, cc, alpha, beta
+
+    def metrics(self, N=5):
+        """
+        all metrics of the pair
+        output:
+            dict name -> value, KGE split into kge, cc, alpha and beta
+        """
+        kge, cc, alpha, beta = self.KGE()
+        return {'pc_bias': self.pc_bias(), 'apb': self.apb(), 'rmse': self.rmse(),
+                'mae': self.mae(), 'bias': self.bias(), 'NS': self.NS(), 'L': self.L(N),
+                'correlation': cc, 'index_agreement': self.index_agreement(),
+                'agreement_coefficient': self.agreement_coefficient(),
+                'kge': kge, 'cc': cc, 'alpha': alpha, 'beta': beta}
+
+
 def kendalltau_nan(s, o):
     """
     kendall's tau
@@ -54,6 +206,9 @@ def kendalltau_nan(s, o):
     output:
         kendall's tau
     """
+    # scipy is imported on first use only, the other metrics need numpy only
+    from scipy.stats import kendalltau
+
     s, o = filter_nan(s, o)
     return kendalltau(s, o)[0]
 
@@ -67,8 +222,7 @@ def pc_bias(s, o):
     output:
         pc_bias: percent bias
     """
-    s, o = filter_nan(s, o)
-    return 100.0 * sum(s - o) / sum(o)
+    return PairedSeries(s, o).pc_bias()
 
 
 def apb(s, o):
@@ -80,8 +234,7 @@ def apb(s, o):
     output:
         apb_bias: absolute percent bias
     """
-    s, o = filter_nan(s, o)
-    return 100.0 * sum(abs(s - o)) / sum(o)
+    return PairedSeries(s, o).apb()
 
 
 def rmse(s, o):
@@ -93,8 +246,7 @@ def rmse(s, o):
     output:
         rmses: root mean squared error
     """
-    s, o = filter_nan(s, o)
-    return np.sqrt(np.mean((s - o) ** 2))
+    return PairedSeries(s, o).rmse()
 
 
 def mae(s, o):
@@ -106,8 +258,7 @@ def mae(s, o):
     output:
         maes: mean absolute error
     """
-    s, o = filter_nan(s, o)
-    return np.mean(abs(s - o))
+    return PairedSeries(s, o).mae()
 
 
 def bias(s, o):
@@ -119,8 +270,7 @@ def bias(s, o):
     output:
         bias: bias
     """
-    s, o = filter_nan(s, o)
-    return np.mean(s - o)
+    return PairedSeries(s, o).bias()
 
 
 def NS(s, o):
@@ -132,8 +282,7 @@ def NS(s, o):
     output:
         ns: Nash Sutcliffe efficient coefficient
     """
-    s, o = filter_nan(s, o)
-    return 1 - sum((s - o) ** 2) / sum((o - np.mean(o)) ** 2)
+    return PairedSeries(s, o).NS()
 
 
 def L(s, o, N=5):
@@ -145,8 +294,7 @@ def L(s, o, N=5):
     output:
         L: likelihood
     """
-    s, o = filter_nan(s, o)
-    return np.exp(-N * sum((s - o) ** 2) / sum((o - np.mean(o)) ** 2))
+    return PairedSeries(s, o).L(N)
 
 
 def correlation(s, o):
@@ -158,13 +306,7 @@ def correlation(s, o):
     output:
         correlation: correlation coefficient
     """
-    s, o = filter_nan(s, o)
-    if s.size == 0:
-        corr = np.NaN
-    else:
-        corr = np.corrcoef(o, s)[0, 1]
-
-    return corr
+    return PairedSeries(s, o).correlation()
 
 
 def index_agreement(s, o):
@@ -178,10 +320,7 @@ def index_agreement(s, o):
     output:
         ia: index of agreement
     """
-    s, o = filter_nan(s, o)
-    ia = 1 - (np.sum((o - s) ** 2)) / (np.sum(
-        (np.abs(s - np.mean(o)) + np.abs(o - np.mean(o))) ** 2))
-    return ia
+    return PairedSeries(s, o).index_agreement()
 
 
 def agreement_coefficient(s, o):
@@ -195,13 +334,7 @@ def agreement_coefficient(s, o):
     output:
         ac: agreement coefficient
     """
-    s, o = filter_nan(s, o)
-    sbar = np.mean(s)
-    obar = np.mean(o)
-    ac = 1 - (np.sum((s - o) ** 2)) / np.sum(
-        (np.abs(sbar - obar) + np.abs(s - sbar)) * (
-        np.abs(sbar - obar) + np.abs(o - obar)))
-    return ac
+    return PairedSeries(s, o).agreement_coefficient()
 
 
 def KGE(s, o):
@@ -216,12 +349,7 @@ def KGE(s, o):
         alpha: ratio of the standard deviation
         beta: ratio of the mean
     """
-    s, o = filter_nan(s, o)
-    cc = correlation(s, o)
-    alpha = np.std(s) / np.std(o)
-    beta = np.sum(s) / np.sum(o)
-    kge = 1 - np.sqrt((cc - 1) ** 2 + (alpha - 1) ** 2 + (beta - 1) ** 2)
-    return kge, cc, alpha, beta
+    return PairedSeries(s, o).KGE()
 
 
 def assimilation_eff(assimilated, simulated, observed):
@@ -238,4 +366,326 @@ def assimilation_eff(assimilated, simulated, observed):
     a, o = filter_nan(assimilated, observed)
 
     Eff = 100 * (1 - np.sum((a - o) ** 2) / np.sum((s - o) ** 2))
-    return Eff
\ No newline at end of file
+    return Eff
+
+
+def filter_nan_batch(s, o):
+    """
+    masked version of filter_nan for a batch of simulations
+
+    the pairs where either simulated or observed data is nan are set to zero
+    and excluded via the returned mask, so that every row keeps its length
+    input:
+        s: simulated, (n_runs, n_time) or (n_time,)
+        o: observed, (n_time,) or same shape as s
+    output:
+        s: simulated with masked values set to 0, (n_runs, n_time)
+        o: observed with masked values set to 0, (n_runs, n_time)
+        mask: True where both are valid
+        n: number of valid pairs per run
+    """
+    s = np.atleast_2d(np.asarray(s, dtype=np.float64))
+    o = np.broadcast_to(np.asarray(o, dtype=np.float64), s.shape)
+    mask = ~(np.isnan(s) | np.isnan(o))
+    s = np.where(mask, s, 0.0)
+    o = np.where(mask, o, 0.0)
+    n = mask.sum(axis=1)
+    return s, o, mask, n
+
+
+def _centered(x, mask, n):
+    # deviations from the masked row mean, zero outside of the mask (nan
+    # mean for rows without a valid pair)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        xbar = x.sum(axis=1) / n
+    return np.where(mask, x - xbar[:, None], 0.0), xbar
+
+
+def pc_bias_batch(s, o):
+    """
+    Percent Bias for a batch of simulations, see pc_bias
+    """
+    s, o, mask, n = filter_nan_batch(s, o)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return 100.0 * np.sum(s - o, axis=1) / np.sum(o, axis=1)
+
+
+def apb_batch(s, o):
+    """
+    Absolute Percent Bias for a batch of simulations, see apb
+    """
+    s, o, mask, n = filter_nan_batch(s, o)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return 100.0 * np.sum(np.abs(s - o), axis=1) / np.sum(o, axis=1)
+
+
+def rmse_batch(s, o):
+    """
+    Root Mean Squared Error for a batch of simulations, see rmse
+    """
+    s, o, mask, n = filter_nan_batch(s, o)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.sqrt(np.sum((s - o) ** 2, axis=1) / n)
+
+
+def mae_batch(s, o):
+    """
+    Mean Absolute Error for a batch of simulations, see mae
+    """
+    s, o, mask, n = filter_nan_batch(s, o)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.sum(np.abs(s - o), axis=1) / n
+
+
+def bias_batch(s, o):
+    """
+    Bias for a batch of simulations, see bias
+    """
+    s, o, mask, n = filter_nan_batch(s, o)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.sum(s - o, axis=1) / n
+
+
+def NS_batch(s, o):
+    """
+    Nash Sutcliffe efficiency coefficient for a batch of simulations, see NS
+    """
+    s, o, mask, n = filter_nan_batch(s, o)
+    oc, obar = _centered(o, mask, n)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return 1 - np.sum((s - o) ** 2, axis=1) / np.sum(oc ** 2, axis=1)
+
+
+def L_batch(s, o, N=5):
+    """
+    Likelihood for a batch of simulations, see L
+    """
+    s, o, mask, n = filter_nan_batch(s, o)
+    oc, obar = _centered(o, mask, n)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.exp(-N * np.sum((s - o) ** 2, axis=1) / np.sum(oc ** 2, axis=1))
+
+
+def correlation_batch(s, o):
+    """
+    correlation coefficient for a batch of simulations, see correlation
+    """
+    s, o, mask, n = filter_nan_batch(s, o)
+    sc, sbar = _centered(s, mask, n)
+    oc, obar = _centered(o, mask, n)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.sum(sc * oc, axis=1) / np.sqrt(
+            np.sum(sc ** 2, axis=1) * np.sum(oc ** 2, axis=1))
+
+
+def index_agreement_batch(s, o):
+    """
+    index of agreement for a batch of simulations, see index_agreement
+    """
+    s, o, mask, n = filter_nan_batch(s, o)
+    oc, obar = _centered(o, mask, n)
+    obar = obar[:, None]
+    denom = np.where(mask, np.abs(s - obar) + np.abs(o - obar), 0.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return 1 - np.sum((o - s) ** 2, axis=1) / np.sum(denom ** 2, axis=1)
+
+
+def agreement_coefficient_batch(s, o):
+    """
+    agreement coefficient for a batch of simulations, see
+    agreement_coefficient
+    """
+    s, o, mask, n = filter_nan_batch(s, o)
+    sc, sbar = _centered(s, mask, n)
+    oc, obar = _centered(o, mask, n)
+    dbar = np.abs(sbar - obar)[:, None]
+    denom = np.where(mask, (dbar + np.abs(sc)) * (dbar + np.abs(oc)), 0.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return 1 - np.sum((s - o) ** 2, axis=1) / np.sum(denom, axis=1)
+
+
+def KGE_batch(s, o):
+    """
+    Kling-Gupta Efficiency for a batch of simulations, see KGE
+    input:
+        s: simulated, (n_runs, n_time)
+        o: observed, (n_time,) or (n_runs, n_time)
+    output:
+        kge, cc, alpha, beta: arrays of length n_runs
+    """
+    s, o, mask, n = filter_nan_batch(s, o)
+    sc, sbar = _centered(s, mask, n)
+    oc, obar = _centered(o, mask, n)
+    ss = np.sum(sc ** 2, axis=1)
+    oo = np.sum(oc ** 2, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cc = np.sum(sc * oc, axis=1) / np.sqrt(ss * oo)
+        alpha = np.sqrt(ss / oo)
+        beta = np.sum(s, axis=1) / np.sum(o, axis=1)
+    kge = 1 - np.sqrt((cc - 1) ** 2 + (alpha - 1) ** 2 + (beta - 1) ** 2)
+    return kge, cc, alpha, beta
+
+
+def _tied_pairs(sorted_x):
+    # number of tied pairs per row of row-wise sorted values
+    n_rows, m = sorted_x.shape
+    pos = np.arange(m)
+    new = np.ones((n_rows, m), dtype=bool)
+    new[:, 1:] = sorted_x[:, 1:] != sorted_x[:, :-1]
+    start = np.maximum.accumulate(np.where(new, pos, 0), axis=1)
+    return (pos - start).sum(axis=1)
+
+
+def _dense_ranks(x):
+    # ranks 0, 1, ... per row, equal values get the same rank
+    order = np.argsort(x, axis=1, kind='stable')
+    sorted_x = np.take_along_axis(x, order, axis=1)
+    new = np.ones(x.shape, dtype=bool)
+    new[:, 1:] = sorted_x[:, 1:] != sorted_x[:, :-1]
+    ranks = np.empty(x.shape, dtype=np.int64)
+    np.put_along_axis(ranks, order, np.cumsum(new, axis=1) - 1, axis=1)
+    return ranks, sorted_x
+
+
+def _average_ranks(x):
+    # ranks 1..m per row, ties get the average of their ranks (like
+    # scipy.stats.rankdata)
+    n_rows, m = x.shape
+    order = np.argsort(x, axis=1, kind='stable')
+    sorted_x = np.take_along_axis(x, order, axis=1)
+    pos = np.arange(m)
+    new = np.ones(x.shape, dtype=bool)
+    new[:, 1:] = sorted_x[:, 1:] != sorted_x[:, :-1]
+    last = np.ones(x.shape, dtype=bool)
+    last[:, :-1] = new[:, 1:]
+    start = np.maximum.accumulate(np.where(new, pos, 0), axis=1)
+    end = np.minimum.accumulate(np.where(last, pos, m - 1)[:, ::-1], axis=1)[:, ::-1]
+    ranks = np.empty(x.shape)
+    np.put_along_axis(ranks, order, (start + end) / 2.0 + 1, axis=1)
+    return ranks
+
+
+def _count_inversions(ranks):
+    """
+    number of pairs i < j with ranks[i] > ranks[j] per row of integer ranks
+    0..m-1. Radix sort by the bits of the ranks from the highest: the pairs
+    that are first separated by bit b are inversions if the one comes
+    before the zero, O(n log n) per row and vectorized over the rows.
+    """
+    n_rows, m = ranks.shape
+    x = ranks.astype(np.int16 if m < 2 ** 15 else np.int64)
+    inversions = np.zeros(n_rows, dtype=np.int64)
+    if m <= 384:
+        # for short series comparing every column with the ones before is
+        # faster than the sorting passes
+        xt = np.ascontiguousarray(x.T)
+        for j in range(1, m):
+            inversions += np.count_nonzero(xt[:j] > xt[j], axis=0)
+        return inversions
+
+    start = np.ones(x.shape, dtype=np.int32)
+    levels = max(1, int(m).bit_length())
+    for b in reversed(range(levels)):
+        # x is sorted stably by its bits above b within each row, the groups
+        # of equal higher bits are contiguous
+        prefix = x >> (b + 1)
+        start[:, 1:] = prefix[:, 1:] != prefix[:, :-1]
+        key = x >> b
+        bit = (key & 1).astype(np.int32)
+        # ones before each element within its group
+        ones_before = np.cumsum(bit, axis=1, dtype=np.int32)
+        ones_before -= bit
+        ones_before -= np.maximum.accumulate(start * ones_before, axis=1)
+        inversions += np.einsum('ij,ij->i', 1 - bit, ones_before)
+        x = np.take_along_axis(x, np.argsort(key, axis=1, kind='stable'), axis=1)
+    return inversions
+
+
+def _nan_pattern_groups(s, o):
+    """
+    groups of rows with the same valid pairs, o is (n_time,)
+    output:
+        list of (rows, columns) index arrays
+    """
+    valid_o = ~np.isnan(o)
+    nan_s = np.isnan(s)
+    if not nan_s.any():
+        return [(np.arange(s.shape[0]), np.flatnonzero(valid_o))]
+    valid = ~nan_s & valid_o
+    packed = np.ascontiguousarray(np.packbits(valid, axis=1))
+    keys = packed.view(np.dtype((np.void, packed.shape[1]))).ravel()
+    inverse = np.unique(keys, return_inverse=True)[1]
+    order = np.argsort(inverse, kind='stable')
+    bounds = np.cumsum(np.bincount(inverse))[:-1]
+    return [(rows, np.flatnonzero(valid[rows[0]])) for rows in np.split(order, bounds)]
+
+
+def kendalltau_batch(s, o):
+    """
+    Kendall's tau-b of many simulations against one observed series, like
+    kendalltau_nan for each row.
+    The observations are sorted once per nan pattern, the discordant pairs
+    are counted as inversions of the simulated ranks in that order, ties
+    are corrected as in scipy.stats.kendalltau.
+    input:
+        s: simulated, (n_runs, n_time)
+        o: observed, (n_time,)
+    output:
+        tau: array of length n_runs
+    """
+    s = np.atleast_2d(np.asarray(s, dtype=np.float64))
+    o = np.asarray(o, dtype=np.float64)
+    tau = np.full(s.shape[0], np.nan)
+    for rows, cols in _nan_pattern_groups(s, o):
+        m = cols.size
+        if m < 2:
+            continue
+        oo = o[cols]
+        o_order = np.argsort(oo, kind='stable')
+        o_sorted = oo[o_order]
+        o_ranks, _ = _dense_ranks(o_sorted[None, :])
+        s_ranks, s_sorted = _dense_ranks(s[np.ix_(rows, cols[o_order])])
+        o_ties = _tied_pairs(o_sorted[None, :])
+        both_ties = 0
+        if o_ties.any():
+            # within tied observations order by the simulation, so that only
+            # pairs with different observations can be discordant
+            order = np.argsort(o_ranks * m + s_ranks, axis=1, kind='stable')
+            s_ranks = np.take_along_axis(s_ranks, order, axis=1)
+            # the (observation, simulation) keys are sorted now
+            both_ties = _tied_pairs(o_ranks * m + s_ranks)
+        s_ties = _tied_pairs(s_sorted)
+        discordant = _count_inversions(s_ranks)
+
+        total = m * (m - 1) // 2
+        concordant_minus_discordant = total - o_ties - s_ties + both_ties - 2 * discordant
+        with np.errstate(divide='ignore', invalid='ignore'):
+            tau[rows] = concordant_minus_discordant / np.sqrt(
+                (total - o_ties).astype(np.float64) * (total - s_ties))
+    return np.clip(tau, -1, 1)
+
+
+def spearman_batch(s, o):
+    """
+    Spearman's rank correlation of many simulations against one observed
+    series, pairs with nan are dropped per row, ties get average ranks
+    input:
+        s: simulated, (n_runs, n_time)
+        o: observed, (n_time,)
+    output:
+        rho: array of length n_runs
+    """
+    s = np.atleast_2d(np.asarray(s, dtype=np.float64))
+    o = np.asarray(o, dtype=np.float64)
+    rho = np.full(s.shape[0], np.nan)
+    for rows, cols in _nan_pattern_groups(s, o):
+        if cols.size < 2:
+            continue
+        o_ranks = _average_ranks(o[None, cols])
+        s_ranks = _average_ranks(s[np.ix_(rows, cols)])
+        sc = s_ranks - s_ranks.mean(axis=1, keepdims=True)
+        oc = o_ranks - o_ranks.mean()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rho[rows] = np.sum(sc * oc, axis=1) / np.sqrt(
+                np.sum(sc ** 2, axis=1) * np.sum(oc ** 2))
+    return rho
@@ -1,17 +1,26 @@
 import os
+import re
+import hashlib
+import numpy as np
 import pandas as pd
 
+from profiling import profiled
 
-def read_data(fname):
+# binary copies of the parsed text files are stored in this folder next to
+# the source file, unless EXERCISE03_CACHE_DIR points to a central location
+CACHE_DIRNAME = '__cache__'
+CACHE_ENV = 'EXERCISE03_CACHE_DIR'
+
+
+def _parse_data(fname):
     """
-    Simple reader for all .csv
+    Parse a space delimited text file with pandas
     :param fname: string
         name of file to read
     :return: pandas.Dataframe
         data in file
     """
-    
-    df = pd.read_csv(fname, ' ')
+    df = pd.read_csv(fname, sep=' ')
     try:
         df.index = pd.to_datetime(df.iloc[:, 0])
     except ValueError:
@@ -20,6 +29,205 @@ def read_data(fname):
     return df
 
 
+# all keys of a LPJmL/satellite text file joined by blanks, e.g. "1982-1 1982-2"
+_YEAR_MONTH = re.compile(r'^(\d{4}-\d{1,2} )*\d{4}-\d{1,2}$')
+
+
+def _parse_lpjml(fname):
+    """
+    Fast parser for the known layout of the LPJmL and satellite files:
+    quoted header, quoted "YYYY-M" key, numeric columns and NA as missing.
+    The monthly DatetimeIndex is computed from the year and month numbers.
+    :param fname: string
+        name of file to read
+    :return: pandas.Dataframe or None
+        data in file, None if the file does not have the expected layout
+    """
+    with open(fname) as f:
+        header = f.readline()
+        body = f.read()
+
+    names = re.findall(r'"([^"]*)"', header)
+    if len(names) < 2:
+        return None
+    tokens = body.replace('"', '').split()
+    ncols = len(names)
+    if not tokens or len(tokens) % ncols:
+        return None
+    table = np.array(tokens, dtype=object).reshape(-1, ncols)
+
+    # dates from year and month
+    keys = ' '.join(table[:, 0])
+    if not _YEAR_MONTH.match(keys):
+        return None
+    year_month = np.array(keys.replace('-', ' ').split(), dtype=np.int64)
+    years = year_month[0::2]
+    months = year_month[1::2]
+    if months.min() < 1 or months.max() > 12:
+        return None
+    dates = ((years - 1970) * 12 + months - 1).astype('datetime64[M]')
+    index = pd.DatetimeIndex(dates.astype('datetime64[ns]'), name=names[0])
+
+    # values, pandas.to_numeric converts like pandas.read_csv (same float
+    # rounding, int64 for integer columns without missing values)
+    table[table == 'NA'] = np.nan
+    data = {}
+    for i in range(1, ncols):
+        try:
+            data[i - 1] = pd.to_numeric(table[:, i])
+        except ValueError:
+            return None
+    df = pd.DataFrame(data, index=index)
+    df.columns = pd.Index(names[1:], dtype=object)
+    return df
+
+
+def _cache_path(fname, suffix='.npz'):
+    """
+    Location of the binary cache (.npz) for a text file
+    :param fname: string
+        name of the source file
+    :param suffix: string
+        appended to the file name, other converted forms of the file use
+        their own suffix
+    :return: string
+        name of the cache file
+    """
+    cache_dir = os.environ.get(CACHE_ENV)
+    if cache_dir:
+        # central cache dir: make names unique per source path
+        key = hashlib.sha1(os.path.abspath(fname).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(cache_dir, '{}_{}{}'.format(os.path.basename(fname), key, suffix))
+    return os.path.join(os.path.dirname(os.path.abspath(fname)), CACHE_DIRNAME,
+                        os.path.basename(fname) + suffix)
+
+
+def _source_stamp(fname):
+    st = os.stat(fname)
+    return np.array([st.st_mtime_ns, st.st_size], dtype=np.int64)
+
+
+def _load_cache(fname, cache_fname):
+    """
+    Load a cached DataFrame, returns None if the cache is missing or stale
+    """
+    if not os.path.exists(cache_fname):
+        return None
+    try:
+        with np.load(cache_fname, allow_pickle=False) as npz:
+            if not np.array_equal(npz['stamp'], _source_stamp(fname)):
+                return None
+            meta = npz['meta']
+            index_values = npz['index']
+            floats = npz['floats']
+            ints = npz['ints']
+    except (OSError, KeyError, ValueError):
+        return None
+
+    # meta: index kind, index name (if any), then one dtype code per column
+    # followed by the column names
+    index_kind, has_name, index_name = meta[:3]
+    index_name = str(index_name) if has_name == '1' else None
+    ncols = (len(meta) - 3) // 2
+    kinds = meta[3:3 + ncols]
+    columns = pd.Index([str(c) for c in meta[3 + ncols:]], dtype=object)
+
+    if index_kind == 'datetime':
+        index = pd.DatetimeIndex(index_values, name=index_name)
+    else:
+        index = pd.Index(index_values.astype(object), name=index_name)
+
+    if (kinds == 'f').all():
+        df = pd.DataFrame(floats, index=index, columns=columns)
+    else:
+        data = {}
+        fi = ii = 0
+        for i, kind in enumerate(kinds):
+            if kind == 'f':
+                data[i] = floats[:, fi]
+                fi += 1
+            else:
+                data[i] = ints[:, ii]
+                ii += 1
+        df = pd.DataFrame(data, index=index)
+        df.columns = columns
+    return df
+
+
+def _write_cache(fname, cache_fname, df):
+    """
+    Store a parsed DataFrame as .npz, only float64/int64 columns and datetime
+    or string indices are supported. Failing to write the cache is not an
+    error, the file is simply parsed again next time.
+    """
+    kinds = []
+    for dtype in df.dtypes:
+        if dtype == np.float64:
+            kinds.append('f')
+        elif dtype == np.int64:
+            kinds.append('i')
+        else:
+            return
+    if isinstance(df.index, pd.DatetimeIndex):
+        index_kind = 'datetime'
+        index = df.index.values
+    elif all(isinstance(i, str) for i in df.index):
+        index_kind = 'str'
+        index = np.array(df.index, dtype=str)
+    else:
+        return
+    kinds = np.array(kinds)
+    has_name = df.index.name is not None
+    meta = [index_kind, '1' if has_name else '0', df.index.name if has_name else '']
+    meta += list(kinds) + [str(c) for c in df.columns]
+
+    arrays = {'meta': np.array(meta, dtype=str),
+              'stamp': _source_stamp(fname),
+              'index': index,
+              'floats': df.iloc[:, np.flatnonzero(kinds == 'f')].values.astype(np.float64),
+              'ints': df.iloc[:, np.flatnonzero(kinds == 'i')].values.astype(np.int64)}
+
+    tmp_fname = '{}.{}.tmp'.format(cache_fname, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(cache_fname), exist_ok=True)
+        with open(tmp_fname, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_fname, cache_fname)
+    except OSError:
+        if os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
+
+
+@profiled('read_data')
+def read_data(fname, cache=True):
+    """
+    Simple reader for all .csv
+
+    Files in the LPJmL layout are read with a dedicated parser, everything
+    else with pandas. The parsed data is cached in binary form (see
+    _cache_path), the cache is rebuilt whenever modification time or size of
+    the source file change.
+    :param fname: string
+        name of file to read
+    :param cache: bool
+        use and update the binary cache
+    :return: pandas.Dataframe
+        data in file
+    """
+    if cache:
+        cache_fname = _cache_path(fname)
+        df = _load_cache(fname, cache_fname)
+        if df is not None:
+            return df
+
+    df = _parse_lpjml(fname)
+    if df is None:
+        df = _parse_data(fname)
+    if cache:
+        _write_cache(fname, cache_fname, df)
+    return df
+
+
 if __name__ == '__main__':
     # get the path where this script is located
     inpath = os.path.dirname(os.path.realpath(__file__))
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+The metric table of taskB (FAPAR, GPP-SIF and SSM) for all LPJmL cells of a
+data folder with bounded memory.
+
+The cells are evaluated in chunks. The model output of a chunk is read (on a
+pool of worker processes), the matching satellite columns come from the
+converted products (satellite.open_columns), and the metrics of all cells of
+the chunk are computed at once on (cell, month) arrays. The rows of every
+finished chunk are appended to the output csv, an interrupted run continues
+with the cells that are not in the file yet.
+
+    GLOBAL_MEMORY_MB=2048 GLOBAL_WORKERS=8 python global_eval.py
+
+writes results/taskB/global_metrics.csv (one row per cell and product).
+GLOBAL_RESTART=1 discards an existing file. With CLIMERS_RESULTS_DB set the
+rows are also written to the results database (see results_store.py).
+
+The memory ceiling bounds the arrays of one chunk, not the interpreter and
+libraries. Cells missing in a satellite product get nan metrics, cells
+whose model output cannot be read are reported and retried by the next run.
+"""
+import os
+import sys
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from lpjml import LPJmLCell
+from satellite import PRODUCTS, open_columns
+from alignment import monthly, month_offsets, window
+from metric_kernels import taskb_metrics
+from driver import discover_cells
+from profiling import stage
+from results_store import open_store, store_from_env
+
+# name in the metric table, model variable, satellite product and whether
+# both series are min-max normalized (as in taskB.evaluate_model)
+PAIRS = [('FAPAR', 'mfapar', 'fapar', False),
+         ('GPP-SIF', 'mgpp', 'sif', True),
+         ('SSM', 'mswc1', 'ssm', True)]
+METRICS = ['NRMSE', 'NAE', 'VR', 'IoA', 'Corr']
+COLUMNS = ['cell', 'product'] + METRICS
+# float arrays of the length of a satellite product per cell and pair while
+# a chunk is evaluated (model, satellite and the metric temporaries)
+ARRAYS_PER_CELL = 16
+
+
+def _read_model(lpjmlpath, cell):
+    # runs in the worker, first month and values of the model variables
+    try:
+        lpjml_cell = LPJmLCell(lpjmlpath, cell)
+        return [monthly(lpjml_cell[var]) for _, var, _, _ in PAIRS]
+    except Exception as e:
+        return '{}: {}'.format(type(e).__name__, e)
+
+
+class _Product(object):
+    """
+    satellite product on its grid of months
+    """
+
+    def __init__(self, fname):
+        self.columns = open_columns(fname)
+        offsets = month_offsets(self.columns.dates)
+        self.first = offsets[0] if len(offsets) else 0
+        self.n_months = offsets[-1] - self.first + 1 if len(offsets) else 0
+        # positions of the stored months on the grid, None if there are no gaps
+        self.positions = None if len(offsets) == self.n_months else offsets - self.first
+
+    def values(self, cells):
+        """
+        (cell, month) array on the grid, nan for cells missing in the product
+        """
+        values = np.full((len(cells), self.n_months), np.nan)
+        rows = [i for i, cell in enumerate(cells) if cell in self.columns]
+        if rows:
+            stored = self.columns.values([cells[i] for i in rows])
+            if self.positions is None:
+                values[rows] = stored
+            else:
+                values[np.ix_(rows, self.positions)] = stored
+        return values
+
+
+def _normalize_rows(values):
+    # taskB.normalize_values along the months
+    low = np.nanmin(values, axis=1, keepdims=True)
+    return (values - low) / (np.nanmax(values, axis=1, keepdims=True) - low)
+
+
+def evaluate_chunk(cells, models, products):
+    """
+    Metric table of a chunk of cells
+    :param cells: list
+        cell numbers
+    :param models: list
+        per cell the (first month, values) of the model variables of PAIRS
+    :param products: dict
+        satellite product -> _Product
+    :return: pd.DataFrame
+        COLUMNS, one row per cell and pair
+    """
+    tables = []
+    for j, (name, var, product, normalize) in enumerate(PAIRS):
+        sat = products[product]
+        o = sat.values(cells)
+        # model on the grid of the product; like the clipping of taskB both
+        # series are nan outside of the months covered by both
+        s = np.empty_like(o)
+        for i, model in enumerate(models):
+            first, values = model[j]
+            s[i] = window(values, first, sat.first, sat.n_months)
+            o[i, :max(first - sat.first, 0)] = np.nan
+            o[i, max(first + len(values) - sat.first, 0):] = np.nan
+
+        with warnings.catch_warnings():
+            # cells without data in a product
+            warnings.simplefilter('ignore', RuntimeWarning)
+            if normalize:
+                s = _normalize_rows(s)
+                o = _normalize_rows(o)
+            metrics = taskb_metrics(s, o)
+        table = pd.DataFrame({metric: np.round(metrics[metric], 4) for metric in METRICS})
+        table.insert(0, 'product', name)
+        table.insert(0, 'cell', cells)
+        tables.append(table)
+    # rows of a cell next to each other
+    table = pd.concat(tables, keys=range(len(PAIRS)), names=['pair', 'row'])
+    return table.sort_index(level=['row', 'pair']).reset_index(drop=True)[COLUMNS]
+
+
+def completed_cells(fname):
+    """
+    Cells with all rows in an output file of an earlier run. A row cut off
+    by an interruption and incomplete cells are removed from the file.
+    """
+    if not os.path.exists(fname):
+        return set()
+    with open(fname, 'rb+') as f:
+        data = f.read()
+        end = data.rfind(b'\n') + 1
+        if end < len(data):
+            f.truncate(end)
+    if end == 0:
+        os.remove(fname)
+        return set()
+    table = pd.read_csv(fname, usecols=['cell', 'product'], dtype={'cell': str})
+    counts = table.groupby('cell', sort=False).size()
+    incomplete = counts.index[counts != len(PAIRS)]
+    if len(incomplete):
+        table = pd.read_csv(fname, dtype={'cell': str})
+        table[~table['cell'].isin(incomplete)].to_csv(fname, index=False)
+    return set(counts.index[counts == len(PAIRS)])
+
+
+def chunk_size(products, memory_mb):
+    """
+    number of cells whose arrays fit into memory_mb
+    """
+    bytes_per_cell = 8 * ARRAYS_PER_CELL * sum(product.n_months for product in products.values())
+    return max(1, int(memory_mb * 2 ** 20 // bytes_per_cell))
+
+
+def evaluate_global(datapath, out_fname, cells=None, memory_mb=1024, n_workers=None,
+                    restart=False, results_db=None):
+    """
+    Evaluate all cells chunk by chunk and append the metrics to out_fname
+    :param datapath: string
+        folder with LPJmL and Satellite
+    :param out_fname: string
+        csv file with the columns COLUMNS, continued if it exists
+    :param cells: list
+        cells to evaluate, default all cells in datapath/LPJmL
+    :param memory_mb: float
+        memory ceiling for the arrays of a chunk
+    :param n_workers: int
+        processes reading the model output, default number of CPUs, 1 reads
+        in this process
+    :param restart: bool
+        discard the results of an earlier run
+    :param results_db: string
+        results database the rows of every chunk are also written to
+    :return: pd.DataFrame
+        number of cells per status ('done', 'skipped', 'failed') and the
+        errors of the failed cells
+    """
+    lpjmlpath = os.path.join(datapath, 'LPJmL')
+    satpath = os.path.join(datapath, 'Satellite')
+    if cells is None:
+        cells = discover_cells(lpjmlpath)
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    if restart and os.path.exists(out_fname):
+        os.remove(out_fname)
+
+    done = completed_cells(out_fname)
+    todo = [cell for cell in cells if cell not in done]
+    products = {product: _Product(os.path.join(satpath, PRODUCTS[product]))
+                for _, _, product, _ in PAIRS}
+    size = chunk_size(products, memory_mb)
+
+    failed = {}
+    executor = ProcessPoolExecutor(max_workers=n_workers) if n_workers > 1 else None
+    try:
+        for start in range(0, len(todo), size):
+            chunk = todo[start:start + size]
+            with stage('read_model', cells=len(chunk)):
+                if executor is None:
+                    models = [_read_model(lpjmlpath, cell) for cell in chunk]
+                else:
+                    models = list(executor.map(_read_model, [lpjmlpath] * len(chunk), chunk,
+                                               chunksize=max(1, len(chunk) // (4 * n_workers))))
+            for cell, model in zip(chunk, models):
+                if isinstance(model, str):
+                    failed[cell] = model
+            chunk_cells = [cell for cell, model in zip(chunk, models) if not isinstance(model, str)]
+            models = [model for model in models if not isinstance(model, str)]
+            if not chunk_cells:
+                continue
+
+            with stage('metrics', cells=len(chunk_cells)):
+                table = evaluate_chunk(chunk_cells, models, products)
+            # one write per chunk, flushed before the next chunk starts
+            header = not os.path.exists(out_fname)
+            with open(out_fname, 'a') as f:
+                f.write(table.to_csv(header=header, index=False))
+                f.flush()
+                os.fsync(f.fileno())
+            if results_db is not None:
+                with stage('store', cells=len(chunk_cells)):
+                    open_store(results_db).put_frame(
+                        'taskB', table.set_index(['cell', 'product']), index=('cell', 'variable'))
+            print('{} of {} cells'.format(start + len(chunk), len(todo)))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    rows = [{'status': 'done', 'cells': len(todo) - len(failed), 'error': ''},
+            {'status': 'skipped', 'cells': len(cells) - len(todo), 'error': ''}]
+    rows += [{'status': 'failed', 'cells': 1, 'error': '{}: {}'.format(cell, error)}
+             for cell, error in failed.items()]
+    return pd.DataFrame(rows, columns=['status', 'cells', 'error'])
+
+
+if __name__ == '__main__':
+    rootpath = os.path.dirname(os.path.realpath(__file__))
+    outpath = os.path.join(rootpath, 'results', 'taskB')
+    datapath = os.path.join(rootpath, 'data')
+    try:
+        os.makedirs(outpath)
+    except:
+        pass
+
+    # cells given on the command line, all cells in data/LPJmL otherwise
+    cells = sys.argv[1:] or None
+    memory_mb = float(os.environ.get('GLOBAL_MEMORY_MB', 1024))
+    n_workers = int(os.environ.get('GLOBAL_WORKERS', 0)) or None
+    restart = bool(os.environ.get('GLOBAL_RESTART'))
+    results_db = store_from_env(os.path.join(rootpath, 'results', 'results.sqlite'))
+    summary = evaluate_global(datapath, os.path.join(outpath, 'global_metrics.csv'), cells,
+                              memory_mb, n_workers, restart, results_db)
+    print(summary)
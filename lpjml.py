@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Lazy access to the LPJmL output of one grid cell (or one parameter set of a
+cell), shared by the analyses of taskA, taskB and taskC.
+"""
+import os
+import pandas as pd
+
+from exercise03 import read_data
+
+
+class LPJmLCell(object):
+    """
+    Output files of one LPJmL cell, every variable is read on first access
+    and kept for later use.
+
+    cell = LPJmLCell(lpjmlpath, '6037')
+    cell['mgpp']                      # data/LPJmL/cell_6037/6037_mgpp.txt
+    LPJmLCell(lpjmlpath, '32785', 'pars1')['mgpp']
+                                      # cell_32785/pars1/32785_pars1_mgpp.txt
+
+    The returned frames are shared between all users of the instance and
+    must not be modified in place.
+    """
+
+    def __init__(self, lpjmlpath, cell, pars=None):
+        self.lpjmlpath = lpjmlpath
+        self.cell = cell
+        self.pars = pars
+        self._data = {}
+
+    @property
+    def cellpath(self):
+        return os.path.join(self.lpjmlpath, 'cell_{}'.format(self.cell))
+
+    def path(self, var):
+        """
+        file name of a variable
+        """
+        if self.pars is None:
+            return os.path.join(self.cellpath, '{}_{}.txt'.format(self.cell, var))
+        return os.path.join(self.cellpath, self.pars,
+                            '{}_{}_{}.txt'.format(self.cell, self.pars, var))
+
+    def files(self):
+        """
+        all output files of the cell (or parameter set)
+        """
+        path = self.cellpath if self.pars is None else os.path.join(self.cellpath, self.pars)
+        prefix = '{}_'.format(self.cell) if self.pars is None else '{}_{}_'.format(self.cell, self.pars)
+        return sorted(os.path.join(path, f) for f in os.listdir(path)
+                      if f.startswith(prefix) and f.endswith('.txt'))
+
+    def __getitem__(self, var):
+        if var not in self._data:
+            self._data[var] = read_data(self.path(var))
+        return self._data[var]
+
+    def __contains__(self, var):
+        return var in self._data
+
+    def combined(self, variables):
+        """
+        several variables joined into one frame on the union of their dates
+        """
+        return pd.concat([self[var] for var in variables], axis=1, sort=True)
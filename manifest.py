@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Records which inputs and which code produced an output, so reruns only
+recompute what changed.
+
+A manifest is a json file next to the outputs. For every unit (a cell, a
+parameter set, a summary table) it stores the content hashes of the input
+files and of the code, and the written files. A unit is up to date if all
+of them are unchanged and the outputs still exist.
+
+    manifest = Manifest(os.path.join(outpath, 'manifest.json'))
+    code = manifest.code_hash([taskB, exercise03])
+    inputs = manifest.input_hashes(files)
+    if not manifest.is_current(cell, inputs, code):
+        outputs = evaluate_model(...)
+        manifest.update(cell, inputs, code, outputs)
+    manifest.save()
+
+File hashes are kept with modification time and size of the file and only
+recomputed when one of them changed. Set CLIMERS_FORCE=1 to recompute all
+units.
+"""
+import os
+import json
+import inspect
+import hashlib
+
+FORCE_ENV = 'CLIMERS_FORCE'
+
+
+def _sha1(fname):
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def combine_hashes(hashes):
+    """
+    one hash of a dict or list of hashes
+    """
+    if isinstance(hashes, dict):
+        hashes = ['{}={}'.format(k, hashes[k]) for k in sorted(hashes)]
+    return hashlib.sha1('\n'.join(hashes).encode()).hexdigest()
+
+
+class Manifest(object):
+    """
+    Inputs, code and outputs of the units written to one output folder
+    """
+
+    def __init__(self, fname, force=None):
+        """
+        :param fname: string
+            json file of the manifest, paths are stored relative to its folder
+        :param force: bool
+            treat all units as outdated, default from CLIMERS_FORCE
+        """
+        self.fname = fname
+        self.path = os.path.dirname(os.path.abspath(fname))
+        if force is None:
+            force = os.environ.get(FORCE_ENV, '0') != '0'
+        self.force = force
+        self.files = {}
+        self.units = {}
+        if os.path.exists(fname):
+            try:
+                with open(fname) as f:
+                    content = json.load(f)
+                self.files = content['files']
+                self.units = content['units']
+            except (ValueError, KeyError):
+                # broken manifest, everything is recomputed
+                pass
+
+    def _relpath(self, fname):
+        return os.path.relpath(os.path.abspath(fname), self.path)
+
+    def file_hash(self, fname):
+        """
+        content hash of a file, reused while mtime and size are unchanged
+        """
+        key = self._relpath(fname)
+        stat = os.stat(fname)
+        known = self.files.get(key)
+        if known is not None and known[0] == stat.st_mtime_ns and known[1] == stat.st_size:
+            return known[2]
+        digest = _sha1(fname)
+        self.files[key] = [stat.st_mtime_ns, stat.st_size, digest]
+        return digest
+
+    def input_hashes(self, fnames):
+        """
+        :return: dict
+            relative path -> content hash, missing files hash to None
+        """
+        return {self._relpath(f): self.file_hash(f) if os.path.exists(f) else None
+                for f in fnames}
+
+    def code_hash(self, modules, config=None):
+        """
+        hash of the source files of the modules and an optional config
+        (anything json serializable that changes the results)
+        """
+        hashes = [self.file_hash(inspect.getsourcefile(m)) for m in modules]
+        if config is not None:
+            hashes.append(json.dumps(config, sort_keys=True))
+        return combine_hashes(hashes)
+
+    def is_current(self, unit, inputs, code):
+        """
+        True if unit was produced from the same inputs and code and its
+        outputs still exist
+        """
+        if self.force:
+            return False
+        entry = self.units.get(unit)
+        if entry is None or entry['code'] != code or entry['inputs'] != inputs:
+            return False
+        return all(os.path.exists(os.path.join(self.path, f)) for f in entry['outputs'])
+
+    def outputs(self, unit):
+        """
+        absolute paths of the recorded outputs of a unit
+        """
+        return [os.path.join(self.path, f) for f in self.units[unit]['outputs']]
+
+    def update(self, unit, inputs, code, outputs):
+        """
+        record a recomputed unit, outputs are the written files
+        """
+        self.units[unit] = {'inputs': inputs, 'code': code,
+                            'outputs': [self._relpath(f) for f in outputs]}
+
+    def remove(self, unit):
+        self.units.pop(unit, None)
+
+    def save(self):
+        """
+        write the manifest (atomic replace)
+        """
+        tmp_fname = '{}.{}.tmp'.format(self.fname, os.getpid())
+        with open(tmp_fname, 'w') as f:
+            json.dump({'files': self.files, 'units': self.units}, f, indent=0, sort_keys=True)
+        os.replace(tmp_fname, self.fname)
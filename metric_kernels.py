@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+The metric panel of taskB (NRMSE, NAE, VR, IoA, Corr) and KGE for a batch
+of series, with an optional compiled backend.
+
+    panel = metric_panel(s, o)          # metric -> (rows,) array
+    metrics = taskb_metrics(s, o)       # as bootstrap.taskb_metrics_batch
+
+The numba backend runs one kernel per row: a pass over the months for the
+counts and sums of both series, a second one for the centered sums and the
+IoA denominator, no temporary arrays. The numpy backend is
+bootstrap.taskb_metrics_batch and error_metrics.KGE_batch. Both skip nan the
+same way: means and variances use all valid values of a series, the
+residual terms, Corr and KGE only the valid pairs.
+
+Rows with a constant series (over its valid values or the valid pairs)
+keep the taskB metrics of the pandas functions in taskB, which numpy
+reproduces including the rounding noise in the deviations (VR 1e30
+instead of inf, Corr 0.0 instead of nan). The numba backend flags these
+rows and takes their taskB metrics from numpy. KGE is nan for them in
+both backends, alpha if the observed series is constant.
+
+CLIMERS_METRICS_BACKEND selects the backend: auto (default, numba if it is
+installed), numba or numpy. numba is imported and the kernel compiled on
+the first call (cached in __pycache__ for later runs).
+"""
+import os
+
+import numpy as np
+
+from bootstrap import taskb_metrics_batch
+from error_metrics import KGE_batch
+
+BACKEND_ENV = 'CLIMERS_METRICS_BACKEND'
+BACKENDS = ['auto', 'numba', 'numpy']
+
+PANEL = ['NRMSE', 'NAE', 'VR', 'IoA', 'Corr', 'KGE', 'alpha', 'beta']
+TASKB_METRICS = ['NRMSE', 'NAE', 'VR', 'IoA', 'Corr']
+
+
+def panel_rows(s, o, out):
+    """
+    Kernel of the numba backend, writes the PANEL metrics of every row of
+    s and o into the columns of out and 1 into its last column if one of
+    the series is constant (0 otherwise). Runs as plain Python without
+    numba (slow, for checking the kernel), the float64 scalars divide like
+    numpy.
+    """
+    nan = np.float64(np.nan)
+    inf = np.float64(np.inf)
+    for r in range(s.shape[0]):
+        n_s = np.float64(0.0)
+        n_o = np.float64(0.0)
+        n = np.float64(0.0)
+        sum_s = np.float64(0.0)
+        sum_o = np.float64(0.0)
+        pair_s = np.float64(0.0)
+        pair_o = np.float64(0.0)
+        sq = np.float64(0.0)
+        # ranges, the deviations of a constant series are exactly 0
+        lo_s, hi_s, lo_o, hi_o = inf, -inf, inf, -inf
+        plo_s, phi_s, plo_o, phi_o = inf, -inf, inf, -inf
+        for t in range(s.shape[1]):
+            x = s[r, t]
+            y = o[r, t]
+            if x == x:
+                n_s += 1.0
+                sum_s += x
+                lo_s, hi_s = min(lo_s, x), max(hi_s, x)
+            if y == y:
+                n_o += 1.0
+                sum_o += y
+                lo_o, hi_o = min(lo_o, y), max(hi_o, y)
+            if x == x and y == y:
+                n += 1.0
+                pair_s += x
+                pair_o += y
+                sq += (x - y) * (x - y)
+                plo_s, phi_s = min(plo_s, x), max(phi_s, x)
+                plo_o, phi_o = min(plo_o, y), max(phi_o, y)
+        mean_s = lo_s if lo_s == hi_s else sum_s / n_s
+        mean_o = lo_o if lo_o == hi_o else sum_o / n_o
+        pmean_s = plo_s if plo_s == phi_s else pair_s / n
+        pmean_o = plo_o if plo_o == phi_o else pair_o / n
+
+        var_s = np.float64(0.0)
+        var_o = np.float64(0.0)
+        ss = np.float64(0.0)
+        oo = np.float64(0.0)
+        so = np.float64(0.0)
+        denom = np.float64(0.0)
+        for t in range(s.shape[1]):
+            x = s[r, t]
+            y = o[r, t]
+            if x == x:
+                var_s += (x - mean_s) * (x - mean_s)
+            if y == y:
+                var_o += (y - mean_o) * (y - mean_o)
+            if x == x and y == y:
+                ss += (x - pmean_s) * (x - pmean_s)
+                oo += (y - pmean_o) * (y - pmean_o)
+                so += (x - pmean_s) * (y - pmean_o)
+                d = abs(x - mean_o) + abs(y - mean_o)
+                denom += d * d
+        # like np.nanvar, nan without degrees of freedom
+        var_s = var_s / (n_s - 1.0) if n_s > 1.0 else nan
+        var_o = var_o / (n_o - 1.0) if n_o > 1.0 else nan
+
+        # zero variance: corr is 0 / 0, alpha nan instead of inf
+        corr = so / np.sqrt(ss * oo)
+        alpha = np.sqrt(ss / oo) if oo > 0.0 else nan
+        beta = pair_s / pair_o
+        out[r, 0] = np.sqrt(sq / n) / mean_o
+        out[r, 1] = (mean_s - mean_o) / mean_o
+        out[r, 2] = var_s / var_o
+        out[r, 3] = 1.0 - sq / denom
+        out[r, 4] = corr
+        out[r, 5] = 1.0 - np.sqrt((corr - 1.0) ** 2 + (alpha - 1.0) ** 2 + (beta - 1.0) ** 2)
+        out[r, 6] = alpha
+        out[r, 7] = beta
+        constant = lo_s == hi_s or lo_o == hi_o or plo_s == phi_s or plo_o == phi_o
+        out[r, 8] = 1.0 if constant else 0.0
+
+
+_kernel = None
+
+
+def _numba_kernel():
+    # compiled panel_rows, None if numba is not installed
+    global _kernel
+    if _kernel is None:
+        try:
+            import numba
+        except ImportError:
+            _kernel = False
+        else:
+            _kernel = numba.njit(cache=True, nogil=True, error_model='numpy')(panel_rows)
+    return _kernel or None
+
+
+def backend(name=None):
+    """
+    The backend to use
+    :param name: string
+        auto, numba or numpy, default from CLIMERS_METRICS_BACKEND
+    :return: string
+        numba or numpy
+    """
+    name = name or os.environ.get(BACKEND_ENV) or 'auto'
+    if name not in BACKENDS:
+        raise ValueError('unknown metrics backend {}, use one of {}'.format(name, BACKENDS))
+    if name == 'numpy':
+        return 'numpy'
+    if _numba_kernel() is not None:
+        return 'numba'
+    if name == 'numba':
+        raise ImportError('numba is not installed, set {}=numpy or auto'.format(BACKEND_ENV))
+    return 'numpy'
+
+
+def _constant(x, mask):
+    # rows of x with a single distinct value in mask
+    return np.where(mask, x, -np.inf).max(axis=1) == np.where(mask, x, np.inf).min(axis=1)
+
+
+def _numpy_panel(s, o):
+    panel = taskb_metrics_batch(s, o)
+    panel['KGE'], _, panel['alpha'], panel['beta'] = KGE_batch(s, o)
+    # nan like the kernel for constant series, see the module docstring
+    pairs = ~(np.isnan(s) | np.isnan(o))
+    flat_o = _constant(o, pairs)
+    panel['KGE'][_constant(s, pairs) | flat_o] = np.nan
+    panel['alpha'][flat_o] = np.nan
+    return panel
+
+
+def metric_panel(s, o, backend_name=None):
+    """
+    PANEL metrics of a batch of series with nan
+    :param s: np.array
+        simulated, (rows, n_time) or (n_time,)
+    :param o: np.array
+        observed, (n_time,) or same shape as s
+    :param backend_name: string
+        auto, numba or numpy, see backend
+    :return: dict
+        metric name -> (rows,) array
+    """
+    s = np.atleast_2d(np.asarray(s, dtype=np.float64))
+    o = np.broadcast_to(np.asarray(o, dtype=np.float64), s.shape)
+    if backend(backend_name) == 'numpy':
+        return _numpy_panel(s, o)
+    return _kernel_panel(_numba_kernel(), s, o)
+
+
+def _kernel_panel(kernel, s, o):
+    # PANEL metrics from kernel (compiled or plain panel_rows)
+    out = np.empty((s.shape[0], len(PANEL) + 1))
+    kernel(s, o, out)
+    constant = out[:, -1] > 0
+    if constant.any():
+        # the taskB metrics of constant series as in numpy, see the module
+        # docstring
+        rows = taskb_metrics_batch(s[constant], o[constant])
+        for i, name in enumerate(TASKB_METRICS):
+            out[constant, i] = rows[name]
+    return {name: out[:, i] for i, name in enumerate(PANEL)}
+
+
+def taskb_metrics(s, o, backend_name=None):
+    """
+    NRMSE, NAE, VR, IoA and Corr of taskB (not rounded), see metric_panel
+    and bootstrap.taskb_metrics_batch
+    """
+    if backend(backend_name) == 'numpy':
+        return taskb_metrics_batch(s, o)
+    panel = metric_panel(s, o, 'numba')
+    return {name: panel[name] for name in TASKB_METRICS}
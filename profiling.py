@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in timing of named stages (read_data, alignment, metrics, savefig, ...).
+
+Set CLIMERS_PROFILE=1 (or to the name of a json file) before running a task
+to record wall time, number of calls and peak memory per stage and per
+cell/parameter set. A table is printed at exit and the details are written
+to the json file (default profile_report.json). Without the variable the
+stages cost one flag check.
+
+Peak memory is measured with tracemalloc, which slows down allocation heavy
+code like plotting considerably. Set CLIMERS_PROFILE_MEMORY=0 to time
+without it.
+
+    with stage('align', cell=cell):
+        ...
+
+    @profiled('calc_metrics')
+    def calc_metrics(df):
+        ...
+
+Stages running in worker processes are sent back with the results (see
+take and merge) and end up in the report of the main process.
+"""
+import os
+import sys
+import json
+import time
+import atexit
+import functools
+import tracemalloc
+
+PROFILE_ENV = 'CLIMERS_PROFILE'
+MEMORY_ENV = 'CLIMERS_PROFILE_MEMORY'
+
+_enabled = False
+_memory = False
+_report_fname = None
+# (name, tags) -> [calls, seconds, peak bytes]
+_records = {}
+# running memory peaks of the open stages
+_peaks = []
+
+
+class _NoStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_STAGE = _NoStage()
+
+
+class _Stage(object):
+
+    def __init__(self, name, tags):
+        self.key = (name, tuple(sorted(tags.items())))
+
+    def __enter__(self):
+        self.memory = 0
+        if _memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if _peaks:
+                _peaks[-1] = max(_peaks[-1], peak)
+            tracemalloc.reset_peak()
+            _peaks.append(0)
+            self.memory = current
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        peak = 0
+        if _memory:
+            current, peak = tracemalloc.get_traced_memory()
+            peak = max(_peaks.pop(), peak)
+            tracemalloc.reset_peak()
+            if _peaks:
+                _peaks[-1] = max(_peaks[-1], peak)
+        record = _records.setdefault(self.key, [0, 0.0, 0])
+        record[0] += 1
+        record[1] += seconds
+        record[2] = max(record[2], peak - self.memory)
+        return False
+
+
+def stage(name, **tags):
+    """
+    Context manager timing a named stage, tags (e.g. cell, pars) are
+    recorded separately
+    """
+    if not _enabled:
+        return _NO_STAGE
+    return _Stage(name, tags)
+
+
+def profiled(name):
+    """
+    Decorator timing every call of a function as stage `name`
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with _Stage(name, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def enable(report_fname='profile_report.json', memory=True):
+    """
+    Start recording, the report is written at exit
+    :param report_fname: string
+        json file of the report, None for the table only
+    :param memory: bool
+        record peak memory with tracemalloc
+    """
+    global _enabled, _memory, _report_fname
+    if not _enabled:
+        atexit.register(report)
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    _enabled = True
+    _memory = memory
+    _report_fname = report_fname
+
+
+def enabled():
+    return _enabled
+
+
+def take():
+    """
+    Remove and return the records of this process, None if not profiling.
+    Used by worker processes to send their records to the main process.
+    """
+    if not _enabled:
+        return None
+    records = list(_records.items())
+    _records.clear()
+    return records
+
+
+def merge(records):
+    """
+    Add records returned by take (e.g. in a worker process)
+    """
+    for key, (calls, seconds, peak) in records or []:
+        record = _records.setdefault(key, [0, 0.0, 0])
+        record[0] += calls
+        record[1] += seconds
+        record[2] = max(record[2], peak)
+
+
+def collect(func, *args):
+    """
+    Call func and return its result together with the records of the call,
+    for functions run in a process pool
+    """
+    return func(*args), take()
+
+
+def summary():
+    """
+    Recorded stages aggregated over the tags
+    :return: dict
+        name -> {'calls', 'seconds', 'peak_mb'}
+    """
+    stages = {}
+    for (name, tags), (calls, seconds, peak) in _records.items():
+        s = stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'peak_mb': 0.0})
+        s['calls'] += calls
+        s['seconds'] += seconds
+        s['peak_mb'] = max(s['peak_mb'], peak / 1e6)
+    return stages
+
+
+def report(fname=None, stream=None):
+    """
+    Print the stage table and write all records as json
+    """
+    if not _records:
+        return
+    stream = stream or sys.stdout
+    stages = summary()
+    stream.write('{:20s} {:>8s} {:>10s} {:>10s} {:>10s}\n'.format(
+        'stage', 'calls', 'total [s]', 'mean [ms]', 'peak [MB]'))
+    for name, s in sorted(stages.items(), key=lambda item: -item[1]['seconds']):
+        stream.write('{:20s} {:8d} {:10.3f} {:10.3f} {:10.2f}\n'.format(
+            name, s['calls'], s['seconds'], 1000 * s['seconds'] / s['calls'], s['peak_mb']))
+
+    fname = fname or _report_fname
+    if fname:
+        details = [{'stage': name, 'tags': dict(tags), 'calls': calls,
+                    'seconds': seconds, 'peak_mb': peak / 1e6}
+                   for (name, tags), (calls, seconds, peak) in sorted(_records.items())]
+        with open(fname, 'w') as f:
+            json.dump({'stages': stages, 'details': details}, f, indent=1)
+        stream.write('profile written to {}\n'.format(fname))
+
+
+if os.environ.get(PROFILE_ENV):
+    value = os.environ[PROFILE_ENV]
+    enable(value if value.endswith('.json') else 'profile_report.json',
+           os.environ.get(MEMORY_ENV, '1') != '0')
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+Renders the figures of the tasks apart from the computations, with the Agg
+backend and one reusable figure per plot type.
+
+A plot type is a module level function drawing computed data into the axes
+of a figure template, the layout is declared with @template:
+
+    @template(nrows=3, figsize=(12, 8))
+    def draw_cell(fig, axes, frames, titles):
+        ...
+
+The analyses describe a figure as a Job (draw function, file name and the
+data) and hand it to a renderer:
+
+- render(job) draws and saves it in this process
+- RenderPool.submit(job) renders it on a pool of processes, the caller
+  continues at once, the profiling stages of the workers are merged into
+  this process
+- defer(job) keeps it in this process until the driver collects it with
+  take_deferred and submits it to its RenderPool (see driver.run_cells),
+  workers computing cells never wait for savefig
+
+Every process keeps one figure per plot type. It is cleared and drawn again
+for the next job instead of creating and closing a figure per cell, so
+memory stays flat over any number of cells.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED, ALL_COMPLETED
+
+import profiling
+from profiling import stage
+
+# number of render processes, default half of the CPUs
+WORKERS_ENV = 'CLIMERS_RENDER_WORKERS'
+
+
+class Job(object):
+    """
+    A figure to render: draw(fig, axes, *args, **kwargs), saved as fname
+    """
+
+    def __init__(self, draw, fname, *args, savefig=None, **kwargs):
+        """
+        :param draw: function
+            module level function decorated with @template
+        :param fname: string
+            png file
+        :param savefig: dict
+            keyword arguments of Figure.savefig, e.g. bbox_inches
+        """
+        self.draw = draw
+        self.fname = fname
+        self.args = args
+        self.kwargs = kwargs
+        self.savefig = savefig or {}
+
+
+def template(**subplots_kw):
+    """
+    Declare the layout of a plot type (keyword arguments of plt.subplots)
+    """
+    def decorator(draw):
+        draw.subplots_kw = subplots_kw
+        return draw
+    return decorator
+
+
+# per process: plot type -> figure, axes, the axes of the template and its
+# subplot parameters
+_figures = {}
+
+
+def figure(draw):
+    """
+    The figure of a plot type, cleared for drawing
+    :return: tuple
+        figure and axes as returned by plt.subplots
+    """
+    import matplotlib.pyplot as plt
+
+    key = (draw.__module__, draw.__name__)
+    if key not in _figures:
+        fig, axes = plt.subplots(**draw.subplots_kw)
+        params = fig.subplotpars
+        _figures[key] = (fig, axes, list(fig.axes),
+                         dict(left=params.left, right=params.right, bottom=params.bottom,
+                              top=params.top, wspace=params.wspace, hspace=params.hspace))
+        return fig, axes
+    fig, axes, base, layout = _figures[key]
+    # the layout of a fresh figure, tight_layout starts from it
+    fig.subplots_adjust(**layout)
+    for ax in fig.axes:
+        if ax in base:
+            ax.cla()
+        else:
+            # twin axes, colorbars
+            fig.delaxes(ax)
+    fig.legends.clear()
+    fig.texts.clear()
+    return fig, axes
+
+
+def render(job):
+    """
+    Draw and save a job in this process
+    :return: string
+        the written file
+    """
+    fig, axes = figure(job.draw)
+    job.draw(fig, axes, *job.args, **job.kwargs)
+    with stage('savefig'):
+        fig.savefig(job.fname, **job.savefig)
+    return job.fname
+
+
+def release():
+    """
+    Close the figures of this process
+    """
+    import matplotlib.pyplot as plt
+
+    for fig in [entry[0] for entry in _figures.values()]:
+        plt.close(fig)
+    _figures.clear()
+
+
+_deferred = []
+
+
+def defer(job):
+    """
+    Keep a job for the driver, see take_deferred
+    """
+    _deferred.append(job)
+    return job.fname
+
+
+def take_deferred():
+    """
+    The deferred jobs of this process since the last call
+    """
+    jobs = list(_deferred)
+    del _deferred[:]
+    return jobs
+
+
+def _init_worker():
+    import matplotlib
+
+    matplotlib.use('Agg', force=True)
+    # drop the records a forked worker inherits from the parent
+    profiling.take()
+
+
+class RenderPool(object):
+    """
+    Renders jobs on a pool of Agg processes
+
+        with RenderPool() as pool:
+            pool.submit(job)
+        pool.errors                   # key -> error message of failed jobs
+    """
+
+    def __init__(self, n_workers=None, max_pending=None):
+        """
+        :param n_workers: int
+            number of processes, default from CLIMERS_RENDER_WORKERS or half
+            of the CPUs
+        :param max_pending: int
+            maximum number of jobs in flight (with their data), submit waits
+            for a free slot, default 4 * n_workers
+        """
+        if n_workers is None:
+            n_workers = int(os.environ.get(WORKERS_ENV, 0)) or max(1, (os.cpu_count() or 1) // 2)
+        self.n_workers = n_workers
+        self.max_pending = max_pending or 4 * n_workers
+        self.errors = {}
+        self._pending = {}
+        self._executor = ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker)
+
+    def submit(self, job, key=None):
+        """
+        Render a job in the background
+        :param key: hashable
+            recorded with the error if the job fails, default the file name
+        :return: string
+            the file name of the job
+        """
+        while len(self._pending) >= self.max_pending:
+            self._collect(FIRST_COMPLETED)
+        self._pending[self._executor.submit(profiling.collect, render, job)] = job.fname if key is None else key
+        return job.fname
+
+    def _collect(self, return_when):
+        done, _ = wait(self._pending, return_when=return_when)
+        for future in done:
+            key = self._pending.pop(future)
+            error = future.exception()
+            if error is not None:
+                self.errors[key] = '{}: {}'.format(type(error).__name__, error)
+            else:
+                # the savefig stages of the worker
+                profiling.merge(future.result()[1])
+
+    def join(self):
+        """
+        Wait for all submitted jobs
+        :return: dict
+            key -> error message of the failed jobs
+        """
+        if self._pending:
+            self._collect(ALL_COMPLETED)
+        return self.errors
+
+    def close(self):
+        self.join()
+        self._executor.shutdown()
+        return self.errors
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
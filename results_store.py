@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+Results of all tasks in one SQLite database instead of one csv per cell.
+
+Every value is a row keyed by task, cell, parameter set, variable and
+metric, e.g. ('taskB', '6037', '', 'FAPAR', 'Corr') or
+('taskC', '32785', 'pars7', 'FAPAR', 'kge'). Tables are inserted in bulk,
+one transaction per table, writing the same key again replaces the value.
+Indexes on (metric, variable, value) and (metric, cell, value) make cross
+cell queries fast:
+
+    store = ResultsStore('results/results.sqlite')
+    store.put_frame('taskB', metric_results, index='variable', cell='6037')
+    store.best('kge')                                   # best KGE per cell
+    store.query(metric='Corr', variable='FAPAR', below=0.5)
+    store.export_csv('metrics_taskB.csv', task='taskB')
+
+The tasks write to the store if CLIMERS_RESULTS_DB is set (a file name, or
+1 for results/results.sqlite). With CLIMERS_RESULTS_CSV=0 the per cell csv
+files are skipped then. Missing values (nan) are stored as NULL.
+
+Several processes can write at once (WAL journal, writers wait for the
+lock).
+"""
+import os
+import sqlite3
+import numpy as np
+import pandas as pd
+
+DB_ENV = 'CLIMERS_RESULTS_DB'
+CSV_ENV = 'CLIMERS_RESULTS_CSV'
+
+KEYS = ['task', 'cell', 'parset', 'variable', 'metric']
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS results (
+    task TEXT NOT NULL,
+    cell TEXT NOT NULL,
+    parset TEXT NOT NULL,
+    variable TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    value REAL,
+    PRIMARY KEY (task, cell, parset, variable, metric)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS results_metric_variable ON results (metric, variable, value);
+CREATE INDEX IF NOT EXISTS results_metric_cell ON results (metric, cell, value);
+'''
+
+
+def _check_keys(keys):
+    unknown = [key for key in keys if key not in KEYS]
+    if unknown:
+        raise ValueError('unknown result keys {}, use {}'.format(unknown, KEYS))
+
+
+def frame_rows(task, df, index='variable', **keys):
+    """
+    Rows (task, cell, parset, variable, metric, value) of a table
+    :param task: string
+        e.g. 'taskB'
+    :param df: pd.DataFrame
+        one column per metric
+    :param index: string or tuple
+        key(s) given by the index (levels) of df
+    :param keys: string
+        values of the other keys, missing keys are ''
+    :return: list
+    """
+    index = [index] if isinstance(index, str) else list(index)
+    _check_keys(index + list(keys))
+    n_rows, n_cols = df.shape
+    columns = {'task': [task] * (n_rows * n_cols)}
+    for level, key in enumerate(index):
+        labels = df.index.get_level_values(level).astype(str)
+        columns[key] = np.repeat(np.asarray(labels, dtype=object), n_cols).tolist()
+    columns['metric'] = np.tile(np.asarray(df.columns.astype(str), dtype=object), n_rows).tolist()
+    for key in KEYS:
+        if key not in columns:
+            columns[key] = [str(keys.get(key, ''))] * (n_rows * n_cols)
+    values = df.values.astype(np.float64).ravel()
+    values = np.where(np.isnan(values), None, values).tolist()
+    return list(zip(*[columns[key] for key in KEYS], values))
+
+
+class ResultsStore(object):
+    """
+    Connection to a results database, created on first use
+    """
+
+    def __init__(self, fname, timeout=60):
+        """
+        :param fname: string
+            SQLite file
+        :param timeout: float
+            seconds to wait for the lock of another writer
+        """
+        self.fname = fname
+        path = os.path.dirname(os.path.abspath(fname))
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.conn = sqlite3.connect(fname, timeout=timeout)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.conn:
+            self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def put(self, rows):
+        """
+        insert or replace (task, cell, parset, variable, metric, value) rows
+        in one transaction
+        """
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+    def put_frame(self, task, df, index='variable', **keys):
+        """
+        insert a table, see frame_rows
+        """
+        self.put(frame_rows(task, df, index, **keys))
+
+    def query(self, below=None, above=None, **keys):
+        """
+        Rows matching the given keys (e.g. metric='Corr', variable='FAPAR')
+        :param below: float
+            only values < below
+        :param above: float
+            only values > above
+        :return: pd.DataFrame
+            columns KEYS and value
+        """
+        _check_keys(keys)
+        conditions = ['{} = ?'.format(key) for key in keys]
+        params = [str(value) for value in keys.values()]
+        if below is not None:
+            conditions.append('value < ?')
+            params.append(below)
+        if above is not None:
+            conditions.append('value > ?')
+            params.append(above)
+        sql = 'SELECT * FROM results'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        return pd.read_sql_query(sql, self.conn, params=params)
+
+    def best(self, metric, per='cell', lowest=False, **keys):
+        """
+        Row with the largest (or lowest) value of a metric per cell (or other
+        keys), e.g. best('kge') or best('NRMSE', per=('cell', 'variable'),
+        lowest=True, task='taskB')
+        :return: pd.DataFrame
+            columns KEYS and value
+        """
+        per = [per] if isinstance(per, str) else list(per)
+        _check_keys(per + list(keys))
+        conditions = ['metric = ?', 'value IS NOT NULL'] + ['{} = ?'.format(key) for key in keys]
+        params = [metric] + [str(value) for value in keys.values()]
+        # SQLite takes the other columns from the row of the MIN/MAX
+        sql = ('SELECT task, cell, parset, variable, metric, {}(value) AS value FROM results '
+               'WHERE {} GROUP BY {}'.format('MIN' if lowest else 'MAX', ' AND '.join(conditions),
+                                             ', '.join(per)))
+        return pd.read_sql_query(sql, self.conn, params=params)
+
+    def frame(self, index=('cell', 'parset', 'variable'), **keys):
+        """
+        Matching rows as wide table, one column per metric
+        """
+        long = self.query(**keys)
+        return long.set_index(list(index) + ['metric'])['value'].unstack('metric')
+
+    def export_csv(self, fname, index=('cell', 'parset', 'variable'), **keys):
+        """
+        write frame(index, **keys) as csv
+        """
+        self.frame(index, **keys).to_csv(fname)
+
+
+_stores = {}
+
+
+def open_store(fname):
+    """
+    Process wide store for a database file
+    """
+    key = os.path.abspath(fname)
+    if key not in _stores:
+        _stores[key] = ResultsStore(fname)
+    return _stores[key]
+
+
+def store_from_env(default_fname):
+    """
+    database file given by CLIMERS_RESULTS_DB (1 for default_fname), None
+    if not set
+    """
+    fname = os.environ.get(DB_ENV)
+    if not fname or fname == '0':
+        return None
+    return default_fname if fname == '1' else fname
+
+
+def write_csv():
+    """
+    False if CLIMERS_RESULTS_CSV=0 and a database is used
+    """
+    return not (os.environ.get(DB_ENV, '0') != '0' and os.environ.get(CSV_ENV) == '0')
+
+
+if __name__ == '__main__':
+    import sys
+    # python results_store.py results/results.sqlite out.csv [task]
+    store = ResultsStore(sys.argv[1])
+    keys = {'task': sys.argv[3]} if len(sys.argv) > 3 else {}
+    store.export_csv(sys.argv[2], **keys)
@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+"""
+Satellite products used for the model evaluation. Each product file holds
+one column per LPJmL cell. The files are parsed once per process and the
+cell series are handed out as views on the stored arrays.
+
+At global scale the files have tens of thousands of cell columns. For a few
+cells read_columns parses only the requested columns of the text. For
+repeated access a product is converted once (build_columns) to a memory
+mapped (cell, month) array, reading a subset or a chunk of cells then only
+touches the rows of these cells:
+
+    store = open_columns(os.path.join(satpath, PRODUCTS['fapar']))
+    for cells, values in store.iter_chunks(1000):
+        ...                         # values: (len(cells), month) array
+
+SatelliteStore(satpath, cells) keeps only the given cells in memory.
+"""
+import os
+import re
+import json
+import numpy as np
+import pandas as pd
+
+from exercise03 import read_data, _cache_path
+
+# file names of the satellite products in data/Satellite
+PRODUCTS = {'fapar': 'MOD15A2H.FPAR.forLPJcells.2000.2018.30days.txt',
+            'sif': 'GlobFluo-GOME2.SIF.forLPJcells.2007.2015.30days.txt',
+            'ssm': 'ESACCIv050.SSM.forLPJcells.1978.2017.30days.txt'}
+
+
+# suffix of the converted products in the cache folder of read_data
+COLUMNS_SUFFIX = '.columns'
+# approximate memory for the text rows parsed at once by build_columns, a
+# parsed token takes about 120 bytes
+BLOCK_BYTES = 2 ** 26
+
+
+def _header(f):
+    """
+    column names in the quoted header line of a product file
+    """
+    return re.findall(r'"([^"]*)"', f.readline())
+
+
+def _month(key):
+    """
+    months since 1970-01 of a "YYYY-M" key
+    """
+    year, month = key.strip('"').split('-')
+    return (int(year) - 1970) * 12 + int(month) - 1
+
+
+def _dates(months, name):
+    months = np.array(months, dtype=np.int64).astype('datetime64[M]')
+    return pd.DatetimeIndex(months.astype('datetime64[ns]'), name=name)
+
+
+def _to_float(tokens):
+    """
+    float array of value tokens, NA is missing (same conversion as read_data)
+    """
+    tokens = np.array(tokens, dtype=object).ravel()
+    tokens[tokens == 'NA'] = np.nan
+    return pd.to_numeric(tokens).astype(np.float64)
+
+
+def read_columns(fname, cells):
+    """
+    Read some cell columns of a product file, the other columns are not
+    converted. Memory use is proportional to the requested cells.
+    :param fname: string
+        name of the product file
+    :param cells: list
+        LPJmL cell numbers (strings)
+    :return: pandas.DataFrame
+        (dates x cells) like read_data(fname)[cells], as float
+    """
+    cells = list(cells)
+    with open(fname) as f:
+        names = _header(f)
+        positions = {name: i for i, name in enumerate(names)}
+        columns = [positions[cell] for cell in cells]
+        last = max(columns) if columns else 0
+        months = []
+        tokens = []
+        for line in f:
+            # tokens behind the last requested column are not split
+            row = line.split(None, last + 1)
+            if not row:
+                continue
+            months.append(_month(row[0]))
+            tokens.extend(row[i] for i in columns)
+    values = _to_float(tokens).reshape(len(months), len(columns))
+    return pd.DataFrame(values, index=_dates(months, names[0]), columns=cells)
+
+
+def _stamp(fname):
+    st = os.stat(fname)
+    return [st.st_mtime_ns, st.st_size]
+
+
+def _write_block(data, stop, rows):
+    """
+    store the token rows ending at month stop in the (cell, month) array
+    """
+    data[:, stop - len(rows):stop] = _to_float(rows).reshape(len(rows), -1).T
+
+
+def build_columns(fname, path=None, block_bytes=BLOCK_BYTES):
+    """
+    Convert a product file to a (cell, month) array, see ColumnStore. The
+    text is read in blocks of rows, the whole table is never in memory.
+    :param fname: string
+        name of the product file
+    :param path: string
+        folder for columns.npy and index.json, default in the cache folder
+        of read_data
+    :param block_bytes: int
+        approximate memory for the text rows converted at once
+    :return: string
+        path
+    """
+    if path is None:
+        path = _cache_path(fname, COLUMNS_SUFFIX)
+    os.makedirs(path, exist_ok=True)
+    with open(fname) as f:
+        names = _header(f)
+        n_months = sum(1 for line in f if line.strip())
+    cells = names[1:]
+    n_cells = len(cells)
+    block = max(1, block_bytes // (120 * n_cells))
+
+    # written under a temporary name, other processes never see a partial file
+    npy_fname = os.path.join(path, 'columns.npy')
+    tmp_fname = '{}.{}.tmp'.format(npy_fname, os.getpid())
+    data = np.lib.format.open_memmap(tmp_fname, mode='w+', dtype=np.float64,
+                                     shape=(n_cells, n_months))
+    months = []
+    with open(fname) as f:
+        f.readline()
+        rows = []
+        for line in f:
+            row = line.split()
+            if not row:
+                continue
+            if len(row) != n_cells + 1:
+                raise ValueError('{}: row {} has {} values, expected {}'.format(
+                    fname, row[0], len(row) - 1, n_cells))
+            months.append(_month(row[0]))
+            rows.append(row[1:])
+            if len(rows) == block:
+                _write_block(data, len(months), rows)
+                rows = []
+        if rows:
+            _write_block(data, len(months), rows)
+    data.flush()
+    del data
+    os.replace(tmp_fname, npy_fname)
+
+    index = {'source': _stamp(fname),
+             'cells': cells,
+             'dates': [d.strftime('%Y-%m') for d in _dates(months, names[0])],
+             'date': names[0]}
+    tmp_fname = os.path.join(path, 'index.json.{}.tmp'.format(os.getpid()))
+    with open(tmp_fname, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_fname, os.path.join(path, 'index.json'))
+    return path
+
+
+class ColumnStore(object):
+    """
+    Read access to a product converted by build_columns. The cell rows of
+    the memory-mapped array are contiguous, reading some cells only touches
+    their pages.
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, 'index.json')) as f:
+            index = json.load(f)
+        self.source = index['source']
+        self.cells = index['cells']
+        self.dates = pd.DatetimeIndex(pd.to_datetime(index['dates'], format='%Y-%m'),
+                                      name=index['date'])
+        self.data = np.load(os.path.join(path, 'columns.npy'), mmap_mode='r')
+        self._positions = {cell: i for i, cell in enumerate(self.cells)}
+
+    def __contains__(self, cell):
+        return cell in self._positions
+
+    def values(self, cells):
+        """
+        (cell, month) array of the given cells, read into memory
+        """
+        return self.data[[self._positions[cell] for cell in cells]]
+
+    def frame(self, cells):
+        """
+        the given cells as DataFrame (dates x cells)
+        """
+        return pd.DataFrame(self.values(cells).T, index=self.dates, columns=list(cells))
+
+    def series(self, cell, name=None):
+        """
+        one cell, a view on the memory map
+        """
+        return pd.Series(self.data[self._positions[cell]], index=self.dates,
+                         name=cell if name is None else name)
+
+    def iter_chunks(self, chunk_size=1000, cells=None):
+        """
+        Iterate over cells in chunks, only one chunk is in memory at a time
+        :param chunk_size: int
+            number of cells per chunk
+        :param cells: list
+            cells to read, default all cells of the product
+        :return: iterator
+            (cells, values) with values a (len(cells), month) array
+        """
+        if cells is None:
+            for start in range(0, len(self.cells), chunk_size):
+                yield (self.cells[start:start + chunk_size],
+                       np.array(self.data[start:start + chunk_size]))
+        else:
+            cells = list(cells)
+            for start in range(0, len(cells), chunk_size):
+                chunk = cells[start:start + chunk_size]
+                yield chunk, self.values(chunk)
+
+
+def open_columns(fname, rebuild=False):
+    """
+    Open the converted form of a product file, it is (re)built first if it
+    does not exist or the file changed
+    """
+    path = _cache_path(fname, COLUMNS_SUFFIX)
+    if not rebuild:
+        try:
+            store = ColumnStore(path)
+            if store.source == _stamp(fname):
+                return store
+        except (OSError, ValueError):
+            pass
+    build_columns(fname, path)
+    return ColumnStore(path)
+
+
+def iter_cell_chunks(satpath, product, chunk_size=1000, cells=None):
+    """
+    Cells of a product in chunks, see ColumnStore.iter_chunks
+    """
+    return open_columns(os.path.join(satpath, PRODUCTS[product])).iter_chunks(chunk_size, cells)
+
+
+class SatelliteStore(object):
+    """
+    Parses every satellite product once and keeps its cell columns as one
+    column-major array, so that a single cell is a contiguous slice.
+
+    With cells given only these columns are kept (read from the converted
+    product, see open_columns), cells missing in a product are left out.
+
+    The returned series share memory with the store, callers must not modify
+    them in place (copy first, as normalize_df does).
+    """
+
+    def __init__(self, satpath, cells=None):
+        self.satpath = satpath
+        self.subset = None if cells is None else list(cells)
+        self._products = {}
+
+    def _load(self, product):
+        if product not in self._products:
+            fname = os.path.join(self.satpath, PRODUCTS[product])
+            if self.subset is None:
+                df = read_data(fname)
+            else:
+                columns = open_columns(fname)
+                df = columns.frame([cell for cell in self.subset if cell in columns])
+            values = np.asfortranarray(df.values, dtype=np.float64)
+            columns = {col: i for i, col in enumerate(df.columns)}
+            self._products[product] = (df.index, columns, values)
+        return self._products[product]
+
+    def cells(self, product):
+        """list of cells available in a product"""
+        return list(self._load(product)[1])
+
+    def get(self, product, cell, name=None):
+        """
+        Time series of one cell
+        :param product: string
+            key in PRODUCTS ('fapar', 'sif', 'ssm')
+        :param cell: string
+            LPJmL cell number
+        :param name: string
+            name of the returned series, defaults to the cell
+        :return: pandas.Series
+            view on the stored product data
+        """
+        index, columns, values = self._load(product)
+        return pd.Series(values[:, columns[cell]], index=index,
+                         name=cell if name is None else name, copy=False)
+
+
+_stores = {}
+
+
+def get_store(satpath, cells=None):
+    """
+    Process wide store for a satellite data folder (and subset of cells)
+    """
+    key = (os.path.abspath(satpath), None if cells is None else tuple(cells))
+    if key not in _stores:
+        _stores[key] = SatelliteStore(satpath, cells)
+    return _stores[key]
+
+
+def read_satellite(satpath, product, cell, name=None):
+    """
+    Time series of one cell from the process wide store, see SatelliteStore.get
+    """
+    return get_store(satpath).get(product, cell, name)
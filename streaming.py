@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+"""
+Single pass metrics for series that are read in chunks.
+
+PairedAccumulator consumes (sim, obs) chunks and keeps counts, means and
+sums of squared deviations (Welford/Chan updates) instead of the data. Two
+accumulators fed with different parts of a series (e.g. in worker
+processes) are combined with merge, the result is the same as for one
+accumulator fed with all chunks.
+
+    acc = PairedAccumulator()
+    for s, o in chunks:
+        acc.update(s, o)
+    acc.rmse(), acc.KGE(), acc.nrmse()
+
+Metrics follow error_metrics (nan pairs are dropped, statistics over the
+valid pairs) and taskB (means and variances of each series over its own
+valid values, like pandas).
+
+Index of agreement and agreement coefficient sum absolute deviations from
+the means, which are only known once all data has been seen. They are
+computed exactly in a second pass over the chunks with the means of the
+first one:
+
+    second = acc.second_pass()
+    for s, o in chunks:
+        second.update(s, o)
+    second.index_agreement(), second.ioa()
+
+stream_metrics runs both passes for a chunk source that can be iterated
+twice.
+"""
+import numpy as np
+
+
+def _div(a, b):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.float64(a) / b
+
+
+def _chunk(s, o):
+    s = np.asarray(s, dtype=np.float64).ravel()
+    o = np.asarray(o, dtype=np.float64).ravel()
+    if s.shape != o.shape:
+        raise ValueError('sim and obs chunks differ in length: {} != {}'.format(s.size, o.size))
+    return s, o
+
+
+class _Moments(object):
+    """
+    count, mean and sum of squared deviations of one series
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def update(self, x):
+        nb = x.size
+        if nb == 0:
+            return
+        mean_b = np.mean(x)
+        m2_b = np.dot(x - mean_b, x - mean_b)
+        self._combine(nb, mean_b, m2_b)
+
+    def merge(self, other):
+        if other.n:
+            self._combine(other.n, other.mean, other.m2)
+
+    def _combine(self, nb, mean_b, m2_b):
+        n = self.n + nb
+        delta = mean_b - self.mean
+        self.mean += delta * nb / n
+        self.m2 += m2_b + delta * delta * self.n * nb / n
+        self.n = n
+
+    def var(self, ddof=0):
+        return _div(self.m2, self.n - ddof)
+
+
+class PairedAccumulator(object):
+    """
+    mergeable first pass statistics of a simulated and observed series
+    """
+
+    def __init__(self):
+        # each series over its own valid values
+        self.sim = _Moments()
+        self.obs = _Moments()
+        # over the pairs where both are valid
+        self.n = 0
+        self.mean_s = 0.0
+        self.mean_o = 0.0
+        self.m2_s = 0.0
+        self.m2_o = 0.0
+        self.c_so = 0.0
+        self.sum_o = 0.0
+        self.sum_residuals = 0.0
+        self.sum_abs_residuals = 0.0
+        self.sse = 0.0
+
+    def update(self, s, o):
+        """
+        add a chunk of simulated and observed values (same length, may
+        contain nan)
+        """
+        s, o = _chunk(s, o)
+        valid_s = ~np.isnan(s)
+        valid_o = ~np.isnan(o)
+        self.sim.update(s[valid_s])
+        self.obs.update(o[valid_o])
+
+        pair = valid_s & valid_o
+        s = s[pair]
+        o = o[pair]
+        nb = s.size
+        if nb == 0:
+            return self
+        mean_s = np.mean(s)
+        mean_o = np.mean(o)
+        sc = s - mean_s
+        oc = o - mean_o
+        residuals = s - o
+        self.sum_o += np.sum(o)
+        self.sum_residuals += np.sum(residuals)
+        self.sum_abs_residuals += np.sum(np.abs(residuals))
+        self.sse += np.dot(residuals, residuals)
+        self._combine(nb, mean_s, mean_o, np.dot(sc, sc), np.dot(oc, oc), np.dot(sc, oc))
+        return self
+
+    def merge(self, other):
+        """
+        add the state of another accumulator, e.g. of a worker process
+        """
+        self.sim.merge(other.sim)
+        self.obs.merge(other.obs)
+        if other.n:
+            self.sum_o += other.sum_o
+            self.sum_residuals += other.sum_residuals
+            self.sum_abs_residuals += other.sum_abs_residuals
+            self.sse += other.sse
+            self._combine(other.n, other.mean_s, other.mean_o, other.m2_s, other.m2_o,
+                          other.c_so)
+        return self
+
+    def _combine(self, nb, mean_s, mean_o, m2_s, m2_o, c_so):
+        n = self.n + nb
+        ds = mean_s - self.mean_s
+        do = mean_o - self.mean_o
+        f = self.n * nb / n
+        self.m2_s += m2_s + ds * ds * f
+        self.m2_o += m2_o + do * do * f
+        self.c_so += c_so + ds * do * f
+        self.mean_s += ds * nb / n
+        self.mean_o += do * nb / n
+        self.n = n
+
+    # error_metrics
+    def pc_bias(self):
+        return 100.0 * _div(self.sum_residuals, self.sum_o)
+
+    def apb(self):
+        return 100.0 * _div(self.sum_abs_residuals, self.sum_o)
+
+    def rmse(self):
+        return np.sqrt(_div(self.sse, self.n))
+
+    def mae(self):
+        return _div(self.sum_abs_residuals, self.n)
+
+    def bias(self):
+        return _div(self.sum_residuals, self.n)
+
+    def NS(self):
+        return 1 - _div(self.sse, self.m2_o)
+
+    def L(self, N=5):
+        return np.exp(-N * _div(self.sse, self.m2_o))
+
+    def correlation(self):
+        return np.clip(_div(self.c_so, np.sqrt(self.m2_s * self.m2_o)), -1, 1)
+
+    def KGE(self):
+        cc = self.correlation()
+        alpha = np.sqrt(_div(self.m2_s, self.m2_o))
+        beta = _div(self.mean_s, self.mean_o)
+        kge = 1 - np.sqrt((cc - 1) ** 2 + (alpha - 1) ** 2 + (beta - 1) ** 2)
+        return kge, cc, alpha, beta
+
+    # taskB, not rounded
+    def nrmse(self):
+        return _div(self.rmse(), self.obs.mean)
+
+    def nae(self):
+        return _div(self.sim.mean - self.obs.mean, self.obs.mean)
+
+    def vr(self):
+        return _div(self.sim.var(ddof=1), self.obs.var(ddof=1))
+
+    def pearson_corr(self):
+        return self.correlation()
+
+    def second_pass(self):
+        """
+        accumulator of the deviations from the means of this pass
+        """
+        return DeviationAccumulator(self)
+
+
+class DeviationAccumulator(object):
+    """
+    mergeable second pass for the index of agreement and the agreement
+    coefficient, uses the final means of a PairedAccumulator
+    """
+
+    def __init__(self, first):
+        self.first = first
+        self.ia_denom = 0.0
+        self.ioa_denom = 0.0
+        self.ac_denom = 0.0
+
+    def update(self, s, o):
+        """
+        add a chunk, the chunks of the first pass in any order
+        """
+        s, o = _chunk(s, o)
+        pair = ~(np.isnan(s) | np.isnan(o))
+        s = s[pair]
+        o = o[pair]
+        first = self.first
+        # error_metrics.index_agreement, mean of the pairs
+        self.ia_denom += np.sum((np.abs(s - first.mean_o) + np.abs(o - first.mean_o)) ** 2)
+        # taskB.ioa, mean of all observations
+        self.ioa_denom += np.sum((np.abs(s - first.obs.mean) + np.abs(o - first.obs.mean)) ** 2)
+        dbar = np.abs(first.mean_s - first.mean_o)
+        self.ac_denom += np.sum((dbar + np.abs(s - first.mean_s)) * (dbar + np.abs(o - first.mean_o)))
+        return self
+
+    def merge(self, other):
+        self.ia_denom += other.ia_denom
+        self.ioa_denom += other.ioa_denom
+        self.ac_denom += other.ac_denom
+        return self
+
+    def index_agreement(self):
+        return 1 - _div(self.first.sse, self.ia_denom)
+
+    def agreement_coefficient(self):
+        return 1 - _div(self.first.sse, self.ac_denom)
+
+    def ioa(self):
+        return 1 - _div(self.first.sse, self.ioa_denom)
+
+
+def stream_metrics(chunks):
+    """
+    All metrics of a chunked pair in two passes
+    :param chunks: callable
+        chunks() returns a new iterator over (sim, obs) chunks
+    :return: dict
+        metric name -> value, names of error_metrics and taskB
+    """
+    first = PairedAccumulator()
+    for s, o in chunks():
+        first.update(s, o)
+    second = first.second_pass()
+    for s, o in chunks():
+        second.update(s, o)
+
+    kge, cc, alpha, beta = first.KGE()
+    return {'pc_bias': first.pc_bias(), 'apb': first.apb(), 'rmse': first.rmse(),
+            'mae': first.mae(), 'bias': first.bias(), 'NS': first.NS(), 'L': first.L(),
+            'correlation': cc, 'index_agreement': second.index_agreement(),
+            'agreement_coefficient': second.agreement_coefficient(),
+            'kge': kge, 'cc': cc, 'alpha': alpha, 'beta': beta,
+            'NRMSE': first.nrmse(), 'NAE': first.nae(), 'VR': first.vr(),
+            'IoA': second.ioa(), 'Corr': first.pearson_corr()}
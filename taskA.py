@@ -1,19 +1,31 @@
 import os
-import matplotlib.pyplot as plt
+import sys
+from functools import partial
 import pandas as pd
 
-from exercise03 import read_data
-
-
-def calc_variables(lpjmlpath, outpath, cell, save=False):
-    mevap = read_data(os.path.join(lpjmlpath, 'cell_{}'.format(cell), '{}_mevap.txt'.format(cell)))
-    mtransp = read_data(os.path.join(lpjmlpath, 'cell_{}'.format(cell), '{}_mtransp.txt'.format(cell)))
-    mnpp = read_data(os.path.join(lpjmlpath, 'cell_{}'.format(cell), '{}_mnpp.txt'.format(cell)))
-    mrh = read_data(os.path.join(lpjmlpath, 'cell_{}'.format(cell), '{}_mrh.txt'.format(cell)))
-    mgpp = read_data(os.path.join(lpjmlpath, 'cell_{}'.format(cell), '{}_mgpp.txt'.format(cell)))
-    mfapar = read_data(os.path.join(lpjmlpath, 'cell_{}'.format(cell), '{}_mfapar.txt'.format(cell)))
-    mswc = read_data(os.path.join(lpjmlpath, 'cell_{}'.format(cell), '{}_mswc1.txt'.format(cell)))
-    vars_cell = pd.concat([mevap, mtransp, mnpp, mrh, mgpp, mfapar, mswc], axis=1, sort=True)
+from lpjml import LPJmLCell
+import exercise03
+import lpjml
+import results_store
+import rendering
+from driver import discover_cells, run_cells_incremental
+from manifest import Manifest
+from results_store import open_store, store_from_env, write_csv
+from rendering import Job, template, render, defer
+
+# plot titles
+site_dict = {'32785': 'Sahel (23.75°E, 7.75°N), cropland area: 11%',
+             '6037': 'Mexico (105.25°W, 28.75°N), cropland area: 85%',
+             '7460': 'Canada (99.25°W, 52.25°N), cropland area: 0.3%',
+             '25368': 'Spain (3.25°W, 39.75°N), cropland area: 77%',
+             '53569': 'Taymyr (102.25°E, 75.75°N), cropland area: 0%'}
+
+
+def calc_variables(lpjmlpath, outpath, cell, save=False, lpjml_cell=None):
+    if lpjml_cell is None:
+        lpjml_cell = LPJmLCell(lpjmlpath, cell)
+    vars_cell = lpjml_cell.combined(['mevap', 'mtransp', 'minterc', 'mnpp', 'mrh',
+                                     'mgpp', 'mfapar', 'mswc1'])
     vars_cell['met'] = vars_cell[['mevap', 'mtransp', 'minterc']].sum(axis=1)
     vars_cell['mnee'] = vars_cell['mrh'] - vars_cell['mnpp']
 
@@ -23,62 +35,101 @@ def calc_variables(lpjmlpath, outpath, cell, save=False):
     return vars_cell
 
 
-def plot_vars(vars_cell, outpath, save=False):
-    '''
-    Plot monthly time series of FAPAR, SWC, ET, GPP and NEE for each grid cell
-    '''
-    fig, axes = plt.subplots(5, 1, sharex='all', figsize=(12, 12))
-
+@template(nrows=5, ncols=1, sharex='all', figsize=(12, 12))
+def draw_vars(fig, axes, vars_cell, name):
+    """
+    monthly FAPAR, SWC, ET, GPP and NEE of a cell
+    """
     # FAPAR
     vars_cell['mfapar'].plot(ax=axes[0])
-    axes[0].set_title('FAPAR {}'.format(vars_cell.name))
+    axes[0].set_title('FAPAR {}'.format(name))
     axes[0].set_ylabel('[-]')
     axes[0].set_ylim(0, 1)
 
     # SWC
     vars_cell['mswc1'].plot(ax=axes[1])
-    axes[1].set_title('Soil Water Content (SWC) {}'.format(vars_cell.name))
+    axes[1].set_title('Soil Water Content (SWC) {}'.format(name))
     axes[1].set_ylabel('[-]')
     axes[1].set_ylim(0, 1)
 
     # ET
     vars_cell['met'].plot(ax=axes[2])
-    axes[2].set_title('Evapotranspiration (ET) {}'.format(vars_cell.name))
+    axes[2].set_title('Evapotranspiration (ET) {}'.format(name))
     axes[2].set_ylabel('[mm/month]')
 
     # GPP
     vars_cell['mgpp'].plot(ax=axes[3])
-    axes[3].set_title('Gross primary production (GPP) {}'.format(vars_cell.name))
+    axes[3].set_title('Gross primary production (GPP) {}'.format(name))
     axes[3].set_ylabel('[gC/m2/month]')
 
     # NEE
     vars_cell['mnee'].plot(ax=axes[4])
-    axes[4].set_title('Net ecosystem exchange (NEE) {}'.format(vars_cell.name))
+    axes[4].set_title('Net ecosystem exchange (NEE) {}'.format(name))
     axes[4].set_ylabel('[gC/m2/month]')
 
-    # save figure
+
+def plot_vars(vars_cell, outpath, save=False, renderer=render):
+    '''
+    Plot monthly time series of FAPAR, SWC, ET, GPP and NEE for each grid cell
+    The saved figure is handed to renderer (see rendering.py).
+    '''
+    data = vars_cell[['mfapar', 'mswc1', 'met', 'mgpp', 'mnee']]
     if save:
-        plt.savefig(os.path.join(outpath, 'cell_vars_{}.png'.format(cell)), bbox_inches="tight")
-    else:
-        plt.show()
-    plt.close()
+        # save figure
+        return renderer(Job(draw_vars, os.path.join(outpath, 'cell_vars_{}.png'.format(vars_cell.name)),
+                            data, vars_cell.name, savefig={'bbox_inches': 'tight'}))
+    import matplotlib.pyplot as plt
+
+    fig, axes = plt.subplots(**draw_vars.subplots_kw)
+    draw_vars(fig, axes, data, vars_cell.name)
+    plt.show()
+    plt.close(fig)
+
 
+# ['mgpp', 'mnbp', 'fpc TeBE', 'fpc TeH', 'vegc']
+unit_dict = {'gpp' : '$gC m^{-2} yr^{-1}$',
+             'nbp' : '$gC m^{-2} yr^{-1}$',
+             'vegc': '$gC m^{-2} yr^{-1}$'}
 
-def calc_annually(lpjmlpath, cell, title=None, out_path=None):
+
+@template(nrows=5, ncols=1, sharex=True, figsize=(12, 8))
+def draw_annually(fig, axes, yearly_data, title=None):
+    """
+    annual GPP, NBP, dominant tree and grass fpc and vegetation carbon
+    """
+    yearly_data.plot(subplots=True, ax=axes)
+
+    for ax in axes:
+        handles, labels = ax.get_legend_handles_labels()
+        ax_label = labels[0]
+
+        if 'fpc' in ax_label:
+            unit = '%'
+        else:
+            unit = unit_dict[ax_label]
+
+        ax.set_ylabel('({})'.format(unit))
+
+    if title is not None:
+        axes[0].set_title(title)
+
+    fig.tight_layout()
+
+
+def calc_annually(lpjmlpath, cell, title=None, out_path=None, lpjml_cell=None, csv=True,
+                  renderer=render):
     '''
     Compute annual GPP and net biome productivity (NBP)
     NPB = NPP - Fire - Rh
-    :return:
+    The saved figure is handed to renderer (see rendering.py).
+    :return: correlations of the annual variables
     '''
 
-    mnpp = read_data(os.path.join(lpjmlpath, 'cell_{}'.format(cell), '{}_mnpp.txt'.format(cell)))
-    mfirec = read_data(os.path.join(lpjmlpath, 'cell_{}'.format(cell), '{}_mfirec.txt'.format(cell)))
-    mrh = read_data(os.path.join(lpjmlpath, 'cell_{}'.format(cell), '{}_mrh.txt'.format(cell)))
-    mgpp = read_data(os.path.join(lpjmlpath, 'cell_{}'.format(cell), '{}_mgpp.txt'.format(cell)))
-    vegc = read_data(os.path.join(lpjmlpath, 'cell_{}'.format(cell), '{}_vegc.txt'.format(cell)))
-    vegc = vegc.asfreq('YS')
-    fpc = read_data(os.path.join(lpjmlpath, 'cell_{}'.format(cell), '{}_fpc.txt'.format(cell)))
-    vars_cell = pd.concat([mnpp, mfirec, mrh, mgpp], axis=1, sort=True)
+    if lpjml_cell is None:
+        lpjml_cell = LPJmLCell(lpjmlpath, cell)
+    vegc = lpjml_cell['vegc'].asfreq('YS')
+    fpc = lpjml_cell['fpc']
+    vars_cell = lpjml_cell.combined(['mnpp', 'mfirec', 'mrh', 'mgpp'])
     vars_cell['mnbp'] = vars_cell['mnpp'] - vars_cell['mfirec'] - vars_cell['mrh']
     vars_cell_yearly = vars_cell.resample('YS').sum()
 
@@ -99,37 +150,45 @@ def calc_annually(lpjmlpath, cell, title=None, out_path=None):
     # calculate correlations
     corrs = yearly_data.corr()
 
-    #vars_cell_yearly.plot(subplots=True)
-    axes = yearly_data.plot(subplots=True, figsize=(12, 8))
-
-    # ['mgpp', 'mnbp', 'fpc TeBE', 'fpc TeH', 'vegc']
-
-    unit_dict = {'gpp' : '$gC m^{-2} yr^{-1}$',
-                 'nbp' : '$gC m^{-2} yr^{-1}$',
-                 'vegc': '$gC m^{-2} yr^{-1}$'}
-
-    for ax in axes:
-        handles, labels = ax.get_legend_handles_labels()
-        ax_label = labels[0]
-
-        if 'fpc' in ax_label:
-            unit = '%'
-        else:
-            unit = unit_dict[ax_label]
-
-        ax.set_ylabel('({})'.format(unit))
-
-    if title is not None:
-        axes[0].set_title(title)
-
-    plt.tight_layout()
-
-    if outpath is None:
+    if out_path is None:
         print(corrs)
+        import matplotlib.pyplot as plt
+
+        fig, axes = plt.subplots(**draw_annually.subplots_kw)
+        draw_annually(fig, axes, yearly_data, title)
         plt.show()
+        plt.close(fig)
     else:
-        corrs.to_csv(os.path.join(outpath, 'annual_corrs_cell_{}.csv'.format(cell)))
-        plt.savefig(os.path.join(outpath, 'annual_cell_{}.png'.format(cell)))
+        if csv:
+            corrs.to_csv(os.path.join(out_path, 'annual_corrs_cell_{}.csv'.format(cell)))
+        renderer(Job(draw_annually, os.path.join(out_path, 'annual_cell_{}.png'.format(cell)),
+                     yearly_data, title))
+    return corrs
+
+
+def process_cell(lpjmlpath, outpath, cell, results_db=None, csv=True, renderer=render):
+    """
+    All taskA analyses of one cell, returns the written files. The annual
+    correlations go to the csv file and/or the results database (variable
+    and metric 'corr_<variable>').
+    """
+    # one lazily loaded cell shared by all analyses
+    lpjml_cell = LPJmLCell(lpjmlpath, cell)
+    vars_cell = calc_variables(lpjmlpath, outpath, cell, False, lpjml_cell)
+    vars_cell.name = cell
+
+    # get plot title for cell
+    cell_title = site_dict.get(cell, 'cell {}'.format(cell))
+    plot_vars(vars_cell, outpath, True, renderer)
+    corrs = calc_annually(lpjmlpath, cell, cell_title, outpath, lpjml_cell, csv, renderer)
+    outputs = [os.path.join(outpath, fname.format(cell))
+               for fname in ['cell_vars_{}.png', 'annual_cell_{}.png']]
+    if csv:
+        outputs.append(os.path.join(outpath, 'annual_corrs_cell_{}.csv'.format(cell)))
+    if results_db is not None:
+        open_store(results_db).put_frame('taskA', corrs.add_prefix('corr_'), cell=cell)
+        outputs.append(results_db)
+    return outputs
 
 
 if __name__ == '__main__':
@@ -141,21 +200,20 @@ if __name__ == '__main__':
     except:
         pass
 
-
-    site_dict = {'32785': 'Sahel (23.75°E, 7.75°N), cropland area: 11%',
-                 '6037': 'Mexico (105.25°W, 28.75°N), cropland area: 85%',
-                 '7460': 'Canada (99.25°W, 52.25°N), cropland area: 0.3%',
-                 '25368': 'Spain (3.25°W, 39.75°N), cropland area: 77%',
-                 '53569': 'Taymyr (102.25°E, 75.75°N), cropland area: 0%'}
-
-
-    cells = ['6037', '7460', '25368', '32785', '53569']
-    vars_cells = {}
-    for cell in cells:
-        vars_cells[cell] = calc_variables(lpjmlpath, outpath, cell, False)
-        vars_cells[cell].name = cell
-
-        # get plot title for cell
-        cell_title = site_dict[cell]
-        plot_vars(vars_cells[cell], outpath, True)
-        calc_annually(lpjmlpath, cell, cell_title, outpath)
+    # cells given on the command line, all cells in data/LPJmL otherwise
+    cells = sys.argv[1:] or discover_cells(lpjmlpath)
+    n_workers = int(os.environ.get('TASKA_WORKERS', 0)) or None
+    # results database and per cell csv files, see results_store.py
+    results_db = store_from_env(os.path.join(rootpath, 'results', 'results.sqlite'))
+    csv = write_csv()
+    # only cells with changed input files or code are recomputed
+    manifest = Manifest(os.path.join(outpath, 'manifest.json'))
+    code = manifest.code_hash([sys.modules[__name__], lpjml, exercise03, results_store, rendering],
+                              {'pandas': pd.__version__, 'results_db': results_db, 'csv': csv})
+    # figures are rendered on a separate pool of processes
+    summary = run_cells_incremental(partial(process_cell, lpjmlpath, outpath,
+                                            results_db=results_db, csv=csv, renderer=defer), cells,
+                                    lambda cell: LPJmLCell(lpjmlpath, cell).files(),
+                                    manifest, code, n_workers)
+    summary.to_csv(os.path.join(outpath, 'summary_cells.csv'))
+    print(summary[['status', 'seconds', 'error']])
@@ -1,18 +1,53 @@
 # -*- coding: utf-8 -*-
 # Created by tobias at 20.06.19
 
+import numpy as np
 import pandas as pd
 import os
-import matplotlib.pyplot as plt
-from exercise03 import read_data
-
-
+import sys
+from functools import partial
+from lpjml import LPJmLCell
+import exercise03
+import lpjml
+import satellite
+import bootstrap
+import alignment
+import error_metrics
+import metric_kernels
+import results_store
+import rendering
+from driver import discover_cells, run_cells_incremental
+from manifest import Manifest
+from satellite import read_satellite
+from profiling import profiled, stage
+from bootstrap import resample_indices, confidence_interval
+from metric_kernels import taskb_metrics
+from alignment import align
+from results_store import open_store, store_from_env, write_csv
+from rendering import Job, template, render, defer
+
+
+@profiled('normalize_df')
 def normalize_df(df):
     df_norm = df.copy()
     df_norm = (df_norm - df_norm.min()) / (df_norm.max() - df_norm.min())
     return df_norm
 
 
+@profiled('normalize_df')
+def normalize_values(values):
+    """
+    min-max normalization of an array with nan, like normalize_df
+    """
+    if np.isnan(values).all():
+        # no valid value (e.g. a product without data in the cell), all nan
+        low = high = np.nan
+    else:
+        low, high = np.nanmin(values), np.nanmax(values)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (values - low) / (high - low)
+
+
 def nrmse(df):
     # normalized root mean square error
     return round((((df.iloc[:, 0] - df.iloc[:, 1]) ** 2).mean() ** .5) / df.iloc[:, 1].mean(), 4)
@@ -41,6 +76,7 @@ def pearson_corr(df):
     return round(df.iloc[:, 0].corr(df.iloc[:, 1]), 4)
 
 
+@profiled('calc_metrics')
 def calc_metrics(df, index_name=''):
     """pd.DataFrame: first col is model, second col is satellite data set"""
     results_dict = {}
@@ -52,9 +88,82 @@ def calc_metrics(df, index_name=''):
     return pd.DataFrame(results_dict, index=[index_name])
 
 
-def evaluate_model(datapath, outpath, cell):
+@profiled('calc_metrics')
+def calc_metrics_values(s, o, index_name=''):
+    """
+    calc_metrics of aligned model (s) and satellite (o) arrays
+    """
+    metrics = taskb_metrics(s[None, :], o[None, :])
+    results_dict = {}
+    for metric in ['NRMSE', 'NAE', 'VR', 'IoA', 'Corr']:
+        results_dict[metric] = round(metrics[metric][0], 4)
+    return pd.DataFrame(results_dict, index=[index_name])
+
+
+def calc_metrics_ci(df, index_name='', n_boot=1000, block_size=12, seed=0, alpha=0.05):
+    """
+    calc_metrics with bootstrap confidence intervals (columns <metric>_low
+    and <metric>_high), see bootstrap.py. Blocks of 12 months keep the
+    seasonal autocorrelation.
+    """
+    s = df.iloc[:, 0].values
+    o = df.iloc[:, 1].values
+    idx = resample_indices(len(df), n_boot, block_size, seed)
+    replicates = taskb_metrics(s[idx], o[idx])
+    results_dict = calc_metrics(df).iloc[0].to_dict()
+    for metric in ['NRMSE', 'NAE', 'VR', 'IoA', 'Corr']:
+        low, high = confidence_interval(replicates[metric], alpha)
+        results_dict[metric + '_low'] = round(low, 4)
+        results_dict[metric + '_high'] = round(high, 4)
+    return pd.DataFrame(results_dict, index=[index_name])
+
+
+@template(nrows=3, figsize=(12, 8))
+def draw_cell(fig, axes, frames, titles):
+    """
+    FAPAR, GPP/SIF and SSM of model and satellite with the metric tables as
+    titles
+    """
+    ax1, ax2, ax3 = axes
+
+    # FAPAR
+    frames[0].plot(ax=ax1)
+    ax1.set_ylabel('FAPAR (-)')
+    ax1.set_ylim(0, )
+    ax1.set_title(titles[0])
+
+    # GPP - SIF
+    frames[1].plot(ax=ax2)
+    ax2.set_ylabel('GPP/SIF (-)')
+    ax2.set_ylim(0, 1)
+    ax2.set_title(titles[1])
+
+    # SSM
+    frames[2].plot(ax=ax3)
+    ax3.set_ylabel('SSM (-)')
+    ax3.set_ylim(0, 1)
+    ax3.set_title(titles[2])
+
+    # formatting
+    for ax in [ax1, ax2, ax3]:
+        ax.set_xlabel(None)
+        ax.legend(loc='upper right')
+    fig.tight_layout()
+
+
+def evaluate_model(datapath, outpath, cell, lpjml_cell=None, n_boot=0, results_db=None,
+                   csv=True, renderer=render):
+    """
+    Metrics and plot of model vs. satellite FAPAR, GPP/SIF and SSM of a cell.
+    The figure is handed to renderer (see rendering.py), by default it is
+    rendered in this process.
+    :return: list
+        written files
+    """
     lpjmlpath = os.path.join(datapath, 'LPJmL')
     satpath = os.path.join(datapath, 'Satellite')
+    if lpjml_cell is None:
+        lpjml_cell = LPJmLCell(lpjmlpath, cell)
 
     # plot titles
     site_dict = {'32785': 'Sahel (23.75°E, 7.75°N), cropland area: 11%',
@@ -65,101 +174,82 @@ def evaluate_model(datapath, outpath, cell):
 
     # FAPAR
     # -------------------------------------------------------------------------
-    mfapar = read_data(os.path.join(lpjmlpath, 'cell_{}'.format(cell), '{}_mfapar.txt'.format(cell)))
-    mfapar = mfapar.rename(columns={'mfapar': 'LPJmL-FAPAR'})#.fillna(0.0)
-    fapar_sat = read_data(os.path.join(satpath, 'MOD15A2H.FPAR.forLPJcells.2000.2018.30days.txt'))
-    fapar_sat_cell = fapar_sat[cell].rename('MODIS-FAPAR')#.fillna(0.0)
+    mfapar = lpjml_cell['mfapar']
+    fapar_sat_cell = read_satellite(satpath, 'fapar', cell)
 
-    index_min = max([mfapar.index.min(), fapar_sat_cell.index.min()])
-    index_max = min([mfapar.index.max(), fapar_sat_cell.index.max()])
-    fapar_comb = pd.concat([mfapar, fapar_sat_cell], axis=1, sort=True).loc[index_min:index_max]
+    # clip to common date range
+    with stage('align', cell=cell):
+        fapar_comb = align([mfapar, fapar_sat_cell], ['LPJmL-FAPAR', 'MODIS-FAPAR'])
 
     # metrics
-    fapar_metrics = calc_metrics(fapar_comb, 'FAPAR')
+    fapar_metrics = calc_metrics_values(fapar_comb['LPJmL-FAPAR'], fapar_comb['MODIS-FAPAR'],
+                                        'FAPAR')
 
     # GPP/SIF
     # -------------------------------------------------------------------------
     # norm to evaluate temporal dynamic of GPP?
-    mgpp = read_data(os.path.join(lpjmlpath, 'cell_{}'.format(cell), '{}_mgpp.txt'.format(cell)))
-    mgpp = mgpp.rename(columns={'mgpp': 'LPJmL-GPP'})#.fillna(0.0)
-    sif = read_data(os.path.join(satpath, 'GlobFluo-GOME2.SIF.forLPJcells.2007.2015.30days.txt'))
-    sif_cell = sif[cell].rename('SIF')#.fillna(0.0)
-
-    # clip to common date range
-    index_min = max([mgpp.index.min(), sif_cell.index.min()])
-    index_max = min([mgpp.index.max(), sif_cell.index.max()])
-    sif_cell = sif_cell.loc[index_min:index_max]
-    mgpp = mgpp.loc[index_min:index_max]
+    mgpp = lpjml_cell['mgpp']
+    sif_cell = read_satellite(satpath, 'sif', cell)
 
-    # min-max normalization
-    mgpp_norm = normalize_df(mgpp)
-    sif_cell_norm = normalize_df(sif_cell)
-
-    gpp_sif = pd.concat([mgpp_norm, sif_cell_norm], axis=1, sort=True)
+    # clip to common date range, then min-max normalization
+    with stage('align', cell=cell):
+        gpp_sif = align([mgpp, sif_cell], ['LPJmL-GPP', 'SIF'])
+    gpp_sif = gpp_sif.apply(normalize_values)
 
     # metrics
-    gpp_sif_metrics = calc_metrics(gpp_sif, 'GPP-SIF')
+    gpp_sif_metrics = calc_metrics_values(gpp_sif['LPJmL-GPP'], gpp_sif['SIF'], 'GPP-SIF')
 
     # SWC/SSM
     # -------------------------------------------------------------------------
-    mswc = read_data(os.path.join(lpjmlpath, 'cell_{}'.format(cell), '{}_mswc1.txt'.format(cell)))
-    mswc = mswc.rename(columns={'mswc1': 'LPJmL-SWC'})#.fillna(0.0)
-    ssm = read_data(os.path.join(satpath, 'ESACCIv050.SSM.forLPJcells.1978.2017.30days.txt'))
-    ssm = ssm[cell].rename('ESACCISM')#.fillna(0.0)
-
-    # clip to common date range
-    index_min = max([ssm.index.min(), mswc.index.min()])
-    index_max = min([ssm.index.max(), mswc.index.max()])
-    mswc = mswc.loc[index_min:index_max]
-    ssm = ssm.loc[index_min:index_max]
+    mswc = lpjml_cell['mswc1']
+    ssm = read_satellite(satpath, 'ssm', cell)
 
-    # min-max normalization
-    ssm_norm = normalize_df(ssm)
-    mswc_norm = normalize_df(mswc)
-
-    ssm_comb = pd.concat([mswc_norm, ssm_norm], axis=1, sort=True)
+    # clip to common date range, then min-max normalization
+    with stage('align', cell=cell):
+        ssm_comb = align([mswc, ssm], ['LPJmL-SWC', 'ESACCISM'])
+    ssm_comb = ssm_comb.apply(normalize_values)
 
     # metrics
-    ssm_metrics = calc_metrics(ssm_comb, 'SSM')
+    ssm_metrics = calc_metrics_values(ssm_comb['LPJmL-SWC'], ssm_comb['ESACCISM'], 'SSM')
 
     # combine metric results to table
     # -------------------------------------------------------------------------
     metric_results = pd.concat([fapar_metrics, gpp_sif_metrics, ssm_metrics])
-    metric_results.to_csv(os.path.join(outpath, 'metrics_cell_{}.csv'.format(cell)))
+    outputs = []
+    if csv:
+        metric_results.to_csv(os.path.join(outpath, 'metrics_cell_{}.csv'.format(cell)))
+        outputs.append(os.path.join(outpath, 'metrics_cell_{}.csv'.format(cell)))
+
+    # bootstrap confidence intervals of the metrics
+    if n_boot:
+        metric_ci = pd.concat([calc_metrics_ci(fapar_comb.frame(), 'FAPAR', n_boot),
+                               calc_metrics_ci(gpp_sif.frame(), 'GPP-SIF', n_boot),
+                               calc_metrics_ci(ssm_comb.frame(), 'SSM', n_boot)])
+        if csv:
+            metric_ci.to_csv(os.path.join(outpath, 'metrics_ci_cell_{}.csv'.format(cell)))
+            outputs.append(os.path.join(outpath, 'metrics_ci_cell_{}.csv'.format(cell)))
+
+    # results database, see results_store.py
+    if results_db is not None:
+        with stage('store', cell=cell):
+            store = open_store(results_db)
+            store.put_frame('taskB', metric_results, cell=cell)
+            if n_boot:
+                store.put_frame('taskB', metric_ci, cell=cell)
+        outputs.append(results_db)
 
     # create plot
     # -------------------------------------------------------------------------
-    fig, (ax1, ax2, ax3) = plt.subplots(nrows=3, figsize=(12, 8))
-
-    # FAPAR
-    fapar_comb.plot(ax=ax1)
-    ax1.set_ylabel('FAPAR (-)')
-    ax1.set_ylim(0, )
-    ax1.set_title(str(fapar_metrics))
-
-    # GPP - SIF
-    gpp_sif.plot(ax=ax2)
-    ax2.set_ylabel('GPP/SIF (-)')
-    ax2.set_ylim(0, 1)
-    ax2.set_title(str(gpp_sif_metrics))
+    if cell in site_dict:
+        site = site_dict[cell].split(' ')[0]
+        fname = 'cell_{}_{}.png'.format(cell, site)
+    else:
+        fname = 'cell_{}.png'.format(cell)
+    renderer(Job(draw_cell, os.path.join(outpath, fname),
+                 [fapar_comb.frame(), gpp_sif.frame(), ssm_comb.frame()],
+                 [str(fapar_metrics), str(gpp_sif_metrics), str(ssm_metrics)]))
 
-    # SSM
-    ssm_comb.plot(ax=ax3)
-    ax3.set_ylabel('SSM (-)')
-    ax3.set_ylim(0, 1)
-    ax3.set_title(str(ssm_metrics))
-
-    # formatting
-    for ax in [ax1, ax2, ax3]:
-        ax.set_xlabel(None)
-        ax.legend(loc='upper right')
-    plt.tight_layout()
-
-    # save
-    site = site_dict[cell].split(' ')[0]
-    fname = 'cell_{}_{}.png'.format(cell, site)
-    plt.savefig(os.path.join(outpath, fname))
-    plt.close()
+    return outputs + [os.path.join(outpath, fname)]
 
 
 if __name__ == '__main__':
@@ -171,7 +261,29 @@ if __name__ == '__main__':
     except:
         pass
 
-    # compute evaluation
-    cells = ['6037', '7460', '25368', '32785', '53569']
-    for cell in cells:
-        evaluate_model(datapath, outpath, cell)
+    # compute evaluation for the cells given on the command line, all cells
+    # in data/LPJmL otherwise
+    cells = sys.argv[1:] or discover_cells(os.path.join(datapath, 'LPJmL'))
+    n_workers = int(os.environ.get('TASKB_WORKERS', 0)) or None
+    # number of bootstrap resamples for confidence intervals, 0 for none
+    n_boot = int(os.environ.get('TASKB_BOOTSTRAP', 0))
+    # results database and per cell csv files, see results_store.py
+    results_db = store_from_env(os.path.join(rootpath, 'results', 'results.sqlite'))
+    csv = write_csv()
+    # only cells with changed input files or code are recomputed
+    lpjmlpath = os.path.join(datapath, 'LPJmL')
+    sat_files = [os.path.join(datapath, 'Satellite', f) for f in sorted(satellite.PRODUCTS.values())]
+    manifest = Manifest(os.path.join(outpath, 'manifest.json'))
+    code = manifest.code_hash([sys.modules[__name__], lpjml, satellite, exercise03, bootstrap,
+                               alignment, error_metrics, metric_kernels, results_store,
+                               rendering],
+                              {'pandas': pd.__version__, 'n_boot': n_boot,
+                               'results_db': results_db, 'csv': csv})
+    # figures are rendered on a separate pool of processes
+    summary = run_cells_incremental(partial(evaluate_model, datapath, outpath, n_boot=n_boot,
+                                            results_db=results_db, csv=csv, renderer=defer), cells,
+                                    lambda cell: [LPJmLCell(lpjmlpath, cell).path(var)
+                                                  for var in ['mfapar', 'mgpp', 'mswc1']] + sat_files,
+                                    manifest, code, n_workers)
+    summary.to_csv(os.path.join(outpath, 'summary_cells.csv'))
+    print(summary[['status', 'seconds', 'error']])
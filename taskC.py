@@ -1,15 +1,42 @@
 # -*- coding: utf-8 -*-
 # Created by tobias at 23.06.19
 import os
+import sys
+import json
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
-from error_metrics import KGE
-from taskB import nrmse, pearson_corr, normalize_df
+from error_metrics import KGE_batch
+from taskB import nrmse, pearson_corr, normalize_values
 from exercise03 import read_data
-
-
+from lpjml import LPJmLCell
+from satellite import read_satellite
+from ensemble_cube import open_cube, find_parsets
+import ensemble_cube
+import exercise03
+import lpjml
+import satellite
+import taskB
+from manifest import Manifest, combine_hashes
+import bootstrap
+import alignment
+import error_metrics
+import metric_kernels
+import results_store
+import rendering
+import pareto
+from pareto import pareto_rank
+from results_store import open_store, store_from_env
+from rendering import Job, RenderPool, template, render
+from bootstrap import resample_indices, bootstrap_batch, confidence_interval
+from metric_kernels import taskb_metrics
+from alignment import Aligned, align, monthly
+import profiling
+from profiling import profiled, stage
+
+
+@profiled('calc_metrics')
 def calc_metrics(df, index_name=''):
     results_dict = {}
     results_dict['NRMSE'] = nrmse(df)
@@ -17,48 +44,287 @@ def calc_metrics(df, index_name=''):
     return pd.DataFrame(results_dict, index=[index_name])
 
 
-def read_fapar(cellpath, satpath, pars, cell):
-    fapar = read_data(os.path.join(cellpath, pars, '{}_{}_mfapar.txt'.format(cell, pars)))
-    fapar_sat = read_data(os.path.join(satpath, 'MOD15A2H.FPAR.forLPJcells.2000.2018.30days.txt'))
-    fapar_sat_cell = fapar_sat[cell].rename('MODIS-FAPAR')
-    index_min = max([fapar.index.min(), fapar_sat_cell.index.min()])
-    index_max = min([fapar.index.max(), fapar_sat_cell.index.max()])
-    fapar_comb = pd.concat([fapar, fapar_sat_cell], axis=1, sort=True).loc[index_min:index_max]
+@profiled('calc_metrics')
+def calc_metrics_values(s, o):
+    """
+    NRMSE and Corr of aligned model (s) and satellite (o) arrays, see
+    calc_metrics
+    """
+    metrics = taskb_metrics(s[None, :], o[None, :])
+    return [round(metrics['NRMSE'][0], 4), round(metrics['Corr'][0], 4)]
+
+
+def _parset_cell(cellpath, pars, cell):
+    # output of one parameter set, cellpath is <lpjmlpath>/cell_<cell>
+    return LPJmLCell(os.path.dirname(os.path.normpath(cellpath)), cell, pars)
+
+
+def read_fapar(cellpath, satpath, pars, cell, lpjml_cell=None):
+    """
+    model and MODIS FAPAR on their common months, see alignment.Aligned
+    """
+    if lpjml_cell is None:
+        lpjml_cell = _parset_cell(cellpath, pars, cell)
+    fapar = lpjml_cell['mfapar']
+    fapar_sat_cell = read_satellite(satpath, 'fapar', cell)
+    with stage('align', cell=cell, pars=pars):
+        fapar_comb = align([fapar, fapar_sat_cell], ['mfapar', 'MODIS-FAPAR'])
+    return fapar_comb
+
+
+def read_fapar_ensemble(cube, satpath, pars_set, cell):
+    """
+    FAPAR of many parameter sets from an EnsembleCube, aligned with MODIS
+    like read_fapar. Columns are the parameter sets and 'MODIS-FAPAR'.
+    """
+    fapar = cube.frame('mfapar')[pars_set]
+    fapar_sat_cell = read_satellite(satpath, 'fapar', cell, 'MODIS-FAPAR')
+    with stage('align', cell=cell):
+        index_min = max([fapar.index.min(), fapar_sat_cell.index.min()])
+        index_max = min([fapar.index.max(), fapar_sat_cell.index.max()])
+        fapar_comb = pd.concat([fapar, fapar_sat_cell], axis=1, sort=True).loc[index_min:index_max]
     return fapar_comb
 
 
-def read_sif(cellpath, satpath, pars, cell):
-    mgpp = read_data(os.path.join(cellpath, pars, '{}_{}_mgpp.txt'.format(cell, pars)))
-    mgpp = mgpp.rename(columns={'mgpp': 'LPJmL-GPP'})
-    mgpp_norm = normalize_df(mgpp)
-    sif = read_data(os.path.join(satpath, 'GlobFluo-GOME2.SIF.forLPJcells.2007.2015.30days.txt'))
-    sif_cell = sif[cell].rename('SIF')
-    sif_cell_norm = normalize_df(sif_cell)
-    index_min = max([mgpp.index.min(), sif_cell.index.min()])
-    index_max = min([mgpp.index.max(), sif_cell.index.max()])
-    gpp_sif = pd.concat([mgpp_norm, sif_cell_norm], axis=1, sort=True).loc[index_min:index_max]
+def _normalized(series):
+    # min-max normalized series over all its months
+    first, values = monthly(series)
+    return first, normalize_values(values)
+
+
+def read_sif(cellpath, satpath, pars, cell, lpjml_cell=None):
+    """
+    normalized model GPP and SIF on their common months, both are normalized
+    over their full length before clipping
+    """
+    if lpjml_cell is None:
+        lpjml_cell = _parset_cell(cellpath, pars, cell)
+    mgpp_norm = _normalized(lpjml_cell['mgpp'])
+    sif_cell_norm = _normalized(read_satellite(satpath, 'sif', cell))
+    with stage('align', cell=cell, pars=pars):
+        gpp_sif = align([mgpp_norm, sif_cell_norm], ['LPJmL-GPP', 'SIF'])
     return gpp_sif
 
 
-def read_swc(cellpath, satpath, pars, cell):
-    mswc = read_data(os.path.join(cellpath, pars, '{}_{}_mswc1.txt'.format(cell, pars)))
-    mswc = mswc.rename(columns={'mswc1': 'LPJmL-SWC'})
-    ssm = read_data(os.path.join(satpath, 'ESACCIv050.SSM.forLPJcells.1978.2017.30days.txt'))
-    ssm = ssm[cell].rename('ESACCISM')
-    ssm_norm = normalize_df(ssm)
-    mswc_norm = normalize_df(mswc)
-    index_min = max([ssm.index.min(), mswc.index.min()])
-    index_max = min([ssm.index.max(), mswc.index.max()])
-    ssm_comb = pd.concat([mswc_norm, ssm_norm], axis=1, sort=True).loc[index_min:index_max]
+def read_swc(cellpath, satpath, pars, cell, lpjml_cell=None):
+    """
+    normalized model soil water and ESA CCI soil moisture on their common
+    months, both are normalized over their full length before clipping
+    """
+    if lpjml_cell is None:
+        lpjml_cell = _parset_cell(cellpath, pars, cell)
+    ssm_norm = _normalized(read_satellite(satpath, 'ssm', cell))
+    mswc_norm = _normalized(lpjml_cell['mswc1'])
+    with stage('align', cell=cell, pars=pars):
+        ssm_comb = align([mswc_norm, ssm_norm], ['LPJmL-SWC', 'ESACCISM'])
     return ssm_comb
 
 
-def model_params_vs_performance_plot():
+# model variable compared with each satellite product
+PRODUCT_VARIABLES = {'fapar': 'mfapar', 'sif': 'mgpp', 'ssm': 'mswc1'}
+# products of the multi-objective ranking, name in the results database and
+# KGE column in metrics_for_param_settings.csv
+RANKED = [('fapar', 'FAPAR', 'kge'), ('sif', 'GPP-SIF', 'kge_gpp_sif'), ('ssm', 'SSM', 'kge_ssm')]
+
+
+def evaluate_parset(cellpath, satpath, cell, pars, products=('fapar', 'sif', 'ssm')):
+    """
+    Read the output of one parameter set, align it with the satellite
+    products and compute NRMSE and Corr for each of them.
+    :return: tuple
+        metrics (pd.Series indexed by metric and product) and a dict with
+        the aligned model/satellite series (alignment.Aligned) per product
+    """
+    readers = {'fapar': (read_fapar, 'FAPAR'),
+               'sif': (read_sif, 'GPP-SIF'),
+               'ssm': (read_swc, 'SSM')}
+    lpjml_cell = _parset_cell(cellpath, pars, cell)
+    combs = {}
+    labels = []
+    values = []
+    for product in products:
+        reader, label = readers[product]
+        combs[product] = reader(cellpath, satpath, pars, cell, lpjml_cell)
+        labels.append(label)
+        values.append(calc_metrics_values(*combs[product].values))
+    # same layout as pd.concat of the calc_metrics frames, unstacked
+    index = pd.MultiIndex.from_product([['NRMSE', 'Corr'], labels])
+    return pd.Series(np.array(values).T.ravel(), index=index), combs
+
+
+def iter_ensemble(cellpath, satpath, cell, pars_set, products=('fapar', 'sif', 'ssm'),
+                  n_workers=None):
+    """
+    Evaluate all parameter sets, see evaluate_parset.
+
+    The parameter sets are spread over a pool of n_workers processes
+    (default: number of CPUs, 1 runs in this process). Results are yielded
+    as they arrive but always in the order of pars_set, so the output is
+    the same as the serial evaluation.
+    """
+    func = partial(evaluate_parset, cellpath, satpath, cell, products=products)
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    if n_workers == 1:
+        for result in map(func, pars_set):
+            yield result
+    else:
+        chunksize = max(1, len(pars_set) // (4 * n_workers))
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            if profiling.enabled():
+                # bring the stage records of the workers back
+                for result, records in executor.map(partial(profiling.collect, func), pars_set,
+                                                    chunksize=chunksize):
+                    profiling.merge(records)
+                    yield result
+            else:
+                for result in executor.map(func, pars_set, chunksize=chunksize):
+                    yield result
+
+
+def ensemble_state(manifest, cellpath, satpath, cell, pars_set, products=('fapar', 'sif', 'ssm')):
+    """
+    Code hash and input hashes per parameter set of an ensemble evaluation
+    :return: tuple
+        code hash and dict pars -> input hashes
+    """
+    code = manifest.code_hash([sys.modules[__name__], taskB, lpjml, satellite, exercise03,
+                               alignment, bootstrap, error_metrics, metric_kernels, rendering,
+                               ensemble_cube],
+                              {'pandas': pd.__version__, 'products': list(products)})
+    sat_files = [os.path.join(satpath, satellite.PRODUCTS[product]) for product in products]
+    inputs = {}
+    for pars in pars_set:
+        lpjml_cell = _parset_cell(cellpath, pars, cell)
+        inputs[pars] = manifest.input_hashes(
+            [lpjml_cell.path(PRODUCT_VARIABLES[product]) for product in products] + sat_files)
+    return code, inputs
+
+
+def _replace(fname, write):
+    # write(f) to a temporary file that replaces fname
+    tmp_fname = '{}.{}.tmp'.format(fname, os.getpid())
+    try:
+        with open(tmp_fname, 'wb') as f:
+            write(f)
+        os.replace(tmp_fname, fname)
+    finally:
+        if os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
+
+
+def _write_parset(fname, result, stamp):
+    """
+    Store a result of evaluate_parset without pickle: the aligned series in
+    fname.npz, the metrics, the windows of the series and the stamp in
+    fname.json, which is written last
+    :param stamp: dict
+        code and input hashes the result was computed from
+    """
+    metrics, combs = result
+    arrays = {}
+    products = {}
+    for product, comb in combs.items():
+        products[product] = {'start': int(comb.start), 'names': comb.names}
+        for i, values in enumerate(comb.values):
+            arrays['{}_{}'.format(product, i)] = np.asarray(values, dtype=np.float64)
+    meta = {'stamp': stamp, 'products': products,
+            'metrics': [[metric, label, float(value)]
+                        for (metric, label), value in metrics.items()]}
+    if os.path.exists(fname + '.json'):
+        os.remove(fname + '.json')
+    _replace(fname + '.npz', lambda f: np.savez(f, **arrays))
+    _replace(fname + '.json', lambda f: f.write(json.dumps(meta).encode('utf-8')))
+
+
+def _read_parset(fname, stamp):
+    """
+    A result stored by _write_parset, None if it is missing, unreadable or
+    was computed from other code or inputs
+    """
+    try:
+        with open(fname + '.json') as f:
+            meta = json.load(f)
+        if meta['stamp'] != stamp:
+            return None
+        with np.load(fname + '.npz', allow_pickle=False) as npz:
+            combs = {product: Aligned(entry['start'], entry['names'],
+                                      [npz['{}_{}'.format(product, i)]
+                                       for i in range(len(entry['names']))])
+                     for product, entry in meta['products'].items()}
+        index = pd.MultiIndex.from_tuples([(metric, label) for metric, label, _ in meta['metrics']])
+        metrics = pd.Series([value for _, _, value in meta['metrics']], index=index)
+    except (OSError, ValueError, KeyError):
+        return None
+    return metrics, combs
+
+
+def iter_ensemble_cached(manifest, cellpath, satpath, cell, pars_set,
+                         products=('fapar', 'sif', 'ssm'), n_workers=None, state=None):
+    """
+    iter_ensemble that keeps the result of every parameter set next to the
+    manifest (.npz and .json, see _write_parset) and only evaluates the
+    parameter sets whose input files or code changed since.
+    :param manifest: manifest.Manifest
+        updated and saved when all results were yielded
+    :param state: tuple
+        result of ensemble_state if already known
+    """
+    code, inputs = state or ensemble_state(manifest, cellpath, satpath, cell, pars_set, products)
+    cachepath = os.path.join(manifest.path, 'parsets')
+    if not os.path.exists(cachepath):
+        os.makedirs(cachepath)
+    units = {pars: '{}_{}'.format(pars, '-'.join(products)) for pars in pars_set}
+    stale = [pars for pars in pars_set
+             if not manifest.is_current(units[pars], inputs[pars], code)]
+    fresh = iter_ensemble(cellpath, satpath, cell, stale, products, n_workers)
+
+    stale = set(stale)
+    for pars in pars_set:
+        fname = os.path.join(cachepath, units[pars])
+        stamp = {'code': code, 'inputs': inputs[pars]}
+        result = None if pars in stale else _read_parset(fname, stamp)
+        if result is None:
+            # stale, or the stored result cannot be read
+            result = next(fresh) if pars in stale else evaluate_parset(cellpath, satpath, cell,
+                                                                       pars, products)
+            _write_parset(fname, result, stamp)
+            manifest.update(units[pars], inputs[pars], code, [fname + '.npz', fname + '.json'])
+        yield result
+    manifest.save()
+
+
+def stack_ensemble(results, products):
+    """
+    Model runs of an ensemble as arrays on the months of the first run
+    :param results: iterable
+        per parameter set a dict product -> aligned model and satellite
+        series (alignment.Aligned), e.g. from evaluate_parset
+    :return: dict
+        product -> (runs, months) model values and satellite values
+    """
+    sims = {product: [] for product in products}
+    starts = {}
+    obs = {}
+    for combs in results:
+        for product in products:
+            comb = combs[product]
+            if product in obs:
+                # keep all runs on the months of the first run
+                comb = comb.reindex(starts[product], len(obs[product]))
+            else:
+                starts[product] = comb.start
+                obs[product] = comb.values[1]
+            sims[product].append(comb.values[0])
+    return {product: (np.vstack(sims[product]), obs[product]) for product in products}
+
+
+def model_params_vs_performance_plot(n_workers=None, renderer=render):
     """
     The initial plot that matthias critized.
     """
     cell = '32785'
-    pars_set = ['pars{}'.format(i) for i in range(1, 51)]
+    pars_set = find_parsets(cellpath)
 
     parameters = read_data(
         os.path.join(datapath, 'LPJmL', 'cell_32785_parameter-sets.txt'))
@@ -66,20 +332,11 @@ def model_params_vs_performance_plot():
 
     metric_sets = {}
     param_sets = {}
-    for i, pars in enumerate(pars_set):
-        print()
-        i += 1
-        fapar_comb = read_fapar(cellpath, satpath, pars, cell)
-        fapar_metrics = calc_metrics(fapar_comb, 'FAPAR')
-        sif_comb = read_sif(cellpath, satpath, pars, cell)
-        sif_metrics = calc_metrics(sif_comb, 'GPP-SIF')
-        ssm_comb = read_swc(cellpath, satpath, pars, cell)
-        ssm_metrics = calc_metrics(ssm_comb, 'SSM')
-        metric_results = pd.concat([fapar_metrics, sif_metrics, ssm_metrics])
-
-        # store metrics and params per run
-        metric_sets[i] = metric_results.unstack()
-        param_sets[i] = parameters.loc[pars]
+    results = iter_ensemble(cellpath, satpath, cell, pars_set, n_workers=n_workers)
+    for pars, (metric_results, combs) in zip(pars_set, results):
+        # store metrics and params per run, by the number of the parameter set
+        metric_sets[int(pars[4:])] = metric_results
+        param_sets[int(pars[4:])] = parameters.loc[pars]
 
     # to df
     par_set_metrics = pd.DataFrame.from_dict(metric_sets).T
@@ -89,8 +346,17 @@ def model_params_vs_performance_plot():
     print(par_set_params)
 
     # plot
-    fig, (ax1, ax2, ax3, ax4) = plt.subplots(nrows=4, sharex=True,
-                                             figsize=(12, 8))
+    renderer(Job(draw_params_vs_performance,
+                 os.path.join(outpath, '1_model_params_vs_performance.png'),
+                 par_set_metrics, par_set_params))
+
+
+@template(nrows=4, sharex=True, figsize=(12, 8))
+def draw_params_vs_performance(fig, axes, par_set_metrics, par_set_params):
+    """
+    NRMSE, correlation and parameters of every model run
+    """
+    ax1, ax2, ax3, ax4 = axes
     par_set_metrics[['NRMSE']].plot(ax=ax1)
     par_set_metrics[['Corr']].plot(ax=ax2)
     par_set_params['WATER_BASE'].plot(ax=ax3)
@@ -105,56 +371,138 @@ def model_params_vs_performance_plot():
     ax3.set_ylabel('WATER_BASE (%)')
     ax4.set_ylabel('EMAX ($mm day^{-1}$)')
 
-    plt.xlabel('Model run')
-    plt.tight_layout()
-    plt.savefig(os.path.join(outpath, '1_model_params_vs_performance.png'))
-    plt.close(fig)
+    ax4.set_xlabel('Model run')
+    fig.tight_layout()
+
+
+@template(figsize=(12, 5))
+def draw_kge_scatterplot(fig, ax, df_merged):
+    """
+    WATER_BASE vs. EMAX of the parameter sets, colored by KGE
+    """
+    import seaborn as sns
+
+    x = 'WATER_BASE'
+    y = 'EMAX'
+    sns.scatterplot(x=x,
+                         y=y,
+                         size='cc',
+                         hue='kge',
+                         data=df_merged,
+                    ax=ax,
+                    legend='brief')
+
+    # annotate setting number
+    for i, txt in enumerate(df_merged.index.values):
+        ax.annotate(txt, (df_merged[x].iloc[i], df_merged[y].iloc[i]),
+                    color='grey')
+
+    # Put a legend to the right of the current axis
+    ax.legend(loc='center left', bbox_to_anchor=(1, 0.5))
+
+    ax.set_title('Optimisation of model parameters via KGE')
+    ax.set_xlabel('WATER_BASE (%)')
+    ax.set_ylabel('EMAX ($mm day^{-1}$)')
+    fig.tight_layout()
 
 
-def kge_scatterplot():
+def kge_scatterplot(n_workers=None, cube=None, manifest=None, n_boot=1000, results_db=None,
+                    renderer=render):
     """
     Creates a scatterplot of WATER_BASE vs. EMAX parameters with the hue
     given by the Kling-Gupta efficiency (KGE).
 
-    KGE is calculated only based on sim and obs FAPAR as we saw that the
-    agreement for SSM and SIF-GPP are quite good regardless of the
-    parameter settings.
+    KGE is calculated for FAPAR, GPP-SIF and SSM (both normalized as in
+    taskB). The parameter sets are ranked by all three: the non-dominated
+    front (1 is best) and the crowding distance within the front, see
+    pareto.py. metrics_for_param_settings.csv is sorted by FAPAR KGE as
+    before, front and crowding distance are extra columns; the figure shows
+    the FAPAR KGE.
 
     Kling-Gupta efficiencies range from -Inf to 1.
     Essentially, the closer to 1, the more accurate the model is.
-    """
 
-    cell = '32785'
-    pars_set = ['pars{}'.format(i) for i in range(1, 51)]
+    If an EnsembleCube is given, the model output of all runs is sliced from
+    it instead of reading the text files of every parameter set.
 
-    parameters = read_data(
-        os.path.join(datapath, 'LPJmL', 'cell_32785_parameter-sets.txt'))
+    With a manifest.Manifest only new or changed parameter sets are read
+    again and nothing is done if none changed.
 
-    metric_sets = {'kge': [],
-                   'cc': [],
-                   'alpha': [],
-                   'beta': []}
-    param_sets = {}
-    for i, pars in enumerate(pars_set):
-        i += 1
-        fapar_comb = read_fapar(cellpath, satpath, pars, cell)
-        fapar_sim = fapar_comb['mfapar'].values
-        fapar_obs = fapar_comb['MODIS-FAPAR'].values
-
-        # calc KGE for each parameter set
-        kge, cc, alpha, beta = KGE(s=fapar_sim, o=fapar_obs)
-
-        # store metrics and params per run
-        metric_sets['kge'].append(kge)
-        metric_sets['cc'].append(cc)
-        metric_sets['alpha'].append(alpha)
-        metric_sets['beta'].append(beta)
-        param_sets[i] = parameters.loc[pars]
+    The 95% confidence interval of the FAPAR KGE (kge_ci_low, kge_ci_high)
+    comes from n_boot block bootstrap resamples (blocks of 12 months, the
+    same for all parameter sets), n_boot=0 skips it.
+
+    With results_db the parameters and metrics of every parameter set are
+    also written to the results database (see results_store.py).
+
+    The figure is handed to renderer (see rendering.py).
+    """
+
+    cell = '32785'
+    pars_set = find_parsets(cellpath)
+    products = tuple(product for product, _, _ in RANKED)
+
+    parameters_fname = os.path.join(datapath, 'LPJmL', 'cell_32785_parameter-sets.txt')
+    parameters = read_data(parameters_fname)
+
+    if manifest is not None and cube is None:
+        state = ensemble_state(manifest, cellpath, satpath, cell, pars_set, products)
+        code, inputs = state
+        code = combine_hashes([code, manifest.code_hash([bootstrap, results_store, pareto,
+                                                         ensemble_cube, rendering],
+                                                        {'n_boot': n_boot,
+                                                         'results_db': results_db})])
+        unit_inputs = {pars: combine_hashes(inputs[pars]) for pars in pars_set}
+        unit_inputs.update(manifest.input_hashes([parameters_fname]))
+        if manifest.is_current('kge_scatterplot', unit_inputs, code):
+            print('metrics_for_param_settings.csv is up to date')
+            return
+
+    # parameter sets by their number
+    numbers = [int(pars[4:]) for pars in pars_set]
+    param_sets = {number: parameters.loc[pars] for number, pars in zip(numbers, pars_set)}
+    if cube is not None:
+        fapar_comb = read_fapar_ensemble(cube, satpath, pars_set, cell)
+        # GPP and soil water of the cube, aligned per run like read_sif/read_swc
+        model_cells = ({var: cube.series(pars, var) for var in ('mgpp', 'mswc1')}
+                       for pars in pars_set)
+        ensemble = stack_ensemble(({'sif': read_sif(cellpath, satpath, pars, cell, model_cell),
+                                    'ssm': read_swc(cellpath, satpath, pars, cell, model_cell)}
+                                   for pars, model_cell in zip(pars_set, model_cells)),
+                                  ('sif', 'ssm'))
+        ensemble['fapar'] = (fapar_comb[pars_set].values.T, fapar_comb['MODIS-FAPAR'].values)
+    else:
+        if manifest is not None:
+            results = iter_ensemble_cached(manifest, cellpath, satpath, cell, pars_set,
+                                           products, n_workers, state)
+        else:
+            results = iter_ensemble(cellpath, satpath, cell, pars_set, products=products,
+                                    n_workers=n_workers)
+        ensemble = stack_ensemble((combs for metric_results, combs in results), products)
+    fapar_sims, fapar_obs = ensemble['fapar']
+
+    # calc KGE for all parameter sets at once
+    with stage('kge'):
+        kges = {product: KGE_batch(*ensemble[product]) for product in products}
 
     # to df
-    par_set_metrics = pd.DataFrame.from_dict(metric_sets)
-    # reindex to start from 1
-    par_set_metrics.index = np.arange(1, len(par_set_metrics) + 1)
+    product_metrics = {name: pd.DataFrame(dict(zip(['kge', 'cc', 'alpha', 'beta'], kges[product])))
+                       for product, name, _ in RANKED}
+    fapar_metrics = product_metrics['FAPAR']
+    if n_boot:
+        with stage('bootstrap'):
+            idx = resample_indices(len(fapar_obs), n_boot, block_size=12, seed=0)
+            kge_boot = bootstrap_batch(KGE_batch, fapar_sims, fapar_obs, idx)
+            fapar_metrics['kge_ci_low'], fapar_metrics['kge_ci_high'] = \
+                confidence_interval(kge_boot)
+    par_set_metrics = fapar_metrics.copy()
+    for product, name, column in RANKED[1:]:
+        par_set_metrics[column] = product_metrics[name]['kge']
+    with stage('pareto'):
+        fronts, crowding = pareto_rank(par_set_metrics[[column for _, _, column in RANKED]].values)
+    ranking = pd.DataFrame({'front': fronts, 'crowding': crowding})
+    par_set_metrics = pd.concat([par_set_metrics, ranking], axis=1)
+    par_set_metrics.index = numbers
     par_set_params = pd.DataFrame.from_dict(param_sets).T
 
     # merge -> output could be given to plot function from here on
@@ -162,33 +510,27 @@ def kge_scatterplot():
     sorted_by_kge = df_merged.sort_values('kge', ascending=False)
     sorted_by_kge.to_csv(os.path.join(outpath,
                                       'metrics_for_param_settings.csv'))
+    if results_db is not None:
+        with stage('store'):
+            parset_names = ['pars{}'.format(i) for i in df_merged.index]
+            store = open_store(results_db)
+            store.put_frame('taskC', par_set_params.set_axis(parset_names), index='parset',
+                            cell=cell)
+            store.put_frame('taskC', ranking.set_axis(parset_names), index='parset', cell=cell)
+            for name, metrics in product_metrics.items():
+                store.put_frame('taskC', metrics.set_axis(parset_names), index='parset',
+                                cell=cell, variable=name)
 
     # plot
-    fig, ax = plt.subplots(figsize=(12,5))
-    x = 'WATER_BASE'
-    y = 'EMAX'
-    sns.scatterplot(x=x,
-                         y=y,
-                         size='cc',
-                         hue='kge',
-                         data=df_merged,
-                    ax=ax,
-                    legend='brief')
-
-    # annotate setting number
-    for i, txt in enumerate(df_merged.index.values):
-        ax.annotate(txt, (df_merged[x].iloc[i], df_merged[y].iloc[i]),
-                    color='grey')
-
-    # Put a legend to the right of the current axis
-    ax.legend(loc='center left', bbox_to_anchor=(1, 0.5))
+    renderer(Job(draw_kge_scatterplot, os.path.join(outpath, '2_kge_scatterplot.png'), df_merged))
 
-    plt.title('Optimisation of model parameters via KGE')
-    plt.xlabel('WATER_BASE (%)')
-    plt.ylabel('EMAX ($mm day^{-1}$)')
-    plt.tight_layout()
-    plt.savefig(os.path.join(outpath, '2_kge_scatterplot.png'))
-    plt.close(fig)
+    if manifest is not None and cube is None:
+        outputs = [os.path.join(outpath, 'metrics_for_param_settings.csv'),
+                   os.path.join(outpath, '2_kge_scatterplot.png')]
+        if results_db is not None:
+            outputs.append(results_db)
+        manifest.update('kge_scatterplot', unit_inputs, code, outputs)
+        manifest.save()
 
 if __name__ == '__main__':
     rootpath = os.path.dirname(os.path.realpath(__file__))
@@ -201,4 +543,18 @@ if __name__ == '__main__':
     except:
         pass
 
-    kge_scatterplot()
\ No newline at end of file
+    # number of worker processes for the ensemble, defaults to all CPUs
+    n_workers = int(os.environ.get('TASKC_WORKERS', 0)) or None
+    # number of bootstrap resamples for the KGE confidence intervals
+    n_boot = int(os.environ.get('TASKC_BOOTSTRAP', 1000))
+    # read the ensemble from the memory-mapped cube instead of text files
+    cube = open_cube(cellpath, '32785') if os.environ.get('TASKC_CUBE') else None
+    # only changed parameter sets are evaluated again
+    manifest = Manifest(os.path.join(outpath, 'manifest.json'))
+    # results database, see results_store.py
+    results_db = store_from_env(os.path.join(rootpath, 'results', 'results.sqlite'))
+    # the figure is rendered in the background while the manifest is saved
+    with RenderPool(1) as pool:
+        kge_scatterplot(n_workers, cube, manifest, n_boot, results_db, pool.submit)
+    for fname, error in pool.errors.items():
+        print('rendering {} failed: {}'.format(fname, error))
\ No newline at end of file
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+The kernel of metric_kernels against the numpy backend: compiled with numba
+if it is installed (skipped otherwise) and as plain Python.
+"""
+import numpy as np
+import pytest
+
+import metric_kernels
+from bootstrap import taskb_metrics_batch
+from metric_kernels import PANEL, TASKB_METRICS, metric_panel, panel_rows, _kernel_panel
+
+# rows 0-6 of series
+EDGE_ROWS = ['no valid pair', 'single value', 'observed mean 0', 'constant simulation',
+             'constant observations', 'both constant', 'constant over the valid pairs']
+
+
+def series(runs, months, seed=0):
+    """simulations with gaps, the edge cases in the first rows"""
+    rng = np.random.RandomState(seed)
+    o = 0.5 + 0.3 * np.sin(np.arange(months) * 2 * np.pi / 12) + 0.05 * rng.normal(size=months)
+    s = o * rng.uniform(0.5, 1.5, size=(runs, 1)) + 0.05 * rng.normal(size=(runs, months))
+    s[rng.uniform(size=s.shape) < 0.1] = np.nan
+    o = np.tile(o, (runs, 1))
+    o[rng.uniform(size=o.shape) < 0.1] = np.nan
+    s[0] = np.nan
+    s[1, 1:] = np.nan
+    o[2] = 0.0
+    s[3] = 0.3
+    o[4] = 0.4
+    s[5], o[5] = 0.3, 0.4
+    o[6, ::2] = 0.1
+    s[6, 1::2] = np.nan
+    return s, o
+
+
+def kernel_panel(name, s, o):
+    if name == 'numba':
+        pytest.importorskip('numba')
+        return metric_panel(s, o, 'numba')
+    with np.errstate(all='ignore'):
+        return _kernel_panel(panel_rows, s, o)
+
+
+@pytest.fixture(params=['numba', 'python'])
+def kernel(request):
+    return request.param
+
+
+def test_kernel_matches_numpy(kernel):
+    s, o = series(2000 if kernel == 'numba' else 100, 60)
+    panel = kernel_panel(kernel, s, o)
+    expected = metric_panel(s, o, 'numpy')
+    for name in PANEL:
+        a, b = panel[name], expected[name]
+        np.testing.assert_array_equal(np.isnan(a), np.isnan(b), err_msg=name)
+        np.testing.assert_allclose(a[~np.isnan(a)], b[~np.isnan(b)], rtol=1e-10, atol=1e-12,
+                                   err_msg=name)
+
+
+def test_constant_series_keep_taskb_values(kernel):
+    s, o = series(len(EDGE_ROWS), 60)
+    panel = kernel_panel(kernel, s, o)
+    expected = taskb_metrics_batch(s, o)
+    constant = [3, 4, 5, 6]
+    for name in TASKB_METRICS:
+        # the same numbers, rounding noise included
+        np.testing.assert_array_equal(panel[name][constant], expected[name][constant],
+                                      err_msg=name)
+    assert np.isnan(panel['KGE'][constant]).all()
+    assert np.isnan(panel['alpha'][[4, 5, 6]]).all()
+    assert panel['alpha'][3] == 0.0
+
+
+def test_backend_selection(monkeypatch):
+    monkeypatch.setenv(metric_kernels.BACKEND_ENV, 'numpy')
+    assert metric_kernels.backend() == 'numpy'
+    with pytest.raises(ValueError):
+        metric_kernels.backend('fortran')
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+stream_metrics and merged accumulators against the batch metrics of
+error_metrics and metric_kernels.taskb_metrics.
+"""
+import numpy as np
+import pytest
+
+import error_metrics
+from metric_kernels import taskb_metrics
+from streaming import PairedAccumulator, stream_metrics
+
+# stream_metrics name -> batch function of error_metrics
+BATCH = {'pc_bias': error_metrics.pc_bias_batch, 'apb': error_metrics.apb_batch,
+         'rmse': error_metrics.rmse_batch, 'mae': error_metrics.mae_batch,
+         'bias': error_metrics.bias_batch, 'NS': error_metrics.NS_batch,
+         'L': error_metrics.L_batch, 'correlation': error_metrics.correlation_batch,
+         'index_agreement': error_metrics.index_agreement_batch,
+         'agreement_coefficient': error_metrics.agreement_coefficient_batch}
+
+
+def series(months=240, seed=0):
+    """a simulated and observed series with gaps"""
+    rng = np.random.RandomState(seed)
+    o = 0.5 + 0.3 * np.sin(np.arange(months) * 2 * np.pi / 12) + 0.05 * rng.normal(size=months)
+    s = 1.2 * o + 0.05 * rng.normal(size=months)
+    s[rng.uniform(size=months) < 0.1] = np.nan
+    o[rng.uniform(size=months) < 0.1] = np.nan
+    return s, o
+
+
+def chunked(s, o, bounds):
+    return lambda: ((s[lo:hi], o[lo:hi]) for lo, hi in zip(bounds[:-1], bounds[1:]))
+
+
+def expected_metrics(s, o):
+    expected = {name: func(s[None, :], o[None, :])[0] for name, func in BATCH.items()}
+    kge, cc, alpha, beta = error_metrics.KGE_batch(s[None, :], o[None, :])
+    expected.update({'kge': kge[0], 'cc': cc[0], 'alpha': alpha[0], 'beta': beta[0]})
+    expected.update({name: values[0] for name, values in taskb_metrics(s, o).items()})
+    return expected
+
+
+@pytest.mark.parametrize('bounds', [[0, 240], [0, 1, 2, 100, 101, 240],
+                                    [0, 17, 60, 120, 121, 200, 240]])
+def test_stream_metrics_match_batch(bounds):
+    s, o = series()
+    result = stream_metrics(chunked(s, o, bounds))
+    for name, value in expected_metrics(s, o).items():
+        assert result[name] == pytest.approx(value, rel=1e-12, abs=1e-14), name
+
+
+def test_merge_matches_one_accumulator():
+    s, o = series()
+    bounds = [0, 30, 31, 90, 150, 240]
+    single = PairedAccumulator()
+    for chunk_s, chunk_o in chunked(s, o, bounds)():
+        single.update(chunk_s, chunk_o)
+    # two workers with every other chunk, merged
+    parts = [PairedAccumulator(), PairedAccumulator()]
+    for i, (chunk_s, chunk_o) in enumerate(chunked(s, o, bounds)()):
+        parts[i % 2].update(chunk_s, chunk_o)
+    merged = parts[0].merge(parts[1])
+    for method in ['rmse', 'mae', 'bias', 'NS', 'correlation', 'nrmse', 'nae', 'vr']:
+        assert getattr(merged, method)() == pytest.approx(getattr(single, method)(),
+                                                          rel=1e-12), method
+    assert merged.KGE() == pytest.approx(single.KGE(), rel=1e-12)
+
+    seconds = [merged.second_pass(), merged.second_pass()]
+    for i, (chunk_s, chunk_o) in enumerate(chunked(s, o, bounds)()):
+        seconds[i % 2].update(chunk_s, chunk_o)
+    second = seconds[0].merge(seconds[1])
+    expected = expected_metrics(s, o)
+    assert second.ioa() == pytest.approx(expected['IoA'], rel=1e-12)
+    assert second.index_agreement() == pytest.approx(expected['index_agreement'], rel=1e-12)
+    assert second.agreement_coefficient() == pytest.approx(expected['agreement_coefficient'],
+                                                           rel=1e-12)
+
+
+def test_empty_chunks_and_no_valid_pair():
+    s = np.full(24, np.nan)
+    o = np.linspace(0.1, 0.9, 24)
+    result = stream_metrics(chunked(s, o, [0, 0, 12, 24]))
+    assert np.isnan(result['rmse']) and np.isnan(result['kge']) and np.isnan(result['NRMSE'])
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+Metrics of taskB (NRMSE, NAE, VR, IoA, Corr) and KGE over windows of months:
+moving windows, years and seasons.
+
+The sums the metrics are made of (values, squares and products of both
+series and the counts of valid values) are accumulated once along the
+months. The sum over any window is then the difference of two cumulative
+sums, so all windows of a series cost O(n_months) instead of one metric call
+per window. Like bootstrap.taskb_metrics_batch the means and variances use
+all valid values of a series in the window, the residual terms, Corr and KGE
+(as error_metrics.KGE_batch) only the valid pairs.
+
+    windows, metrics = rolling_metrics(s, o, 36, start=comb.start)
+    metrics['Corr']                     # (rows, windows)
+    years, metrics = yearly_metrics(s, o, comb.start)
+    seasons, metrics = seasonal_metrics(s, o, comb.start)
+    metrics_frame(seasons, metrics, rows=cells)
+
+s and o are (rows, n_months) arrays on the same months (e.g. the columns of
+an Aligned, one row per cell or parameter set) or single series, start is
+the month offset of their first month (see alignment.py).
+
+The denominator of IoA depends on the mean of the observations in the
+window inside an absolute value and has no cumulative form. For years and
+seasons it is still one pass over the months, for moving windows it is
+summed over a sliding_window_view of the series, O(n_months * window).
+"""
+import numpy as np
+import pandas as pd
+
+METRICS = ['NRMSE', 'NAE', 'VR', 'IoA', 'Corr', 'KGE', 'alpha', 'beta', 'n']
+SEASONS = ['DJF', 'MAM', 'JJA', 'SON']
+
+
+def _prefix(x):
+    # cumulative sums along the months with a leading 0, (rows, n_months + 1)
+    out = np.zeros((x.shape[0], x.shape[1] + 1))
+    np.cumsum(x, axis=1, out=out[:, 1:])
+    return out
+
+
+def _row_mean(x):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.nansum(x, axis=1) / np.sum(~np.isnan(x), axis=1)
+    return np.where(np.isnan(mean), 0.0, mean)[:, None]
+
+
+def window_sums(s, o, starts, stops):
+    """
+    Sums of the metrics over the windows [starts, stops) of the months
+    :return: dict
+        name -> (rows, windows) array, the values are shifted by the row
+        means 's_shift' and 'o_shift' (kept small, the centered sums do not
+        cancel)
+    """
+    valid_s = ~np.isnan(s)
+    valid_o = ~np.isnan(o)
+    pair = valid_s & valid_o
+    s_shift = _row_mean(s)
+    o_shift = _row_mean(o)
+    ds = np.where(valid_s, s - s_shift, 0.0)
+    do = np.where(valid_o, o - o_shift, 0.0)
+    ps = np.where(pair, ds, 0.0)
+    po = np.where(pair, do, 0.0)
+    terms = {'n_s': valid_s, 'sum_s': ds, 'sum_ss': ds ** 2,
+             'n_o': valid_o, 'sum_o': do, 'sum_oo': do ** 2,
+             'n': pair, 'pair_s': ps, 'pair_o': po,
+             'pair_ss': ps ** 2, 'pair_oo': po ** 2, 'pair_so': ps * po,
+             'sq': np.where(pair, s - o, 0.0) ** 2}
+    sums = {}
+    for name, x in terms.items():
+        cum = _prefix(x)
+        sums[name] = cum[:, stops] - cum[:, starts]
+    sums['s_shift'] = s_shift
+    sums['o_shift'] = o_shift
+    return sums
+
+
+def _metrics(sums, ioa_denom, min_count):
+    n_s, n_o, n = sums['n_s'], sums['n_o'], sums['n']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_s = sums['s_shift'] + sums['sum_s'] / n_s
+        mean_o = sums['o_shift'] + sums['sum_o'] / n_o
+        var_s = (sums['sum_ss'] - sums['sum_s'] ** 2 / n_s) / (n_s - 1)
+        var_o = (sums['sum_oo'] - sums['sum_o'] ** 2 / n_o) / (n_o - 1)
+        # centered sums of the valid pairs
+        ss = sums['pair_ss'] - sums['pair_s'] ** 2 / n
+        oo = sums['pair_oo'] - sums['pair_o'] ** 2 / n
+        so = sums['pair_so'] - sums['pair_s'] * sums['pair_o'] / n
+        corr = so / np.sqrt(ss * oo)
+        alpha = np.sqrt(ss / oo)
+        beta = ((sums['pair_s'] + n * sums['s_shift']) /
+                (sums['pair_o'] + n * sums['o_shift']))
+        metrics = {'NRMSE': np.sqrt(sums['sq'] / n) / mean_o,
+                   'NAE': (mean_s - mean_o) / mean_o,
+                   'VR': var_s / var_o,
+                   'IoA': 1 - sums['sq'] / ioa_denom,
+                   'Corr': corr,
+                   'KGE': 1 - np.sqrt((corr - 1) ** 2 + (alpha - 1) ** 2 + (beta - 1) ** 2),
+                   'alpha': alpha,
+                   'beta': beta}
+    few = n < min_count
+    for name in metrics:
+        metrics[name][few] = np.nan
+    metrics['n'] = n.astype(np.int64)
+    return metrics
+
+
+def _ioa_terms(s, o, o_mean):
+    # summands of the IoA denominator, 0 where a value is missing
+    terms = (np.abs(s - o_mean) + np.abs(o - o_mean)) ** 2
+    return np.where(np.isnan(terms), 0.0, terms)
+
+
+def _batch(s, o):
+    s = np.atleast_2d(np.asarray(s, dtype=np.float64))
+    o = np.broadcast_to(np.asarray(o, dtype=np.float64), s.shape)
+    return s, o
+
+
+def _row_chunks(n_rows, bytes_per_row, max_bytes):
+    size = max(1, int(max_bytes // max(bytes_per_row, 1)))
+    return [slice(start, start + size) for start in range(0, n_rows, size)]
+
+
+def _stack(parts):
+    return {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+
+
+def rolling_metrics(s, o, window=36, start=None, step=1, min_count=2, max_bytes=2 ** 28):
+    """
+    Metrics over moving windows of months
+    :param s: np.array
+        simulated, (rows, n_months) or (n_months,)
+    :param o: np.array
+        observed, (n_months,) or same shape as s
+    :param window: int
+        months per window
+    :param start: int
+        month offset of the first month, labels the windows with dates
+    :param step: int
+        months between the starts of two windows
+    :param min_count: int
+        windows with fewer valid pairs are nan
+    :param max_bytes: int
+        approximate memory limit, the rows are evaluated in chunks
+    :return: tuple
+        labels of the windows (last month, a DatetimeIndex if start is given
+        else positions) and dict metric -> (rows, windows) array
+    """
+    s, o = _batch(s, o)
+    n_rows, n_months = s.shape
+    starts = np.arange(0, max(n_months - window + 1, 0), step)
+    stops = starts + window
+    ends = stops - 1
+    labels = pd.Index(ends, name='month') if start is None else pd.DatetimeIndex(
+        (start + ends).astype('datetime64[M]').astype('datetime64[ns]'), name='date')
+    if not len(starts):
+        return labels, {name: np.empty((n_rows, 0)) for name in METRICS}
+
+    parts = []
+    # the sliding windows of IoA dominate the temporaries
+    for rows in _row_chunks(n_rows, 8 * 4 * len(starts) * window + 8 * 16 * n_months, max_bytes):
+        s_rows, o_rows = s[rows], o[rows]
+        sums = window_sums(s_rows, o_rows, starts, stops)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            o_mean = sums['o_shift'] + sums['sum_o'] / sums['n_o']
+        s_view = np.lib.stride_tricks.sliding_window_view(s_rows, window, axis=1)[:, ::step]
+        o_view = np.lib.stride_tricks.sliding_window_view(o_rows, window, axis=1)[:, ::step]
+        denom = _ioa_terms(s_view, o_view, o_mean[:, :, None]).sum(axis=2)
+        parts.append(_metrics(sums, denom, min_count))
+    return labels, _stack(parts)
+
+
+def group_metrics(s, o, labels, min_count=2, max_bytes=2 ** 28):
+    """
+    Metrics over groups of months, e.g. years
+    :param labels: array
+        group of every month
+    :return: tuple
+        sorted group labels (pd.Index) and dict metric -> (rows, groups)
+        array
+    """
+    s, o = _batch(s, o)
+    groups, inverse = np.unique(np.asarray(labels), return_inverse=True)
+    # months of a group next to each other, a group is a window then
+    order = np.argsort(inverse, kind='stable')
+    counts = np.bincount(inverse, minlength=len(groups))
+    stops = np.cumsum(counts)
+    starts = stops - counts
+    group_of_month = np.repeat(np.arange(len(groups)), counts)
+    s = s[:, order]
+    o = o[:, order]
+
+    parts = []
+    for rows in _row_chunks(s.shape[0], 8 * 20 * s.shape[1], max_bytes):
+        s_rows, o_rows = s[rows], o[rows]
+        sums = window_sums(s_rows, o_rows, starts, stops)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            o_mean = sums['o_shift'] + sums['sum_o'] / sums['n_o']
+        cum = _prefix(_ioa_terms(s_rows, o_rows, o_mean[:, group_of_month]))
+        parts.append(_metrics(sums, cum[:, stops] - cum[:, starts], min_count))
+    return pd.Index(groups), _stack(parts)
+
+
+def yearly_metrics(s, o, start, min_count=2):
+    """
+    Metrics per calendar year
+    :param start: int
+        month offset of the first month
+    :return: tuple
+        years and dict metric -> (rows, years) array
+    """
+    s, o = _batch(s, o)
+    months = start + np.arange(s.shape[1])
+    years, metrics = group_metrics(s, o, months // 12 + 1970, min_count)
+    return years.rename('year'), metrics
+
+
+def seasonal_metrics(s, o, start, by_year=False, min_count=2):
+    """
+    Metrics per season (DJF, MAM, JJA, SON)
+    :param start: int
+        month offset of the first month
+    :param by_year: bool
+        one window per season and year (December belongs to the winter of
+        the next year), all years of a season together otherwise
+    :return: tuple
+        seasons (pd.Index, or pd.MultiIndex of year and season) and dict
+        metric -> (rows, windows) array
+    """
+    s, o = _batch(s, o)
+    months = start + np.arange(s.shape[1])
+    season = (months % 12 + 1) % 12 // 3
+    if not by_year:
+        groups, metrics = group_metrics(s, o, season, min_count)
+        return pd.Index([SEASONS[i] for i in groups], name='season'), metrics
+    year = (months + 1) // 12 + 1970
+    groups, metrics = group_metrics(s, o, 4 * year + season, min_count)
+    index = pd.MultiIndex.from_arrays([groups // 4, [SEASONS[i] for i in groups % 4]],
+                                      names=['year', 'season'])
+    return index, metrics
+
+
+def metrics_frame(windows, metrics, rows=None):
+    """
+    The metrics of a windowed computation as table
+    :param windows: pd.Index
+        labels of the windows as returned with the metrics
+    :param rows: list
+        names of the rows (cells, parameter sets), default positions
+    :return: pd.DataFrame
+        one column per metric, index (row, window)
+    """
+    n_rows = metrics['n'].shape[0]
+    rows = np.arange(n_rows) if rows is None else np.asarray(rows)
+    levels = [np.repeat(rows, len(windows))]
+    levels += [np.tile(windows.get_level_values(i), n_rows) for i in range(windows.nlevels)]
+    index = pd.MultiIndex.from_arrays(levels, names=['row'] + list(windows.names))
+    return pd.DataFrame({name: metrics[name].ravel() for name in METRICS}, index=index)